@@ -46,6 +46,7 @@ from numpy import nan as Nan
 from hmp2_workflows.utils.misc import (get_sample_id_from_fname,
                                        parse_cfg_file,
                                        reset_column_headers)
+from hmp2_workflows.utils.metadata_cache import load_metadata
 
 
 def parse_cli_arguments():
@@ -134,7 +135,7 @@ def add_metadata_to_tsv(analysis_files, metadata_file,
     Returns: 
         list: A list containing the path to all modified files.
     """
-    metadata_df = pd.read_csv(metadata_file, dtype='str')
+    metadata_df = load_metadata(metadata_file, dtype='str')
 
     col_offset = -1    
     metadata_rows = None
@@ -41,8 +41,13 @@ import argparse
 import importlib
 import itertools
 import json
+import os
+import threading
+import time
 import types
 
+from multiprocessing.pool import ThreadPool
+
 import anytree
 import cutlass
 
@@ -77,17 +82,78 @@ def parse_cli_arguments():
                         'nodes will be delete.')
     parser.add_argument('--delete-root', action='store_true', default=False,
                         help='Delete the root node when this flag is specified.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Number of concurrent requests made to the OSDF '
+                        'when loading and deleting nodes.')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='OPTIONAL. Maximum number of deletes issued '
+                        'per second.')
+    parser.add_argument('--progress-file', 
+                        help='OPTIONAL. File recording every deleted node. '
+                        'Passing the same file to a restarted run skips any '
+                        'node already deleted.')
 
     return parser.parse_args()
 
 
-def build_osdf_tree(study_id):
+def _get_product_children(osdf_obj):
+    """Returns the sequence sets or products derived from the provided OSDF
+    object.
+
+    Args:
+        osdf_obj (cutlass.*): A prep, sequence set or product object.
+
+    Requires:
+        None
+
+    Returns:
+        list: All children of the provided object.
+    """
+    children = osdf_obj.children()
+    if not children:
+        return []
+
+    children = list(itertools.chain.from_iterable(list(c) for c in children))
+    return [c for c in children if not isinstance(c, types.GeneratorType)]
+
+
+def get_osdf_level(parents, get_children, threads=8):
+    """Fetches the children of all the provided OSDF objects concurrently. 
+
+    Args:
+        parents (list): The OSDF objects making up one level of the tree.
+        get_children (function): Returns the children of a single parent.
+        threads (int): The maximum number of parents queried at once.
+
+    Requires:
+        None
+
+    Returns:
+        list: The children of all parents.
+    """
+    if not parents:
+        return []
+
+    pool = ThreadPool(max(1, min(threads, len(parents))))
+    try:
+        children = pool.map(lambda parent: list(get_children(parent)), parents)
+    finally:
+        pool.close()
+        pool.join()
+
+    return list(itertools.chain.from_iterable(children))
+
+
+def build_osdf_tree(study_id, threads=8):
     """
     Builds a tree structure to contain all our targeted objects from the OSDF.
+    Each level of the tree is fetched with concurrent requests for all the 
+    nodes in the level above.
 
     Args:
         study_id (string): The study ID to act as the root node from which 
             all children nodes are retrieved.
+        threads (int): The maximum number of concurrent OSDF requests.
 
     Requires:
         None
@@ -129,57 +195,47 @@ def build_osdf_tree(study_id):
     study_obj = cutlass.Study.load(study_id)
     study_node = anytree.Node("root", osdf=study_obj, type='study')
     
+    ## Only the OSDF requests are made concurrently; nodes are added to the 
+    ## tree back on the main thread once each level has been fetched.
     subjects = list(study_obj.subjects())
     subject_nodes = [anytree.Node(s.id, osdf=s, parent=study_node, type='subject') for s in subjects]
     osdf_lookup_map.update({s.name: s for s in subject_nodes})
 
-    subject_attrs = [list(s.attributes()) for s in subjects]
-    subject_attrs = list(itertools.chain.from_iterable(subject_attrs))
-    subject_attr_nodes = map(_update_osdf_tree, subject_attrs)
+    subject_attrs = get_osdf_level(subjects, lambda s: s.attributes(), threads)
+    subject_attr_nodes = filter(None, map(_update_osdf_tree, subject_attrs))
     osdf_lookup_map.update({sa.name: sa for sa in subject_attr_nodes})
 
-    visits = [list(s.visits()) for s in subjects]
-    visits = list(itertools.chain.from_iterable(visits))
-    visit_nodes = map(_update_osdf_tree, visits)
+    visits = get_osdf_level(subjects, lambda s: s.visits(), threads)
+    visit_nodes = filter(None, map(_update_osdf_tree, visits))
     osdf_lookup_map.update({v.name: v for v in visit_nodes})
 
-    visit_attrs = [list(v.visit_attributes()) for v in visits]
-    visit_attrs = list(itertools.chain.from_iterable(visit_attrs))
-    visit_attr_nodes = map(_update_osdf_tree, visit_attrs)
+    visit_attrs = get_osdf_level(visits, lambda v: v.visit_attributes(), threads)
+    visit_attr_nodes = filter(None, map(_update_osdf_tree, visit_attrs))
     osdf_lookup_map.update({va.name: va for va in visit_attr_nodes})
 
-    samples = [list(v.samples()) for v in visits]
-    samples = list(itertools.chain.from_iterable(samples))
-    sample_nodes = map(_update_osdf_tree, samples)
+    samples = get_osdf_level(visits, lambda v: v.samples(), threads)
+    sample_nodes = filter(None, map(_update_osdf_tree, samples))
     osdf_lookup_map.update({sp.name: sp for sp in sample_nodes})
 
-    sample_attrs = [list(s.sampleAttributes()) for s in samples]
-    sample_attrs = list(itertools.chain.from_iterable(sample_attrs))
-    sample_attr_nodes = map(_update_osdf_tree, sample_attrs)
+    sample_attrs = get_osdf_level(samples, lambda s: s.sampleAttributes(), threads)
+    sample_attr_nodes = filter(None, map(_update_osdf_tree, sample_attrs))
     osdf_lookup_map.update({sa.name: sa for sa in sample_attr_nodes})
 
-    preps = [list(s.preps()) for s in samples]
-    preps = list(itertools.chain.from_iterable(preps))
-    prep_nodes = map(_update_osdf_tree, preps)
+    preps = get_osdf_level(samples, lambda s: s.preps(), threads)
+    prep_nodes = filter(None, map(_update_osdf_tree, preps))
     osdf_lookup_map.update({p.name: p for p in prep_nodes})
 
-    seq_sets = [list(c) for p in preps for c in p.children() if p.children()]
-    seq_sets = list(itertools.chain.from_iterable(seq_sets))
-    seq_sets = [ss for ss in seq_sets if not isinstance(ss, types.GeneratorType)]
-    seq_set_nodes = map(_update_osdf_tree, seq_sets)
+    seq_sets = get_osdf_level(preps, _get_product_children, threads)
+    seq_set_nodes = filter(None, map(_update_osdf_tree, seq_sets))
     osdf_lookup_map.update({ss.name: ss for ss in seq_set_nodes})
 
-    products = [list(c) for ss in seq_sets for c in ss.children() if ss.children()]
-    products = list(itertools.chain.from_iterable(products))
-    products = [p for p in products if not isinstance(p, types.GeneratorType)]
-    product_nodes = map(_update_osdf_tree, products)
+    products = get_osdf_level(seq_sets, _get_product_children, threads)
+    product_nodes = filter(None, map(_update_osdf_tree, products))
     osdf_lookup_map.update({po.name: po for po in product_nodes})
 
     ## Sometimes we have another round of products we need to account for here...
-    products2 = [list(c) for p in products for c in p.children() if p.children()]
-    products2 = list(itertools.chain.from_iterable(products2))
-    products2 = [p for p in products2 if not isinstance(p, types.GeneratorType)]
-    product_nodes2 = map(_update_osdf_tree, products2)
+    products2 = get_osdf_level(products, _get_product_children, threads)
+    product_nodes2 = filter(None, map(_update_osdf_tree, products2))
     osdf_lookup_map.update({po.name: po for po in product_nodes2})
 
     return study_node
@@ -210,9 +266,63 @@ def filter_osdf_tree(root_node, node_type):
     return filtered_root_node
 
 
-def delete_nodes(root_node, dry_run, delete_root, stop_node="root"):
+def get_deletion_levels(root_node, deleted_ids=None):
+    """Groups all nodes below the provided root node into levels that can be
+    deleted in parallel. Leaves make up the first level and every node is 
+    placed in the level after the highest of its children so that a level 
+    can only be deleted once all levels before it have been.
+
+    Args:
+        root_node (anytree.Node): The root node of the tree to delete from.
+        deleted_ids (set): OSDF ID's of nodes already deleted which are 
+            left out of the levels.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of lists of nodes, bottom level first.
     """
-    Cascade deletes OSDF nodes in a depth-first manner.
+    deleted_ids = deleted_ids or set()
+    levels = {}
+
+    for node in anytree.PostOrderIter(root_node):
+        if node is root_node or node.osdf.id in deleted_ids:
+            continue
+
+        levels.setdefault(node.height, []).append(node)
+
+    return [levels[height] for height in sorted(levels)]
+
+
+def read_progress_file(progress_file):
+    """Reads the OSDF ID's of all nodes deleted by previous runs.
+
+    Args:
+        progress_file (string): Path to the deletion progress file.
+
+    Requires:
+        None
+
+    Returns:
+        set: The OSDF ID's of all deleted nodes.
+    """
+    if not progress_file or not os.path.exists(progress_file):
+        return set()
+
+    with open(progress_file) as progress_fh:
+        return set(line.split('\t')[0].strip() for line in progress_fh 
+                   if line.strip())
+
+
+def delete_nodes(root_node, dry_run, delete_root, stop_node="root", threads=8,
+                 rate_limit=None, progress_file=None):
+    """
+    Cascade deletes OSDF nodes from the bottom of the tree up. All nodes in 
+    a level of the tree (see get_deletion_levels) are deleted concurrently 
+    before moving up to the next level. If any node in a level fails to 
+    delete the deletion is stopped so that no parent is deleted before its
+    children.
 
     Args:
         root_node (anytree.Node): The root node of the tree to delete from.
@@ -223,33 +333,100 @@ def delete_nodes(root_node, dry_run, delete_root, stop_node="root"):
         delete_root (boolean): If the stop_node parameter is set to 'root'
             this parameter can be passed to indicate we want to delete the 
             root node as well.
+        threads (int): The maximum number of concurrent deletes.
+        rate_limit (float): The maximum number of deletes issued per second
+            across all threads.
+        progress_file (string): File each deleted node is appended to. Nodes
+            already present in the file are not deleted again.
 
     Requires:
         None
 
     Returns:
-        None
+        list: The OSDF ID's of nodes that failed to delete.
     """
-    deleted = []
-    failed_delete = []
-
-    for node in anytree.PostOrderIter(root_node):
-        if dry_run:
-            if not node.name == "root":
+    deleted_ids = read_progress_file(progress_file)
+    levels = get_deletion_levels(root_node, deleted_ids)
+
+    if deleted_ids:
+        print "RESUMING DELETE; SKIPPING %s ALREADY DELETED NODES" % len(deleted_ids)
+
+    if dry_run:
+        for (level, nodes) in enumerate(levels):
+            node_types = {}
+            for node in nodes:
+                node_types[node.type] = node_types.get(node.type, 0) + 1
+
+            print "LEVEL %s: %s nodes (%s)" % (level, len(nodes), 
+                                                ", ".join("%s: %s" % item for item 
+                                                          in sorted(node_types.items())))
+            for node in nodes:
                 print "DELETING NODE:", node
-        else:
-            osdf_obj = node.osdf
-
-            if not node.name == "root":
-                print "DELETING NODE:", node
-                res = osdf_obj.delete()
-               
-                if not res:
-                    print "FAILED TO DELETE NODE:", node
-                    failed_delete.append(osdf_obj)
-
-    if failed_delete:
-        print "WARNING: The following OSDF nodes were not deleted:" + "\n".join(failed_delete)
+    else:
+        throttle_lock = threading.Lock()
+        next_delete = [time.time()]
+
+        def _delete_node(node):
+            """Deletes a single OSDF node honoring the requested rate limit.
+
+            Args:
+                node (anytree.Node): The node to delete.
+
+            Requires:
+                None
+
+            Returns:
+                tuple: The node and whether it was successfully deleted.
+            """
+            if rate_limit:
+                with throttle_lock:
+                    wait = next_delete[0] - time.time()
+                    next_delete[0] = max(next_delete[0], time.time()) + 1.0 / rate_limit
+                if wait > 0:
+                    time.sleep(wait)
+
+            try:
+                return (node, node.osdf.delete())
+            except Exception as exc:
+                print "ERROR DELETING NODE %s: %s" % (node.name, exc)
+                return (node, False)
+
+        failed_delete = []
+        progress_fh = open(progress_file, 'a') if progress_file else None
+
+        try:
+            for (level, nodes) in enumerate(levels):
+                print "DELETING LEVEL %s: %s nodes" % (level, len(nodes))
+                start_time = time.time()
+
+                pool = ThreadPool(max(1, min(threads, len(nodes))))
+                try:
+                    for (node, res) in pool.imap_unordered(_delete_node, nodes):
+                        if not res:
+                            print "FAILED TO DELETE NODE:", node
+                            failed_delete.append(node.osdf.id)
+                            continue
+
+                        print "DELETED NODE:", node
+                        if progress_fh:
+                            progress_fh.write("%s\t%s\n" % (node.osdf.id, node.type))
+                            progress_fh.flush()
+                finally:
+                    pool.close()
+                    pool.join()
+
+                print "Deleted level %s in %.1fs" % (level, time.time() - start_time)
+
+                if failed_delete:
+                    break
+        finally:
+            if progress_fh:
+                progress_fh.close()
+
+        if failed_delete:
+            print ("WARNING: The following OSDF nodes were not deleted; "
+                   "their parents were left in place:\n" + "\n".join(failed_delete))
+            return failed_delete
 
     if delete_root and stop_node == "root":
         print "DELETING ROOT NODE:", root_node
@@ -257,17 +434,21 @@ def delete_nodes(root_node, dry_run, delete_root, stop_node="root"):
         if not dry_run:
             root_node.osdf.delete()
 
+    return []
+
 
 def main(args):
     session = cutlass.iHMPSession(args.username, args.password, ssl=False)
     osdf = session.get_osdf()
 
-    root_node = build_osdf_tree(args.study_id)
+    root_node = build_osdf_tree(args.study_id, args.threads)
 
     if args.node_type_filter:
         root_node = filter_osdf_tree(root_node, args.node_type_filter)
             
-    delete_nodes(root_node, args.dry_run, args.delete_root)
+    delete_nodes(root_node, args.dry_run, args.delete_root, 
+                 threads=args.threads, rate_limit=args.rate_limit,
+                 progress_file=args.progress_file)
 
 
 if __name__ == "__main__":
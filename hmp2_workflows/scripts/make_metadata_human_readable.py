@@ -20,6 +20,7 @@ import re
 import pandas as pd
 
 from hmp2_workflows.utils.misc import parse_cfg_file 
+from hmp2_workflows.utils.metadata_cache import load_metadata
 
 
 def parse_cli_arguments():
@@ -69,7 +70,7 @@ def populate_value_lookup(row, lookup):
 
 def main(args):
     ## First parse the metadata file 
-    metadata_df = pd.read_csv(args.metadata_file, dtype='object')
+    metadata_df = load_metadata(args.metadata_file, dtype='object')
     metadata_conf = parse_cfg_file(args.config_file)
     conf_rename_cols = metadata_conf.get('col_rename')
     conf_recode_cols = metadata_conf.get('value_recode')
@@ -33,6 +33,7 @@ import argparse
 import pandas as pd
 
 from hmp2_workflows.utils.misc import parse_cfg_file 
+from hmp2_workflows.utils.metadata_cache import load_metadata
 
 
 def parse_cli_arguments():
@@ -108,7 +109,7 @@ def get_column_mapping(metadata_df, analysis_cols, old_id,
 
 
 def main(args):
-    metadata_df = pd.read_csv(args.metadata_file, dtype='str')
+    metadata_df = load_metadata(args.metadata_file, dtype='str')
     input_analysis_df = pd.read_table(args.input_analysis_file, dtype='str')
     analysis_cols = input_analysis_df.columns.tolist()[1:]
     config = parse_cfg_file(args.config_file)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+split_interleaved_fastq.py
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Splits an interleaved or name-sorted FASTQ file into mate 1, mate 2 and 
+orphan FASTQ files in a single pass. Output files ending in .gz are 
+compressed with pigz. Read and byte counts can optionally be written to a
+tab-delimited stats file for QC. If mates are not adjacent in the input 
+the --sort flag groups reads by name first using a bounded-memory external
+sort.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import argparse
+import os
+
+from hmp2_workflows.utils.fastq import (SPLIT_STATS_FIELDS, SORT_BUFFER_RECORDS,
+                                        split_interleaved_fastq)
+
+
+def parse_cli_arguments():
+    """Parses any command-line arguments passed into this script.
+
+    Args:
+        None
+
+    Requires:
+        None
+
+    Returns:
+        argparse.ArgumentParser: argparse object containing the arguments 
+            passed in by the user.
+    """
+    parser = argparse.ArgumentParser('Splits an interleaved FASTQ file into '
+                                     'paired-end and orphan FASTQ files.')
+    parser.add_argument('-i', '--input-fastq', required=True,
+                        help='The interleaved or name-sorted FASTQ file.')
+    parser.add_argument('-1', '--mate-1-fastq', required=True,
+                        help='The mate 1 output FASTQ file.')
+    parser.add_argument('-2', '--mate-2-fastq', required=True,
+                        help='The mate 2 output FASTQ file.')
+    parser.add_argument('-u', '--orphans-fastq', 
+                        help='OPTIONAL. The orphan reads output FASTQ file. '
+                        'Orphans are dropped if not provided.')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='The number of threads given to each output '
+                        'compressor. [DEFAULT: 1]')
+    parser.add_argument('-l', '--compress-level', type=int,
+                        help='OPTIONAL. The gzip compression level.')
+    parser.add_argument('-s', '--stats-file',
+                        help='OPTIONAL. Write read and byte counts to this '
+                        'tab-delimited file.')
+    parser.add_argument('--sort', action='store_true', default=False,
+                        help='OPTIONAL. Group reads by name before splitting.')
+    parser.add_argument('--tmp-dir', 
+                        help='OPTIONAL. Directory to write sort scratch files '
+                        'to. [DEFAULT: System temp directory]')
+    parser.add_argument('--sort-buffer', type=int, default=SORT_BUFFER_RECORDS,
+                        help='OPTIONAL. Number of reads indexed in memory at '
+                        'once when sorting. [DEFAULT: %s]' % SORT_BUFFER_RECORDS)
+
+    return parser.parse_args()
+
+
+def main(args):
+    stats = split_interleaved_fastq(args.input_fastq, 
+                                    args.mate_1_fastq,
+                                    args.mate_2_fastq,
+                                    args.orphans_fastq,
+                                    args.threads,
+                                    args.compress_level,
+                                    sort=args.sort,
+                                    tmp_dir=args.tmp_dir,
+                                    buffer_records=args.sort_buffer)
+
+    if args.stats_file:
+        with open(args.stats_file, 'w') as stats_fh:
+            stats_fh.write("\t".join(['sample'] + SPLIT_STATS_FIELDS) + "\n")
+            stats_fh.write("\t".join([os.path.basename(args.input_fastq)] + 
+                                     map(str, stats.values())) + "\n")
+
+
+if __name__ == "__main__":
+    main(parse_cli_arguments())
@@ -750,15 +750,75 @@ def fill_visit_nums(row):
     return visit_num
 
 
+def get_collection_table(collection_dict):
+    """Flattens the per-subject collection dates into a single table keyed 
+    on subject and collection number that can be joined against our 
+    metadata.
+
+    Args:
+        collection_dict (dict): Dictionary containing collection dates for 
+            each subject grouped by subject ID.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: Table containing the initial and previous 
+            collection dates for every subject and collection number.
+    """
+    collection_df = pd.concat(collection_dict.values())
+    initial_dates = (collection_df.groupby('Subject')['Actual Date of Receipt']
+                     .transform('first'))
+
+    collection_df = pd.DataFrame({'Subject': collection_df['Subject'],
+                                  'Collection #': collection_df['Collection #'],
+                                  'initial_coll_date': initial_dates,
+                                  'prev_coll_date': collection_df['prev_coll_date'].fillna(initial_dates)})
+    collection_df = (collection_df.dropna(subset=['Collection #'])
+                     .drop_duplicates(['Subject', 'Collection #'])
+                     .astype({'Subject': int, 'Collection #': int}))
+
+    return collection_df
+
+
+def get_biopsy_table(biopsy_dates):
+    """Flattens the parsed Studytrax biopsy dates into a table keyed on 
+    subject ID and interval name.
+
+    Args:
+        biopsy_dates (dict): A dictionary containing biopsy week numbers 
+            keyed on subject ID and sample type.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: Table of biopsy week numbers per subject and 
+            interval.
+    """
+    biopsy_rows = [(int(subj_id), interval, week_num) for (subj_id, intervals) 
+                   in (biopsy_dates or {}).iteritems() 
+                   for (interval, week_num) in intervals.iteritems()]
+    
+    return pd.DataFrame(biopsy_rows, columns=['subject_id', 'IntervalName', 
+                                              'biopsy_week_num'])
+
+
 def generate_collection_statistics(metadata_df, collection_dict, biopsy_dates=None):
     """Generates the week_num and interval_days columns which contain
     the number of weeks between the past collection date and days between 
     the last collection date respectively.
 
+    Rather than filtering each subject's collection dates once per row the
+    collection and biopsy dates are flattened into tables that are joined
+    against the whole metadata table at once.
+
     Args:
         metadata_df (pandas.DataFrame): DataFrame containing all metadata
         collection_dict (dict): Dictionary containing collection dates for 
             each subject grouped by subject ID.
+        biopsy_dates (dict): Biopsy week numbers keyed on subject ID and 
+            interval name.
 
     Requires:
         None
@@ -767,106 +827,111 @@ def generate_collection_statistics(metadata_df, collection_dict, biopsy_dates=No
         pandas.DataFrame: Updated DataFrame with week_num and interval_days
             columns populated for each row.
     """
-    def _add_collection_columns(row):
-        """Adds the week_num and interval_days columns to the provided row 
-        of a dataframe.
+    biopsy_types = ['host_transcriptomics', 'biopsy_16S', 'methylome']
+
+    if 'interval_days' not in metadata_df.columns:
+        metadata_df['interval_days'] = np.nan
+
+    metadata_df['Participant ID'] = metadata_df['Site/Sub/Coll ID'].str[:5]
+    subject_ids = metadata_df['Participant ID'].str[1:].astype(int)
+
+    is_biopsy = metadata_df['data_type'].isin(biopsy_types)
+    is_stool = ~is_biopsy & (metadata_df['data_type'] != 'host_genome')
+
+    ## Biopsy week numbers come from the supplementary Studytrax dates
+    interval_names = metadata_df['IntervalName'].fillna('')
+    is_baseline = is_biopsy & interval_names.str.contains('Baseline')
+    is_interval = (is_biopsy & ~is_baseline & 
+                   ~interval_names.str.contains('Follow'))
+
+    metadata_df.loc[is_baseline, 'week_num'] = "0"
+
+    if is_interval.any():
+        biopsy_weeks = pd.DataFrame({'subject_id': subject_ids[is_interval],
+                                     'IntervalName': metadata_df.loc[is_interval, 'IntervalName']})
+        biopsy_weeks = biopsy_weeks.merge(get_biopsy_table(biopsy_dates),
+                                          on=['subject_id', 'IntervalName'],
+                                          how='left').set_index(biopsy_weeks.index)
+        metadata_df.loc[is_interval, 'week_num'] = biopsy_weeks['biopsy_week_num']
+
+    ## Stool samples are compared against the subject's collection dates
+    metadata_df.loc[is_stool, 'Participant ID'] = (metadata_df.loc[is_stool, 'Site/Sub/Coll ID']
+                                                   .str.rsplit('C', 1).str[0])
+
+    metadata_df.loc[is_stool, 'Site'] = metadata_df.loc[is_stool, 'Site'].fillna(
+                                            metadata_df.loc[is_stool, 'SiteName'])
+    metadata_df.loc[is_stool, 'SiteName'] = metadata_df.loc[is_stool, 'SiteName'].fillna(
+                                                metadata_df.loc[is_stool, 'Site'])
+
+    to_compute = (is_stool & metadata_df['week_num'].isnull() & 
+                  metadata_df['Actual Date of Receipt'].notnull())
+
+    if to_compute.any():
+        visits_df = pd.DataFrame({'Subject': subject_ids[to_compute],
+                                  'Collection #': pd.to_numeric(metadata_df.loc[to_compute, 'visit_num']).astype(int),
+                                  'receipt_date': metadata_df.loc[to_compute, 'Actual Date of Receipt']})
+        visits_df = visits_df.merge(get_collection_table(collection_dict),
+                                    on=['Subject', 'Collection #'],
+                                    how='left').set_index(visits_df.index)
+        visits_df = visits_df[visits_df['initial_coll_date'].notnull()]
+
+        metadata_df.loc[visits_df.index, 'week_num'] = (visits_df['receipt_date'] - 
+                                                        visits_df['initial_coll_date']).dt.days // 7
+        metadata_df.loc[visits_df.index, 'interval_days'] = (visits_df['receipt_date'] - 
+                                                             visits_df['prev_coll_date']).dt.days
 
-        Args:
-            row (pandas.Series): A row of the metadata dataframe
-    
-        Requires:
-            None
-
-        Returns:
-            pandas.Series: Modified row containing populated week_num and 
-                interval_day columns.
-        """
-        data_type = row['data_type']
-
-        ## Sticking this in here for the time being...
-        participant_id = row['Site/Sub/Coll ID'][:5]
-        row['Participant ID'] = participant_id
-        subject_id = int(row['Participant ID'][1:])
-        
-        if data_type in ['host_transcriptomics', 'biopsy_16S', 'methylome']:
-            interval_name = row['IntervalName']
-            
-            if "Baseline" in interval_name:
-                row['week_num'] = "0"
-            elif not  "Follow" in interval_name:
-                row['week_num'] = biopsy_dates[str(subject_id)][interval_name]
-        elif data_type != 'host_genome':
-            visit_num = row['visit_num']
-            receipt_date = row['Actual Date of Receipt']
-
-            ## Sticking this in here for the time being...
-            participant_id = row['Site/Sub/Coll ID'].rsplit('C', 1)[0]
-            row['Participant ID'] = participant_id
-
-            if pd.isnull(row['Site']):
-                row['Site'] = row['SiteName']
-            elif pd.isnull(row['SiteName']):
-                row['SiteName'] = row['Site']
-
-            if pd.isnull(row['week_num']) and not pd.isnull(receipt_date):
-                #print row
-                collection_dates = collection_dict.get(subject_id)
-                #print "DEBUG:", collection_dates, visit_num
-                initial_visit_date = collection_dates.iloc[0]['Actual Date of Receipt']
-                subj_collection_row = collection_dates[collection_dates['Collection #']
-                                                       == int(visit_num)]
-                prev_visit_date = subj_collection_row['prev_coll_date'].values[0]
-
-                if pd.isnull(prev_visit_date):
-                    prev_visit_date = initial_visit_date
-
-                row['week_num'] = (receipt_date - initial_visit_date).days / 7
-                row['interval_days'] = (receipt_date - prev_visit_date).days
-
-        return row
-
-    metadata_df = metadata_df.apply(_add_collection_columns, axis=1)
     metadata_df = add_biopsy_visit_num(metadata_df)
 
     return metadata_df
 
 
 def add_biopsy_visit_num(metadata_df):
-    """
-    """
-    for (idx, row) in metadata_df[metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome'])].iterrows():
-        week_num = row.get('week_num')
-        visit_num = row.get('visit_num')
-        participant_id = row.get('Participant ID')
+    """Assigns a visit number to any biopsy samples lacking one by matching
+    the biopsy's week number against the subject's stool collections; an 
+    exact match is preferred otherwise the closest week is used.
 
-        if not pd.isnull(visit_num):
-            continue
+    Args:
+        metadata_df (pandas.DataFrame): DataFrame containing all metadata
 
-        if pd.isnull(week_num) or week_num == '':
-            visit_num = 1
-        else:
-            ## Do we have an exact match somewhere?
-            match = metadata_df.loc[(metadata_df['Participant ID'] == participant_id) &
-                                    (metadata_df['week_num'] == week_num) &
-                                    (-metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome']))]
+    Requires:
+        None
 
-            if not match.empty:
-                visit_num = match.get('visit_num').values[0]
-            else:
-                ## If not then we are going to try to get as close as possible here...
-                subject_rows = metadata_df.loc[(metadata_df['Participant ID'] == participant_id) &
-                                               (-metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome']))]
-                subject_rows['week_num'] = pd.to_numeric(subject_rows['week_num'])
-                matches = subject_rows.iloc[(subject_rows['week_num']-float(week_num)).abs().argsort()[:2]]
-
-                if matches.empty:
-                    visit_num = 1
-                else:
-                    visit_num = matches['visit_num'].values[0]
+    Returns:
+        pandas.DataFrame: Updated DataFrame with visit_num populated for 
+            all biopsy samples.
+    """
+    biopsy_types = ['host_transcriptomics', 'biopsy_16S', 'methylome']
+    is_biopsy = metadata_df['data_type'].isin(biopsy_types)
+
+    biopsy_df = metadata_df[is_biopsy & metadata_df['visit_num'].isnull()]
+    if biopsy_df.empty:
+        return metadata_df
+
+    ## Precompute the week numbers of every stool collection per subject 
+    ## once rather than filtering the whole table for each biopsy.
+    stool_weeks_df = pd.DataFrame({'Participant ID': metadata_df.loc[~is_biopsy, 'Participant ID'],
+                                   'week_num': pd.to_numeric(metadata_df.loc[~is_biopsy, 'week_num'],
+                                                             errors='coerce'),
+                                   'visit_num': metadata_df.loc[~is_biopsy, 'visit_num']})
+    stool_weeks_df = stool_weeks_df.dropna(subset=['week_num'])
+    stool_weeks = dict((participant_id, df) for (participant_id, df) in 
+                       stool_weeks_df.groupby('Participant ID', sort=False))
+
+    biopsy_week_nums = pd.to_numeric(biopsy_df['week_num'].replace('', np.nan),
+                                     errors='coerce')
+
+    for (idx, participant_id, week_num) in zip(biopsy_df.index, 
+                                                biopsy_df['Participant ID'],
+                                                biopsy_week_nums):
+        subject_weeks = stool_weeks.get(participant_id)
+        visit_num = 1
+
+        if not pd.isnull(week_num) and subject_weeks is not None:
+            week_diffs = (subject_weeks['week_num'] - week_num).abs().values
+            visit_num = subject_weeks['visit_num'].values[np.argsort(week_diffs, kind='mergesort')[0]]
+
+        metadata_df.at[idx, 'visit_num'] = visit_num
 
-        row['visit_num'] = visit_num
-        metadata_df.loc[idx] = row
-    
     return metadata_df
 
 
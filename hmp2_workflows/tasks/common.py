@@ -30,24 +30,41 @@ furnished to do so, subject to the following conditions:
 
 import itertools
 import os
-import shutil
-import tempfile
+
+from multiprocessing.pool import ThreadPool
 
 from biobakery_workflows import utilities as bb_utils
 from hmp2_workflows import utils as hmp_utils
+from hmp2_workflows.utils import checksums
+from hmp2_workflows.utils import staging
+from hmp2_workflows.utils.files import create_tarball
 
 
-def verify_files(workflow, input_files, checksums_file):
+def verify_files(workflow, input_files, checksums_file, local=False, 
+                 threads=4, cache_file=None, report_file=None):
     """Verifies the integrity of all files found under the supplied directory 
     using md5 checksums. In order for this function to work properly an file 
     contanining md5 checksums must have been generated on the source side of 
     the files and provided when these files were uploaded.
 
+    By default one md5sum task is dispatched per file. If local is set to 
+    True all files are instead hashed by a single task in a local pool of 
+    threads and the results are written to one verification report.
+
     Args:
         input_file_dir (string): Path to directory containing files to be 
            checked.
         checksums_file (string): Path to file containing the source side md5 
             checksums.
+        local (boolean): Hash files in-process rather than with one md5sum 
+            task per file.
+        threads (int): Number of files hashed in parallel in local mode.
+        cache_file (string): Optional JSON cache of checksums keyed on 
+            inode, size and mtime so unchanged files are not re-hashed 
+            across workflow runs.
+        report_file (string): Path to the verification report written in
+            local mode. Defaults to the checksums file with a 
+            .verification.tsv extension.
 
     Requires:
         None
@@ -73,6 +90,32 @@ def verify_files(workflow, input_files, checksums_file):
         if not md5sum:
             raise KeyError('MD5 checksum not found.', input_file)
 
+    if local:
+        def _verify_checksums(task):
+            """Hashes all input files in a local thread pool and writes
+            a verification report, failing if any checksum mismatches."""
+            results = checksums.verify_md5_checksums(input_files,
+                                                     checksums_dict,
+                                                     threads, cache_file)
+            checksums.write_verification_report(results, task.targets[0].name)
+
+            failed_files = [result[0] for result in results 
+                            if result[-1] != 'OK']
+            if failed_files:
+                raise ValueError('MD5 checksum verification failed', 
+                                 failed_files)
+
+        if not report_file:
+            report_file = os.path.splitext(checksums_file)[0] + '.verification.tsv'
+
+        workflow.add_task(_verify_checksums,
+                          depends = list(input_files) + [checksums_file],
+                          targets = [report_file])
+
+        return input_files
+
+    for input_file in input_files:
+        md5sum = checksums_dict.get(os.path.basename(input_file))
         workflow.add_task_gridable('echo "[args[0]] *[depends[0]]" | md5sum -c -',
                                    depends = [input_file],
                                    args = [md5sum],
@@ -86,7 +129,7 @@ def verify_files(workflow, input_files, checksums_file):
 
 
 def stage_files(workflow, input_files, target_dir, delete=False, 
-                preserve=False, symlink=False):
+                preserve=False, symlink=False, batch=True, batch_size=None):
     """Moves data files from the supplied origin directory to the supplied
     destination directory. In order to include a file verification check in
     the staging process rsync is used by default to copy files.
@@ -97,6 +140,10 @@ def stage_files(workflow, input_files, target_dir, delete=False,
     An optional parameter may be provided to only stage files with the 
     corresponding extension.
 
+    By default files are staged in batches, one rsync call per group of 
+    files sharing a source directory, rather than one rsync call per file.
+    Each staged file is still exposed to AnADAMA2 as its own target.
+
     Args:
         workflow (anadama2.Workflow): The workflow object.
         input_files: A collection of input files to be staged.
@@ -107,6 +154,10 @@ def stage_files(workflow, input_files, target_dir, delete=False,
         symlink (boolean): By default create symlinks from the origin 
             directory to the destination directory. If set to 
             False files will be copied using rsync.
+        batch (boolean): Copy files in batches grouped by source directory.
+            If set to False one rsync task is created per file.
+        batch_size (int): Maximum number of files copied by a single 
+            rsync call when batching.
 
     Requires:
         rsync v3.0.6+: A versatile file copying tool.
@@ -133,8 +184,21 @@ def stage_files(workflow, input_files, target_dir, delete=False,
     ## it tells when the files were received and is used by the website.
     target_files = bb_utils.name_files(input_files, target_dir)
 
-    ## TODO: Figure out a better way to handle this rather than creating 
-    ## N rsync calls.
+    def _stage_file_batch(task):
+        """Copies a batch of files sharing a source directory with one
+        rsync call."""
+        staging.rsync_file_batch([depend.name for depend in task.depends],
+                                 os.path.dirname(task.targets[0].name))
+
+    if batch and not symlink and not preserve:
+        for (_source_dir, _target_dir, batch_inputs, batch_targets) in \
+            staging.group_files_by_dir(input_files, target_files, batch_size):
+            workflow.add_task(_stage_file_batch,
+                              depends = batch_inputs,
+                              targets = batch_targets)
+
+        return target_files
+
     stage_cmd = "remove_if_exists.py [targets[0]] ; rsync -avz [depends[0]] [targets[0]]"
     
     if preserve:
@@ -151,6 +215,111 @@ def stage_files(workflow, input_files, target_dir, delete=False,
     return target_files
 
 
+def stage_and_hash_files(workflow, input_files, target_dir, checksums_file=None,
+                         threads=4, batch_size=None):
+    """Copies data files into the supplied target directory while computing
+    their MD5 checksums from the bytes being copied, so each file is read 
+    only once. A <FILE>.md5 checksum file is written alongside each staged 
+    file and, if a source-side checksums file is provided, every file is 
+    verified against it in the same pass.
+
+    Files are copied in batches grouped by source directory with each batch
+    copied by a local pool of threads.
+
+    Args:
+        workflow (anadama2.Workflow): The workflow object.
+        input_files (list): A collection of input files to be staged.
+        target_dir (string): Path to destination directory where files 
+            should be copied.
+        checksums_file (string): Optional path to a file containing the 
+            source side md5 checksums.
+        threads (int): Number of files copied in parallel within a batch.
+        batch_size (int): Maximum number of files copied by a single task.
+
+    Requires:
+        None
+
+    Returns:
+        tuple: A list of the staged files and a list of their md5 checksum
+            files.
+
+    Example:
+        from anadama2 import Workflow
+        from hmp2_workflows.tasks import common
+
+        workflow = anadama2.Workflow()
+
+        (staged_files, md5_files) = common.stage_and_hash_files(workflow, 
+                                                                ['/tmp/fooA.bam', 
+                                                                 '/tmp/fooB.bam'],
+                                                                '/tmp/out_dir',
+                                                                '/tmp/foo_checksums.txt')
+
+        workflow.go()
+    """
+    if not os.path.exists(target_dir):
+        raise OSError(2, 'Target directory does not exist', target_dir)
+
+    checksums_dict = {}
+    if checksums_file:
+        checksums_dict = hmp_utils.misc.parse_checksums_file(checksums_file)
+
+        for input_file in input_files:
+            if not checksums_dict.get(os.path.basename(input_file)):
+                raise KeyError('MD5 checksum not found.', input_file)
+
+    target_files = bb_utils.name_files(input_files, target_dir)
+    md5_files = [target_file + '.md5' for target_file in target_files]
+
+    def _stage_and_hash_batch(batch_inputs, batch_targets):
+        """Copies and hashes a batch of files in a local thread pool, 
+        writing a checksum file per staged file. The batch is bound here 
+        rather than read back off the task so inputs are always paired 
+        with their own targets."""
+        pool = ThreadPool(max(1, min(threads, len(batch_inputs))))
+        try:
+            md5sums = pool.map(lambda files: checksums.copy_and_hash_file(*files),
+                               zip(batch_inputs, batch_targets))
+        finally:
+            pool.close()
+            pool.join()
+
+        failed_files = []
+        for (input_file, target_file, md5sum) in zip(batch_inputs, 
+                                                      batch_targets, 
+                                                      md5sums):
+            expected_md5 = checksums_dict.get(os.path.basename(input_file))
+
+            if expected_md5 and expected_md5 != md5sum:
+                failed_files.append(input_file)
+                os.remove(target_file)
+            else:
+                checksums.write_md5_sidecar(target_file, md5sum)
+
+        if failed_files:
+            raise ValueError('MD5 checksum verification failed', failed_files)
+
+    def _make_batch_task(batch_inputs, batch_targets):
+        """Returns the AnADAMA2 task function copying the provided batch."""
+        def _stage_and_hash_task(task):
+            _stage_and_hash_batch(batch_inputs, batch_targets)
+
+        return _stage_and_hash_task
+
+    for (_source_dir, _target_dir, batch_inputs, batch_targets) in \
+        staging.group_files_by_dir(input_files, target_files, batch_size):
+        batch_depends = list(batch_inputs)
+        if checksums_file:
+            batch_depends.append(checksums_file)
+
+        workflow.add_task(_make_batch_task(list(batch_inputs), list(batch_targets)),
+                          depends = batch_depends,
+                          targets = batch_targets + [target_file + '.md5' for 
+                                                     target_file in batch_targets])
+
+    return (target_files, md5_files)
+
+
 def make_files_web_visible(workflow, files):
     """Receives a list of files to be disseminated and ensures that they are 
     visible on the IBDMDB website.
@@ -194,7 +363,8 @@ def make_files_web_visible(workflow, files):
     return files
 
 
-def tar_files(workflow, files, output_tarball, depends, compress=True):
+def tar_files(workflow, files, output_tarball, depends, compress=True,
+              compressor='pigz', threads=1, level=None):
     """Creates a tarball package of the provided files with the given output
     tarball file path.
 
@@ -205,7 +375,11 @@ def tar_files(workflow, files, output_tarball, depends, compress=True):
         depends (list): A list of files that can be tied to the files to 
             be tar'd. These dependencies are not tar'd but needed to make 
             sure that this step in the workflow is not run out of order.
-        compress (string):             
+        compress (boolean): Compress the tarball.
+        compressor (string): One of pigz, gzip or zstd. Falls back to gzip 
+            if pigz is not installed.
+        threads (int): Number of threads used by the compressor.
+        level (int): Compression level passed to the compressor.
 
     Requires:
         None
@@ -224,31 +398,62 @@ def tar_files(workflow, files, output_tarball, depends, compress=True):
 
         out_tar = common.tar_files(workflow, files_to_tar, tar_file)
     """
-    ## Though there may be a cleaner way of doing this we need to create 
-    ## a temporary folder to symlink all the files we want to package into 
-    ## a tarball to get rid of tar'ing the directory structure as well.
-    tmp_dir = tempfile.mkdtemp()
-    tar_args = "-hcvf"
-
-    for target_file in files:
-        symlink_path = os.path.join(tmp_dir, os.path.basename(target_file))
-        os.symlink(target_file, symlink_path)
-    
+    return tar_files_batch(workflow, [(files, output_tarball)], depends,
+                           compress, compressor, threads, level)[0]
+
+
+def tar_files_batch(workflow, tarballs, depends=None, compress=True,
+                    compressor='pigz', threads=4, level=None):
+    """Creates many tarballs from a single task. Each tarball is written 
+    by streaming its files straight into tar, without the directory 
+    structure of the files, and through a multi-threaded compressor.
+
+    Args:
+        workflow (anadama2.Workflow): The workflow object.
+        tarballs (list): A list of (files, output_tarball) tuples.
+        depends (list): A list of files that can be tied to the files to 
+            be tar'd. If not provided the files being tar'd are used.
+        compress (boolean): Compress the tarballs.
+        compressor (string): One of pigz, gzip or zstd.
+        threads (int): Number of threads used by the compressor.
+        level (int): Compression level passed to the compressor.
+
+    Requires:
+        None
+
+    Returns:
+        list: Paths to the newly created tarball files.
+
+    Example:
+        from anadama2 import Workflow
+        from hmp2_workflows.tasks import common
+
+        workflow = anadama2.Workflow()
+
+        tarballs = [(['/tmp/fooA.tsv', '/tmp/barA.tsv'], '/tmp/A.tgz'),
+                    (['/tmp/fooB.tsv', '/tmp/barB.tsv'], '/tmp/B.tgz')]
+        out_tars = common.tar_files_batch(workflow, tarballs, threads=8)
+    """
+    output_tarballs = [output_tarball for (_files, output_tarball) in tarballs]
+
+    def _create_tarballs(task):
+        """Writes every tarball in this batch."""
+        for (files, output_tarball) in tarballs:
+            create_tarball(files, output_tarball, compress, compressor, 
+                           threads, level)
+
     depend_files = []
     if depends:
         depend_files.extend(depends)
     else:
-        depend_files.extend(files)
+        for (files, _output_tarball) in tarballs:
+            depend_files.extend(files)
 
-    if compress:
-        tar_args = tar_args + "z"
-    
-    workflow.add_task('tar -hcvzf [targets[0]] -C [args[0]] .; rm -rf [args[0]]',
+    workflow.add_task(_create_tarballs,
                       depends = depend_files,
-                      targets = [output_tarball],
-                      args = [tmp_dir])
+                      targets = output_tarballs)
 
-    return output_tarball
+    return output_tarballs
 
 
 def generate_md5_checksums(workflow, files):
@@ -28,60 +28,127 @@ furnished to do so, subject to the following conditions:
     THE SOFTWARE.
 """
 
+import httplib
 import os
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
 
-def upload_data_files(workflow, dcc_file_objects):
+from hmp2_workflows.utils.dcc import (save_osdf_object, get_local_files,
+                                      read_upload_plan, load_plan_entry)
+
+## Maximum number of concurrent saves against each DCC host. Objects with 
+## local files are pushed through the aspera server while everything else 
+## is a metadata-only save against OSDF.
+UPLOAD_HOST_LIMITS = {'aspera': 4, 'osdf': 8}
+
+## Errors raised by a save that are worth retrying; socket, aspera and 
+## requests failures all derive from EnvironmentError. Anything else (i.e.
+## a ValueError from validation) fails the object straight away.
+TRANSIENT_UPLOAD_ERRORS = (EnvironmentError, httplib.HTTPException)
+
+
+def _get_upload_host(dcc_file):
+    """Returns the DCC host the provided object will be saved against.
+
+    Args:
+        dcc_file (cutlass.*): An iHMP OSDF object.
+
+    Requires:
+        None
+
+    Returns:
+        string: 'aspera' if the object carries local files otherwise 'osdf'
+    """
+    return 'aspera' if sorted(get_local_files(dcc_file).values()) else 'osdf'
+
+
+def upload_data_files(workflow, dcc_file_objects, threads=8, host_limits=None,
+                      retries=3, backoff=30, callback=None):
     """Transfers the provided iHMP OSDF object to the DCC using the cutlass
-    API and aspera. This task is meant to upload in parallel to the DCC to
-    account for the large amount of files that are present in the IBDMDB 
-    datasets.
+    API and aspera. Objects are uploaded in parallel to the DCC using a 
+    bounded pool of workers to account for the large amount of files that 
+    are present in the IBDMDB datasets.
 
     Args:
         workflow (anadama2.Workflow): The AnADAMA2 workflow object.
         dcc_file_objects (list): A list of OSDF iHMP DCC objects to upload
             to the DCC. Examples include AbundanceMatrix, WgsRawSeqSet,
             Proteome, etc.
+        threads (int): The maximum number of objects to upload at once.
+        host_limits (dict): The maximum number of concurrent uploads 
+            allowed per DCC host ('aspera' or 'osdf'). Any host not 
+            provided falls back to UPLOAD_HOST_LIMITS.
+        retries (int): Number of times a save failing with a transient 
+            error (see TRANSIENT_UPLOAD_ERRORS) is retried.
+        backoff (int): Number of seconds to wait before the first retry; 
+            the wait is doubled for each subsequent retry.
+        callback (function): Invoked with each object as soon as it has 
+            been successfully uploaded.
 
     Requires:
         None
 
     Returns:
         list: A list of the files successfully uploaded.
+
+    Example:
+        from hmp2_workflows.tasks.dcc import upload_data_files
+
+        uploaded_files = upload_data_files(workflow, abund_matrices, 
+                                           threads=4)
     """
-    uploaded_files = []
+    upload_limits = dict(UPLOAD_HOST_LIMITS)
+    upload_limits.update(host_limits or {})
+    host_slots = dict((host, threading.BoundedSemaphore(limit)) for 
+                      (host, limit) in upload_limits.iteritems())
 
-    #def _dcc_upload(task):
     def _dcc_upload(dcc_file):
         """Invokes upload of sequencing product(s) to the DCC
-        making using of Cutlass' aspera transfer functionality.
+        making using of Cutlass' aspera transfer functionality. Saves 
+        failing with a transient error are retried with an exponential 
+        backoff; a save() returning False is reported without retrying.
 
         Args: 
-            task (anadama2.Task): AnADAMA2 Task object.
+            dcc_file (cutlass.*): The iHMP OSDF object to save.
 
         Requires: 
             None
 
         Returns:
-            None
+            tuple: The OSDF object, the number of bytes transferred and any
+                error encountered while saving.
         """
-        if dcc_file.updated:
-            success = dcc_file.save()
-            if not success:
-                raise ValueError('Saving file to DCC failed:', raw_file)
-            else:
-                uploaded_files.append(dcc_file)
+        local_files = sorted(get_local_files(dcc_file).values())
+        upload_bytes = sum(os.path.getsize(local_file) for local_file in 
+                           local_files if os.path.exists(local_file))
+        error = None
 
-    for dcc_file in dcc_file_objects:
-        raw_file = getattr(dcc_file, 'local_file', None) 
+        for attempt in xrange(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
 
-        if not raw_file:
-            raw_file = getattr(dcc_file, 'local_raw_file', None)
-                    
+            with host_slots[_get_upload_host(dcc_file)]:
+                try:
+                    ## A False from save() is a validation or metadata 
+                    ## failure that will not change on a retry.
+                    if not save_osdf_object(dcc_file):
+                        return (dcc_file, upload_bytes, 
+                                'save() returned False')
+
+                    return (dcc_file, upload_bytes, None)
+                except TRANSIENT_UPLOAD_ERRORS as exc:
+                    error = str(exc)
+                except Exception as exc:
+                    return (dcc_file, upload_bytes, str(exc))
+
+        return (dcc_file, upload_bytes, error)
+
+    updated_files = []
+    for dcc_file in dcc_file_objects:
         if dcc_file.updated:
-            print "Uploading file %s to DCC...  " % raw_file, 
-            _dcc_upload(dcc_file)
-            print "COMPLETE"
+            updated_files.append(dcc_file)
         else:
             raw_file = getattr(dcc_file, 'urls', None)
             if not raw_file:
@@ -89,4 +156,123 @@ def upload_data_files(workflow, dcc_file_objects):
             
             print "SKIPPING FILE DUE TO NO CHANGES:", raw_file
 
+    uploaded_files = []
+    failed_files = []
+    total_bytes = 0
+    start_time = time.time()
+
+    pool = ThreadPool(max(1, min(threads, len(updated_files))))
+    try:
+        for (dcc_file, upload_bytes, error) in pool.imap_unordered(_dcc_upload, 
+                                                                   updated_files):
+            local_files = (", ".join(sorted(get_local_files(dcc_file).values())) or
+                           type(dcc_file).__name__)
+            if error:
+                print "FAILED UPLOADING FILE %s TO DCC: %s" % (local_files, error)
+                failed_files.append(local_files)
+            else:
+                print "Uploaded file %s to DCC" % local_files
+                uploaded_files.append(dcc_file)
+
+                if callback:
+                    callback(dcc_file)
+                total_bytes += upload_bytes
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    if updated_files:
+        print ("Uploaded %s of %s objects (%.1f MB) in %.1fs: %.2f MB/s, "
+               "%.2f objects/s" % (len(uploaded_files), len(updated_files),
+                                   total_bytes / 1e6, elapsed,
+                                   total_bytes / 1e6 / elapsed,
+                                   len(uploaded_files) / elapsed))
+
+    if failed_files:
+        raise ValueError('Saving files to DCC failed:', failed_files)
+
     return uploaded_files
+
+
+def apply_upload_plan(workflow, plan_file, threads=8, host_limits=None,
+                      retries=3, backoff=30):
+    """Pushes an upload plan written by hmp2_workflows.utils.dcc.write_upload_plan
+    to the DCC. Plan entries are applied in dependency order; all entries 
+    whose parents have been applied are uploaded together in parallel before 
+    moving on to the next level of the tree. 
+
+    Every successfully applied entry is appended to a progress file 
+    (<plan_file>.applied) so that a failed apply can be resumed without 
+    re-diffing the study; entries already present in the progress file are
+    not pushed again.
+
+    Args:
+        workflow (anadama2.Workflow): The AnADAMA2 workflow object.
+        plan_file (string): Path to the JSON upload plan.
+        threads (int): The maximum number of objects to upload at once.
+        host_limits (dict): The maximum number of concurrent uploads 
+            allowed per DCC host ('aspera' or 'osdf').
+        retries (int): Number of times a save failing with a transient 
+            error (see TRANSIENT_UPLOAD_ERRORS) is retried.
+        backoff (int): Number of seconds to wait before the first retry.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The OSDF ID's of all applied entries keyed on their local key.
+
+    Example:
+        from hmp2_workflows.tasks.dcc import apply_upload_plan
+
+        apply_upload_plan(workflow, '/tmp/ibdmdb_upload.plan.json')
+    """
+    entries = read_upload_plan(plan_file)
+    progress_file = plan_file + '.applied'
+
+    resolved_ids = dict((entry['key'], entry['id']) for entry in entries
+                        if entry['action'] == 'skip')
+    if os.path.exists(progress_file):
+        with open(progress_file) as progress_fh:
+            resolved_ids.update(line.rstrip('\n').split('\t', 1) for 
+                                line in progress_fh if line.strip())
+
+    ## Each entry can only be applied once all the entries it depends on 
+    ## have been so we group entries by their depth in the dependency tree.
+    entry_levels = {}
+    entries_map = dict((entry['key'], entry) for entry in entries)
+
+    def _get_level(key):
+        if key not in entry_levels:
+            depends = entries_map[key].get('depends', []) if key in entries_map else []
+            entry_levels[key] = 1 + max([_get_level(dep) for dep in depends] or [-1])
+        return entry_levels[key]
+
+    levels = {}
+    for entry in entries:
+        if entry['action'] != 'skip' and entry['key'] not in resolved_ids:
+            levels.setdefault(_get_level(entry['key']), []).append(entry)
+
+    with open(progress_file, 'a') as progress_fh:
+        for level in sorted(levels):
+            level_objs = []
+            obj_keys = {}
+
+            for entry in levels[level]:
+                dcc_obj = load_plan_entry(entry, resolved_ids)
+                obj_keys[id(dcc_obj)] = entry['key']
+                level_objs.append(dcc_obj)
+
+            def _record_applied(dcc_obj):
+                key = obj_keys[id(dcc_obj)]
+                resolved_ids[key] = dcc_obj.id
+                progress_fh.write("%s\t%s\n" % (key, dcc_obj.id))
+                progress_fh.flush()
+
+            print "Applying %s planned objects (level %s)" % (len(level_objs), level)
+            upload_data_files(workflow, level_objs, threads=threads,
+                              host_limits=host_limits, retries=retries,
+                              backoff=backoff, callback=_record_applied)
+
+    return resolved_ids
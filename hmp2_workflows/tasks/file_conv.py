@@ -29,13 +29,17 @@ furnished to do so, subject to the following conditions:
 
 import os
 
-import pandas as pd
-
 from itertools import chain
 
 from biobakery_workflows import utilities as bb_utils
 from biobakery_workflows.tasks.sixteen_s import convert_to_biom_from_tsv
 
+from hmp2_workflows.utils import biom_cache
+from hmp2_workflows.utils.files import (convert_excel_to_csv,
+                                        get_sheet_csv_files)
+from hmp2_workflows.utils.metadata_cache import build_metadata_cache
+from hmp2_workflows.utils.misc import relabel_cmmr_otu_table
+
 
 def deinterleave_fastq(workflow, input_files, output_dir, threads=1, compress=True):
     """Deinterleaves a FASTQ file producing paired-end FASTQ reads.
@@ -69,15 +73,13 @@ def deinterleave_fastq(workflow, input_files, output_dir, threads=1, compress=Tr
         # [[foo_R1.fastq.gz, foo_R2.fastq.gz], [bar_R1.fastq.gz, bar_R2.fastq.gz]]
     """
     paired_end_reads = []
-    deinterleave_cmd = "deinterleave_fastq.sh < [depends[0]] [targets[0]] [targets[1]]"
+    deinterleave_cmd = ("split_interleaved_fastq.py -i [depends[0]] -1 [targets[0]] "
+                        "-2 [targets[1]] -t %s" % threads)
 
     out_ext = "fastq"
     if compress:
-        deinterleave_cmd += " " + "compress"
         out_ext = "fastq.gz"
 
-    deinterleave_cmd += " " + str(threads)
-
     mate_1_files = bb_utils.name_files(map(os.path.basename, input_files),
                                         output_dir,
                                         tag="R1",
@@ -103,7 +105,7 @@ def deinterleave_fastq(workflow, input_files, output_dir, threads=1, compress=Tr
 
 
 def bam_to_fastq(workflow, input_files, output_dir, paired_end=False,
-                 compress=True, threads=1):
+                 compress=True, threads=1, stream=False, compress_level=None):
     """Converts BAM sequence files to a single interleaved FASTQ file using
     the samtools bam2fq utility.
 
@@ -116,9 +118,16 @@ def bam_to_fastq(workflow, input_files, output_dir, paired_end=False,
         compress (bool): Compress fastq files generated by samtools. 
         threads (int): The number of threads/cores to use for BAM -> FASTQ 
             conversion.
+        stream (bool): Convert each BAM in a single task by piping the name
+            sorted reads straight into reformat.sh, which splits mates and
+            compresses its output, without writing a sorted BAM or 
+            uncompressed FASTQ files to disk.
+        compress_level (int): The gzip compression level to use. Defaults 
+            to --best, or to the reformat.sh default when streaming.
 
     Requires:
         bedtools 2.17+
+        samtools 1.3+ (streaming mode)
 
     Returns:
         list: A list of the newly-converted FASTQ files.
@@ -134,6 +143,11 @@ def bam_to_fastq(workflow, input_files, output_dir, paired_end=False,
                                    ['/tmp/fooA.bam', '/tmp/fooB.bam'],
                                    '/seq/ibdmdbd/out_dir'])
     """
+    if stream:
+        return _stream_bam_to_fastq(workflow, input_files, output_dir, 
+                                    paired_end, compress, threads, 
+                                    compress_level)
+
     sample_names = bb_utils.sample_names(input_files, '.bam')
     sorted_bams = bb_utils.name_files(sample_names, 
                                       output_dir, 
@@ -190,10 +204,11 @@ def bam_to_fastq(workflow, input_files, output_dir, paired_end=False,
     if compress:
         fastq_files_compress = ["%s.gz" % fastq_file for fastq_file in fastq_files]
 
-        workflow.add_task_group_gridable("pigz --best -p [args[0]] [depends[0]]",
+        pigz_level = "-%s" % compress_level if compress_level else "--best"
+        workflow.add_task_group_gridable("pigz [args[1]] -p [args[0]] [depends[0]]",
                                          depends=fastq_files,
                                          targets=fastq_files_compress,
-                                         args=[threads],
+                                         args=[threads, pigz_level],
                                          cores=threads,
                                          time=10*60,
                                          mem=4098)
@@ -206,18 +221,101 @@ def bam_to_fastq(workflow, input_files, output_dir, paired_end=False,
     return fastq_files
 
 
-def excel_to_csv(workflow, input_files, output_dir):
-    """Converts an Excel file to a CSV file. Only attempts to convert the 
-    first worksheet in the file and ignores the rest.
+def _stream_bam_to_fastq(workflow, input_files, output_dir, paired_end, 
+                         compress, threads, compress_level):
+    """Converts each BAM file to FASTQ in a single gridable task by name 
+    sorting with samtools and streaming the sorted reads through 
+    reformat.sh. Only the final (optionally compressed) FASTQ files are 
+    written to disk; samtools may still spill sort runs to the sort folder
+    if a BAM exceeds the sort memory.
+
+    Args:
+        workflow (anadama2.Workflow): The AnADAMA2 Workflow object.
+        input_files (list): A list containing all BAM files to be converted.
+        output_dir (string): The output directory to write converted files too.
+        paired_end (bool): If True generated paired end files.
+        compress (bool): Write gzip compressed FASTQ files.
+        threads (int): The number of threads/cores to use.
+        compress_level (int): The gzip compression level passed to 
+            reformat.sh.
+
+    Requires:
+        samtools 1.3+
+        BBTools (reformat.sh)
+
+    Returns:
+        list: A list of the newly-converted FASTQ files.
+    """
+    fastq_ext = ".fastq.gz" if compress else ".fastq"
+    sort_dir = os.path.join(output_dir, "sort")
+    fastq_dir = os.path.join(output_dir, "fastq")
+    bb_utils.create_folders([sort_dir, fastq_dir])
+
+    reformat_cmd = ("samtools sort -n -@ [args[0]] -m 1G -T [args[1]] -O sam -o - [depends[0]] | "
+                    "reformat.sh t=[args[0]] in=stdin.sam out=stdout.fq primaryonly | "
+                    "reformat.sh t=[args[0]] in=stdin.fq out1=[targets[0]] ")
+    if paired_end:
+        reformat_cmd += "out2=[targets[1]] "
+    reformat_cmd += "interleaved addslash=t spaceslash=f"
+    if compress_level:
+        reformat_cmd += " zl=%s" % compress_level
+
+    ## Without pipefail a failed sort (full scratch, truncated BAM) would 
+    ## leave short FASTQ files behind a successful exit from reformat.sh.
+    reformat_cmd = "bash -c 'set -o pipefail; %s'" % reformat_cmd
+
+    output_files = []
+    for bam_file in input_files:
+        sample_name = os.path.basename(bam_file)
+        if sample_name.endswith('.bam'):
+            sample_name = sample_name[:-len('.bam')]
+
+        if paired_end:
+            targets = [os.path.join(fastq_dir, sample_name + "_R1" + fastq_ext),
+                       os.path.join(fastq_dir, sample_name + "_R2" + fastq_ext)]
+            output_files.append(tuple(targets))
+        else:
+            targets = [os.path.join(output_dir, sample_name + fastq_ext)]
+            output_files.extend(targets)
+
+        workflow.add_task_gridable(reformat_cmd,
+                                   depends=[bam_file],
+                                   targets=targets,
+                                   args=[threads, os.path.join(sort_dir, sample_name)],
+                                   cores=threads,
+                                   time=30*60,
+                                   mem=4098 + threads*1024)
+
+    if paired_end:
+        output_files = list(chain.from_iterable(output_files))
+
+    return output_files
+
+
+def excel_to_csv(workflow, input_files, output_dir, all_sheets=False,
+                 read_only=False, cache_dir=None):
+    """Converts an Excel file to a CSV file. By default only attempts to 
+    convert the first worksheet in the file and ignores the rest.
 
     Args:
         workflow (anadama2.Workflow): The AnADAMA2 workflow object.
         input_files (list): A list containing all Excel files to be converted.
         output_dir (string): The output directory to write converted CSV files
             too.
+        all_sheets (boolean): Convert every worksheet in each file. The 
+            first worksheet is written to the returned CSV file and the 
+            rest alongside it suffixed with their sheet names. The extra 
+            CSV files are declared as task targets for Excel files that 
+            exist when the workflow is built; those of Excel files created 
+            by an upstream task are written but not tracked.
+        read_only (boolean): Stream rows out of XLSX files with openpyxl's 
+            read-only reader rather than loading them with pandas.
+        cache_dir (string): If provided each converted CSV is also written
+            to the columnar cache in this directory (as read by 
+            add_metadata_to_tsv) so the PCL step does not re-parse it.
 
     Requires:
-        None
+        openpyxl: Required for read_only mode.
 
     Returns:
         list: A list of newly-converted CSV files.
@@ -228,30 +326,52 @@ def excel_to_csv(workflow, input_files, output_dir):
 
     def _convert_excel_csv(task):
         """Helper function passed to AnADAMA2 doing the lifting of converting 
-        the supplied Excel file to a CSV file using the pandas python library.
+        the supplied Excel file to one or more CSV files.
         """                                      
         excel_file = task.depends[0].name
         csv_out_file = task.targets[0].name
 
-        excel_df = pd.read_excel(excel_file)
-        excel_df.to_csv(csv_out_file)
+        csv_files = convert_excel_to_csv(excel_file, csv_out_file, all_sheets,
+                                         read_only)
 
-    workflow.add_task_group(_convert_excel_csv,
-                            depends=input_files,
-                            targets=output_files)                                       
+        if cache_dir:
+            for csv_file in csv_files:
+                build_metadata_cache(csv_file, dtype='str', cache_dir=cache_dir,
+                                     header=None)
+
+    for (input_file, output_file) in zip(input_files, output_files):
+        ## Every worksheet's CSV is a target so AnADAMA2 re-runs the 
+        ## conversion if any of them go missing.
+        sheet_files = [output_file]
+        if all_sheets and os.path.exists(input_file):
+            sheet_files = get_sheet_csv_files(input_file, output_file, read_only)
+
+        workflow.add_task(_convert_excel_csv,
+                          depends=[input_file],
+                          targets=sheet_files)
 
     return output_files                            
 
 
-def batch_convert_tsv_to_biom(workflow, tsv_files): 
+def batch_convert_tsv_to_biom(workflow, tsv_files, batch_size=None,
+                              cache_dir=None): 
     """Batch converts tsv files to the biom format. BIOM files will be 
     deposited in the same folder as source TSV files and will carry the 
     same filenames.
 
+    If a batch size is provided files are converted in-process by tasks 
+    that each handle up to batch_size files, rather than by one biom 
+    process per file. If a cache directory is provided converted files are
+    cached under the md5 hash of their source TSV and re-used whenever a 
+    TSV with the same contents is converted again.
+
     Args:
         workflow (anadama2.Workflow): The workflow object.
         tsv_files (list): A list containing all TSV files to be converted 
             to BIOM format.
+        batch_size (int): The number of files converted by each in-process
+            conversion task.
+        cache_dir (string): Directory housing the BIOM conversion cache.
     
     Requires:
         Biom v2: A tool for general use formatting of biological data.
@@ -282,8 +402,30 @@ def batch_convert_tsv_to_biom(workflow, tsv_files):
     biom_files = [os.path.join(biom_dir, biom_fname) for biom_fname in 
                   bb_utils.name_files(tsv_fnames, biom_dir, extension='biom')]
 
-    for (tsv_file, biom_file) in zip(tsv_files, biom_files):
-        convert_to_biom_from_tsv(workflow, tsv_file, biom_file)
+    if not batch_size and not cache_dir:
+        for (tsv_file, biom_file) in zip(tsv_files, biom_files):
+            convert_to_biom_from_tsv(workflow, tsv_file, biom_file)
+
+        return biom_files
+
+    def _convert_tsv_to_biom(task):
+        """Converts a batch of TSV files to BIOM files in-process, copying 
+        any BIOM files already in the conversion cache.
+        """
+        cache_hits = 0
+        for (tsv_file, biom_file) in zip(task.depends, task.targets):
+            cache_hits += biom_cache.convert_tsv_to_biom(tsv_file.name, 
+                                                         biom_file.name,
+                                                         cache_dir)
+
+        print "Converted %s TSV files to BIOM (%s from cache)" % (len(task.targets),
+                                                                 cache_hits)
+
+    step = batch_size or 1
+    for idx in xrange(0, len(tsv_files), step):
+        workflow.add_task(_convert_tsv_to_biom,
+                          depends=tsv_files[idx:idx+step],
+                          targets=biom_files[idx:idx+step])
 
     return biom_files
 
@@ -303,52 +445,53 @@ def fix_CMMR_OTU_table_taxonomy_labels(workflow, otu_table, output_dir):
     Returns:
         string: The path to the modified OTU table.
     """
-    otu_basename = os.path.splitext(os.path.basename(otu_table))[0]
-    fixed_otu_table = os.path.join(output_dir, otu_basename + "_taxonomy_fix.tsv")
-    tax_level_label = {
-        0: 'k',
-        1: 'p',
-        2: 'c',
-        3: 'o',
-        4: 'f',
-        5: 'g'
-    }
+    return batch_fix_CMMR_OTU_table_taxonomy_labels(workflow, [otu_table], 
+                                                    output_dir)[0]
 
-    def _label_taxonomy_levels(task):
-        """Quick function that attempts to label the taxonomic functions in our OTU
-        table in the format that some of the biobakery viz functions can handle.
-        """
-        fixed_otu_fh = open(fixed_otu_table, 'w')
 
-        with open(otu_table) as otu_fh:
-            for line in otu_fh:
-                if line.startswith('#'):
-                    fixed_otu_fh.write(line)
-                    continue
+def batch_fix_CMMR_OTU_table_taxonomy_labels(workflow, otu_tables, output_dir):
+    """Takes a list of OTU tables generated by CMMR and formats each table 
+    to make sure it can be processed by some of the biobakery 16S viz 
+    functions. All tables are fixed by a single task.
 
-                otu_elts = line.strip().split('\t')
-                taxonomy = otu_elts[-1]
-                new_taxonomy = []
+    Args:
+        workflow (anadama2.Workflow): The workflow object.
+        otu_tables (list): Paths to the CMMR OTU tables
+        output_dir (string): Directory
 
-                for (idx, tax_level) in enumerate(taxonomy.split('; ')):
-                    tax_label = tax_level_label[idx]
+    Requires:
+        None
 
-                    if len(tax_level) == 3:
-                        level_labeled = tax_level[-1::-1]
-                    else:
-                        if "__" in tax_level:
-                            level_labeled = tax_label + tax_level
-                        else:
-                            level_labeled = "%s__%s" % (tax_label, tax_level)
+    Returns:
+        list: The paths to the modified OTU tables; in order.
 
-                    new_taxonomy.append(level_labeled)
+    Example:
+        from anadama2 import Workflow
+        from hmp2_workflows.tasks import file_conv
+
+        workflow = anadama2.Workflow()
 
-                fixed_otu_fh.write('\t'.join(otu_elts[:-1]) + '\t' + '; '.join(new_taxonomy) + '\n')
+        fixed_otu_tables = file_conv.batch_fix_CMMR_OTU_table_taxonomy_labels(workflow,
+                                                                              ['/tmp/run1_OTU_Table.tsv',
+                                                                               '/tmp/run2_OTU_Table.tsv'],
+                                                                              '/tmp/fixed')
+    """
+    fixed_otu_tables = [os.path.join(output_dir, 
+                                     os.path.splitext(os.path.basename(otu_table))[0] + "_taxonomy_fix.tsv")
+                        for otu_table in otu_tables]
+
+    if len(set(fixed_otu_tables)) != len(fixed_otu_tables):
+        raise ValueError('OTU tables must have unique file names', otu_tables)
+
+    def _label_taxonomy_levels(task):
+        """Quick function that attempts to label the taxonomic functions in our OTU
+        tables in the format that some of the biobakery viz functions can handle.
+        """
+        for (otu_table, fixed_otu_table) in zip(task.depends, task.targets):
+            relabel_cmmr_otu_table(otu_table.name, fixed_otu_table.name)
 
-        fixed_otu_fh.close()
-                                
     workflow.add_task(_label_taxonomy_levels,
-                      depends=otu_table,
-                      target= fixed_otu_table)
+                      depends=otu_tables,
+                      targets=fixed_otu_tables)
 
-    return fixed_otu_table
+    return fixed_otu_tables
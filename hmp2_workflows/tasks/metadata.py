@@ -38,6 +38,8 @@ from anadama2.tracked import Container
 
 import hmp2_workflows.utils.metadata as m_utils
 
+from hmp2_workflows.utils.metadata_cache import load_metadata
+
 from biobakery_workflows import utilities as bb_utils
 
 from hmp2_workflows.utils.misc import (get_sample_id_from_fname, 
@@ -251,7 +253,7 @@ def generate_sample_metadata(workflow, data_type, in_files, metadata_file,
         print metadata_files
         ## ['/tmp/metadata/sampleA.csv', '/tmp/metadata/sampleB.csv']
     """
-    metadata_df = pd.read_csv(metadata_file)
+    metadata_df = load_metadata(metadata_file, data_types=[data_type])
     samples = bb_utils.sample_names(in_files)
 
     output_metadata_files = bb_utils.name_files(samples, 
@@ -284,7 +286,8 @@ def generate_sample_metadata(workflow, data_type, in_files, metadata_file,
 def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
                         id_col, col_replace=None, col_offset=-1, 
                         metadata_rows=None, target_cols=None, 
-                        aux_files=None, na_rep=""):
+                        aux_files=None, na_rep="", chunksize=None,
+                        cache_dir=None):
     """Adds metadata to the top of a tab-delimited file. This function is
     meant to be called on analysis files to append relevant metadata to the 
     analysis output found in the file. An example can be seen below:
@@ -325,6 +328,13 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
             analysis files. 
         na_rep (string): String representation for any empty cell in our 
             PCL file. Defaults to an empty string.
+        chunksize (int): If provided the analysis file is streamed through
+            in chunks of this many rows rather than loaded whole; only the 
+            metadata header block is held in memory.
+        cache_dir (string): If provided CSV analysis files are loaded through
+            the columnar cache in this directory (see 
+            hmp2_workflows.utils.metadata_cache), re-using any cache written
+            when the file was created.
 
     Requires:
         None
@@ -349,59 +359,29 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
         print out_files
         ## ['/tmp/metaphlan2.out']
     """
-    metadata_df = pd.read_csv(metadata_file, dtype='str',
-                              parse_dates=['date_of_receipt'])
-    
-    def _workflow_add_metadata_to_tsv(task):
-        analysis_file = task.depends[0].name
-        pcl_out = task.targets[0].name
+    metadata_df = load_metadata(metadata_file, dtype='str',
+                                parse_dates=['date_of_receipt'])
 
-        analysis_df = pd.read_csv(analysis_file, dtype='str', header=None)
-        pcl_metadata_df = None
-        header = True
-            
-        # Going to make the assumption that the next row following our PCL 
-        # metadata rows is the row containing the ID's that we will use to merge
-        # the analysis file with our metadata file and we can use these same 
-        # ID's to merge the PCL metadata rows into the larger metadata file.
-        if metadata_rows:
-            pcl_metadata_df = analysis_df[:metadata_rows+1]
-            header = None
+    def _get_analysis_sep(analysis_file):
+        return ',' if analysis_file.endswith('.csv') else '\t'
 
-            offset_cols = range(0, col_offset+1)
-            pcl_metadata_df.drop(pcl_metadata_df.columns[offset_cols[:-1]], 
-                                    axis=1,
-                                    inplace=True)
+    def _get_metadata_block(sample_ids, pcl_metadata_df, col_name):
+        """Builds the block of metadata rows that sits on top of the 
+        analysis results in our PCL file.
 
-            pcl_metadata_df = pcl_metadata_df.T.reset_index(drop=True).T
-            pcl_metadata_df.xs(metadata_rows)[0] = id_col
-            
-            pcl_metadata_df = pcl_metadata_df.T
-            pcl_metadata_df = reset_column_headers(pcl_metadata_df)
+        Args:
+            sample_ids (list): Sample ID's found in the analysis file.
+            pcl_metadata_df (pandas.DataFrame): Any metadata rows already 
+                present in the analysis file.
+            col_name (string): Header of the column the metadata row names
+                are written to.
 
-            analysis_df.drop(analysis_df.index[range(0,metadata_rows)], inplace=True)
-            analysis_df.rename(columns=analysis_df.iloc[0], inplace=True)
-        else:
-            analysis_df = hmp2_utils.misc.reset_column_headers(analysis_df)
-
-        sample_ids = analysis_df.columns.tolist()[col_offset+1:]
-            
-        if len(sample_ids) == 1:
-            raise ValueError('Could not parse sample ID\'s:', 
-                             sample_ids)
-
-        if col_replace:
-            new_ids = sample_ids
-            for replace_str in col_replace:
-                new_ids = [sid.replace(replace_str, '') if not pd.isnull(sid) 
-                           else sid for sid in new_ids]
-
-            if new_ids != sample_ids:
-                sample_ids_map = dict(zip(sample_ids, new_ids))
-                sample_ids = new_ids
-    
-                analysis_df.rename(columns=sample_ids_map, inplace=True)
+        Requires:
+            None
 
+        Returns:
+            pandas.DataFrame: The metadata rows with one column per sample.
+        """
         subset_metadata_df = metadata_df[(metadata_df.data_type == dtype) &
                                          (metadata_df[id_col].isin(sample_ids))]
 
@@ -433,25 +413,103 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
                     subset_metadata_df.update(aux_metadata_existing_df)
                     subset_metadata_df.reset_index(inplace=True)
 
-        if not pcl_metadata_df.empty:
+        if pcl_metadata_df is not None and not pcl_metadata_df.empty:
             subset_metadata_df = pd.merge(subset_metadata_df, pcl_metadata_df,
                                           how='left', on=id_col)
 
         if target_cols:
-            target_cols.insert(0, id_col)
-            subset_metadata_df = subset_metadata_df.filter(target_cols)
+            subset_metadata_df = subset_metadata_df.filter([id_col] + target_cols)
 
         subset_metadata_df = subset_metadata_df.T
         subset_metadata_df = reset_column_headers(subset_metadata_df)
         subset_metadata_df = subset_metadata_df.reset_index()
         subset_metadata_df.fillna('NA', inplace=True)
 
-        _col_offset = col_offset-1 if col_offset != -1 else col_offset
-        col_name = analysis_df.columns[_col_offset+1]
-
         col_name = '' if col_name == "index" else col_name
         subset_metadata_df.rename(columns={'index': col_name}, inplace=True)
 
+        return subset_metadata_df
+
+    def _parse_analysis_header(analysis_df):
+        """Splits the top of an analysis file into any existing PCL metadata
+        rows and the row of sample ID's, applying any column replacements.
+
+        Args:
+            analysis_df (pandas.DataFrame): The analysis file, or at least
+                its first metadata_rows+1 rows, read without a header.
+
+        Requires:
+            None
+
+        Returns:
+            tuple: The existing PCL metadata rows (or None), the analysis 
+                file column headers and the sample ID's they contain.
+        """
+        pcl_metadata_df = None
+
+        # Going to make the assumption that the next row following our PCL 
+        # metadata rows is the row containing the ID's that we will use to merge
+        # the analysis file with our metadata file and we can use these same 
+        # ID's to merge the PCL metadata rows into the larger metadata file.
+        if metadata_rows:
+            pcl_metadata_df = analysis_df[:metadata_rows+1].copy()
+
+            offset_cols = range(0, col_offset+1)
+            pcl_metadata_df.drop(pcl_metadata_df.columns[offset_cols[:-1]], 
+                                    axis=1,
+                                    inplace=True)
+
+            pcl_metadata_df = pcl_metadata_df.T.reset_index(drop=True).T
+            pcl_metadata_df.xs(metadata_rows)[0] = id_col
+            
+            pcl_metadata_df = pcl_metadata_df.T
+            pcl_metadata_df = reset_column_headers(pcl_metadata_df)
+
+        columns = analysis_df.iloc[metadata_rows or 0].tolist()
+        sample_ids = columns[col_offset+1:]
+            
+        if len(sample_ids) == 1:
+            raise ValueError('Could not parse sample ID\'s:', 
+                             sample_ids)
+
+        if col_replace:
+            new_ids = sample_ids
+            for replace_str in col_replace:
+                new_ids = [sid.replace(replace_str, '') if not pd.isnull(sid) 
+                           else sid for sid in new_ids]
+
+            if new_ids != sample_ids:
+                sample_ids_map = dict(zip(sample_ids, new_ids))
+                sample_ids = new_ids
+                columns = [sample_ids_map.get(col, col) for col in columns]
+
+        return (pcl_metadata_df, columns, sample_ids)
+
+    def _workflow_add_metadata_to_tsv(task):
+        analysis_file = task.depends[0].name
+        pcl_out = task.targets[0].name
+
+        sep = _get_analysis_sep(analysis_file)
+        if cache_dir and sep == ',':
+            analysis_df = load_metadata(analysis_file, dtype='str', header=None,
+                                        cache_dir=cache_dir)
+        else:
+            analysis_df = pd.read_csv(analysis_file, dtype='str', header=None,
+                                      sep=sep)
+        (pcl_metadata_df, columns, sample_ids) = _parse_analysis_header(analysis_df)
+        header = None if metadata_rows else True
+
+        if metadata_rows:
+            analysis_df.drop(analysis_df.index[range(0,metadata_rows)], inplace=True)
+            analysis_df.columns = columns
+        else:
+            analysis_df.columns = columns
+            analysis_df.drop(analysis_df.index[0], inplace=True)
+
+        _col_offset = col_offset-1 if col_offset != -1 else col_offset
+        subset_metadata_df = _get_metadata_block(sample_ids, pcl_metadata_df,
+                                                 analysis_df.columns[_col_offset+1])
+
         analysis_df.index = analysis_df.index + len(subset_metadata_df.index)
 
         analysis_metadata_df = pd.concat([subset_metadata_df,
@@ -463,6 +521,45 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
                                     sep='\t',
                                     na_rep=na_rep)
 
+    def _workflow_stream_metadata_to_tsv(task):
+        """Streaming variant of _workflow_add_metadata_to_tsv; the metadata 
+        header block is built from the top of the analysis file and the 
+        remainder of the file is copied through chunksize rows at a time.
+        """
+        analysis_file = task.depends[0].name
+        pcl_out = task.targets[0].name
+        sep = _get_analysis_sep(analysis_file)
+
+        header_df = pd.read_csv(analysis_file, dtype='str', header=None, sep=sep,
+                                nrows=(metadata_rows or 0) + 1)
+        (pcl_metadata_df, columns, sample_ids) = _parse_analysis_header(header_df)
+
+        _col_offset = col_offset-1 if col_offset != -1 else col_offset
+        subset_metadata_df = _get_metadata_block(sample_ids, pcl_metadata_df,
+                                                 columns[_col_offset+1])
+        subset_metadata_df = subset_metadata_df.reindex(columns=columns)
+
+        with open(pcl_out, 'w') as pcl_fh:
+            ## Without existing PCL metadata the sample ID's head the file, 
+            ## otherwise they follow the metadata block as in the input.
+            if not metadata_rows:
+                pd.DataFrame([columns]).to_csv(pcl_fh, index=False, header=False,
+                                               sep='\t', na_rep=na_rep)
+
+            subset_metadata_df.to_csv(pcl_fh, index=False, header=False, 
+                                      sep='\t', na_rep=na_rep)
+
+            if metadata_rows:
+                header_df.iloc[[metadata_rows]].to_csv(pcl_fh, index=False, header=False,
+                                                       sep='\t', na_rep=na_rep)
+
+            for analysis_chunk in pd.read_csv(analysis_file, dtype='str', 
+                                              header=None, sep=sep, 
+                                              skiprows=(metadata_rows or 0) + 1,
+                                              chunksize=chunksize):
+                analysis_chunk.to_csv(pcl_fh, index=False, header=False,
+                                      sep='\t', na_rep=na_rep)
+
     output_folder = os.path.dirname(analysis_files[0])
     pcl_files = bb_utils.name_files(analysis_files, 
                                     output_folder, 
@@ -470,14 +567,23 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
 
     # Because of how YAML inherits lists we'll need to see if we can't 
     # flatten this list out. 
-    target_cols = funcy.flatten(target_cols)
-
-    workflow.add_task_group(_workflow_add_metadata_to_tsv,
-                            depends=analysis_files,
-                            targets=pcl_files,
-                            time="1*60 if ( file_size('depends[0]]') < 1 else 2*60",
-                            mem="4*1024 if ( file_size('depends[0]]') < 1 else 3*12*1024" ,
-                            cores=1,
-                            name="Generate analysis PCL output file")
+    target_cols = list(funcy.flatten(target_cols)) if target_cols else None
+
+    if chunksize:
+        workflow.add_task_group(_workflow_stream_metadata_to_tsv,
+                                depends=analysis_files,
+                                targets=pcl_files,
+                                time="1*60 if ( file_size('depends[0]]') < 1 else 2*60",
+                                mem="4*1024",
+                                cores=1,
+                                name="Generate analysis PCL output file")
+    else:
+        workflow.add_task_group(_workflow_add_metadata_to_tsv,
+                                depends=analysis_files,
+                                targets=pcl_files,
+                                time="1*60 if ( file_size('depends[0]]') < 1 else 2*60",
+                                mem="4*1024 if ( file_size('depends[0]]') < 1 else 3*12*1024" ,
+                                cores=1,
+                                name="Generate analysis PCL output file")
 
     return pcl_files
\ No newline at end of file
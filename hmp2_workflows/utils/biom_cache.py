@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.biom_cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+In-process conversion of TSV profiles (i.e. MetaPhlAn2 taxonomic profiles)
+to BIOM files backed by a content-addressed cache. Converted BIOM files are
+stored in the cache under the md5 hash of their source TSV so that a
+profile whose contents have not changed is never converted twice.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import os
+import shutil
+import tempfile
+
+from hmp2_workflows.utils.checksums import compute_md5
+
+
+def write_biom_from_tsv(tsv_file, biom_file, table_type='Taxon table'):
+    """Converts a TSV profile to a JSON BIOM file in-process. The header
+    line of MetaPhlAn2 profiles (#SampleID) is used as the observation
+    header.
+
+    Args:
+        tsv_file (string): Path to the TSV profile.
+        biom_file (string): Path to the BIOM file to write.
+        table_type (string): The BIOM table type.
+
+    Requires:
+        biom-format v2: A tool for general use formatting of biological data.
+
+    Returns:
+        string: Path to the BIOM file.
+
+    Example:
+        from hmp2_workflows.utils import biom_cache
+
+        biom_cache.write_biom_from_tsv('/tmp/foo_taxonomic_profile.tsv',
+                                       '/tmp/foo_taxonomic_profile.biom')
+    """
+    from biom import Table
+
+    with open(tsv_file) as tsv_fh:
+        table = Table.from_tsv(tsv_fh, None, None, lambda x: x)
+    table.type = table_type
+
+    tmp_biom_file = biom_file + '.tmp'
+    with open(tmp_biom_file, 'w') as biom_fh:
+        biom_fh.write(table.to_json('hmp2_workflows'))
+    os.rename(tmp_biom_file, biom_file)
+
+    return biom_file
+
+
+def convert_tsv_to_biom(tsv_file, biom_file, cache_dir=None):
+    """Converts a TSV profile to a BIOM file re-using a previously converted
+    BIOM file from the cache if the TSV's contents are unchanged.
+
+    Args:
+        tsv_file (string): Path to the TSV profile.
+        biom_file (string): Path to the BIOM file to write.
+        cache_dir (string): Directory housing the conversion cache. No
+            caching is done if not provided.
+
+    Requires:
+        biom-format v2: A tool for general use formatting of biological data.
+
+    Returns:
+        boolean: True if the BIOM file was copied from the cache.
+
+    Example:
+        from hmp2_workflows.utils import biom_cache
+
+        biom_cache.convert_tsv_to_biom('/tmp/foo_taxonomic_profile.tsv',
+                                       '/tmp/biom/foo_taxonomic_profile.biom',
+                                       '/tmp/biom_cache')
+    """
+    if not cache_dir:
+        write_biom_from_tsv(tsv_file, biom_file)
+        return False
+
+    cached_biom = os.path.join(cache_dir, "%s.biom" % compute_md5(tsv_file))
+
+    cache_hit = os.path.exists(cached_biom)
+    if not cache_hit:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        (tmp_fd, tmp_biom) = tempfile.mkstemp(suffix='.biom', dir=cache_dir)
+        os.close(tmp_fd)
+        write_biom_from_tsv(tsv_file, tmp_biom)
+        os.rename(tmp_biom, cached_biom)
+
+    shutil.copyfile(cached_biom, biom_file)
+
+    return cache_hit
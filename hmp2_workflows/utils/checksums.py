@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.checksums
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Functions used to compute and verify MD5 checksums of HMP2 data files
+in-process. Files are hashed in a local thread pool and hashes can be cached
+on disk keyed on each file's inode, size and mtime so that unchanged files
+are never re-hashed when a workflow is re-run. Files can also be hashed as
+they are copied so that staging and checksumming take a single pass.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from multiprocessing.pool import ThreadPool
+
+
+## Files are read in large blocks; hashlib releases the GIL while hashing
+## blocks of this size so threads hash files in parallel.
+BLOCK_SIZE = 8 * 1024 * 1024
+
+REPORT_FIELDS = ['file', 'expected_md5', 'observed_md5', 'status']
+
+
+def get_file_key(file_path):
+    """Returns the key a file's checksum is cached under.
+
+    Args:
+        file_path (string): Path to the file.
+
+    Requires:
+        None
+
+    Returns:
+        string: A key built from the file's inode, size and mtime.
+    """
+    file_stat = os.stat(file_path)
+    return "%s:%s:%r" % (file_stat.st_ino, file_stat.st_size,
+                         file_stat.st_mtime)
+
+
+def compute_md5(file_path, block_size=BLOCK_SIZE):
+    """Computes the MD5 checksum of the provided file.
+
+    Args:
+        file_path (string): Path to the file.
+        block_size (int): Number of bytes read at a time.
+
+    Requires:
+        None
+
+    Returns:
+        string: The MD5 hexdigest of the file.
+
+    Example:
+        from hmp2_workflows.utils import checksums
+
+        md5sum = checksums.compute_md5('/tmp/foo.bam')
+    """
+    md5 = hashlib.md5()
+
+    with open(file_path, 'rb') as in_fh:
+        for block in iter(lambda: in_fh.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def copy_and_hash_file(input_file, target_file, block_size=BLOCK_SIZE):
+    """Copies the provided file to the target path computing its MD5 
+    checksum from the same bytes as they are written, so the file is only
+    read once. The copy is written to a temporary file that is moved into
+    place once complete and the source file's permissions and timestamps 
+    are preserved.
+
+    Args:
+        input_file (string): Path to the file to copy.
+        target_file (string): Path the file should be copied to.
+        block_size (int): Number of bytes read at a time.
+
+    Requires:
+        None
+
+    Returns:
+        string: The MD5 hexdigest of the copied file.
+
+    Example:
+        from hmp2_workflows.utils import checksums
+
+        md5sum = checksums.copy_and_hash_file('/tmp/a/foo.bam',
+                                              '/tmp/b/foo.bam')
+    """
+    md5 = hashlib.md5()
+    tmp_target_file = target_file + '.tmp'
+
+    with open(input_file, 'rb') as in_fh, open(tmp_target_file, 'wb') as out_fh:
+        for block in iter(lambda: in_fh.read(block_size), b''):
+            md5.update(block)
+            out_fh.write(block)
+
+    shutil.copystat(input_file, tmp_target_file)
+
+    if os.path.lexists(target_file):
+        os.remove(target_file)
+    os.rename(tmp_target_file, target_file)
+
+    return md5.hexdigest()
+
+
+def write_md5_sidecar(target_file, md5sum):
+    """Writes the supplied checksum to a <FILE>.md5 file alongside the
+    provided file in the format expected by 
+    hmp2_workflows.utils.misc.create_merged_md5sum_file
+
+    Args:
+        target_file (string): Path to the file the checksum belongs to.
+        md5sum (string): The MD5 checksum of the file.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the checksum file.
+    """
+    md5_file = target_file + '.md5'
+
+    with open(md5_file, 'w') as md5_fh:
+        md5_fh.write(md5sum + "\n")
+
+    return md5_file
+
+
+def load_checksum_cache(cache_file):
+    """Loads a cache of previously computed checksums.
+
+    Args:
+        cache_file (string): Path to the JSON checksum cache.
+
+    Requires:
+        None
+
+    Returns:
+        dict: Checksums keyed on the value returned by get_file_key.
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+
+    with open(cache_file) as cache_fh:
+        return json.load(cache_fh)
+
+
+def save_checksum_cache(checksum_cache, cache_file):
+    """Writes the supplied checksum cache to disk.
+
+    Args:
+        checksum_cache (dict): Checksums keyed on file key.
+        cache_file (string): Path to the JSON checksum cache.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    tmp_cache_file = cache_file + '.tmp'
+    with open(tmp_cache_file, 'w') as cache_fh:
+        json.dump(checksum_cache, cache_fh)
+
+    os.rename(tmp_cache_file, cache_file)
+
+
+def compute_md5_checksums(input_files, threads=4, cache_file=None):
+    """Computes MD5 checksums for the supplied files in a pool of threads.
+    If a cache file is provided any file whose inode, size and mtime match
+    a cached entry is not re-hashed and the cache is updated with any newly
+    computed checksums.
+
+    Args:
+        input_files (list): Files to hash.
+        threads (int): Number of files hashed in parallel.
+        cache_file (string): Optional path to a JSON checksum cache.
+
+    Requires:
+        None
+
+    Returns:
+        dict: MD5 checksums keyed on file path.
+
+    Example:
+        from hmp2_workflows.utils import checksums
+
+        md5sums = checksums.compute_md5_checksums(['/tmp/fooA.bam',
+                                                   '/tmp/fooB.bam'],
+                                                  threads=8)
+    """
+    checksum_cache = load_checksum_cache(cache_file)
+    file_keys = dict((input_file, get_file_key(input_file)) for input_file
+                     in input_files)
+
+    md5sums = {}
+    files_to_hash = []
+    for input_file in input_files:
+        cached_md5 = checksum_cache.get(file_keys[input_file])
+
+        if cached_md5:
+            md5sums[input_file] = cached_md5
+        else:
+            files_to_hash.append(input_file)
+
+    if files_to_hash:
+        pool = ThreadPool(max(1, min(threads, len(files_to_hash))))
+        try:
+            hashes = pool.map(compute_md5, files_to_hash)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (input_file, md5sum) in zip(files_to_hash, hashes):
+            md5sums[input_file] = md5sum
+            checksum_cache[file_keys[input_file]] = md5sum
+
+        if cache_file:
+            save_checksum_cache(checksum_cache, cache_file)
+
+    return md5sums
+
+
+def verify_md5_checksums(input_files, checksums_dict, threads=4,
+                         cache_file=None):
+    """Verifies the supplied files against their expected MD5 checksums.
+
+    Args:
+        input_files (list): Files to verify.
+        checksums_dict (dict): Expected checksums keyed on file basename as
+            returned by hmp2_workflows.utils.misc.parse_checksums_file
+        threads (int): Number of files hashed in parallel.
+        cache_file (string): Optional path to a JSON checksum cache.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of (file, expected_md5, observed_md5, status) tuples
+            where status is one of OK or FAILED.
+
+    Example:
+        from hmp2_workflows.utils import checksums
+        from hmp2_workflows.utils import misc
+
+        expected = misc.parse_checksums_file('/tmp/foo_checksums.txt')
+        results = checksums.verify_md5_checksums(['/tmp/fooA.bam'],
+                                                 expected)
+    """
+    md5sums = compute_md5_checksums(input_files, threads, cache_file)
+
+    results = []
+    for input_file in input_files:
+        expected_md5 = checksums_dict.get(os.path.basename(input_file))
+        observed_md5 = md5sums[input_file]
+        status = 'OK' if expected_md5 == observed_md5 else 'FAILED'
+        results.append((input_file, expected_md5, observed_md5, status))
+
+    return results
+
+
+def write_verification_report(results, report_file):
+    """Writes the results of verify_md5_checksums to a tab-delimited
+    report.
+
+    Args:
+        results (list): Results returned by verify_md5_checksums.
+        report_file (string): Path to the report file.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the report file.
+    """
+    with open(report_file, 'w') as report_fh:
+        report_fh.write("\t".join(REPORT_FIELDS) + "\n")
+
+        for result in results:
+            report_fh.write("\t".join(str(field) for field in result) + "\n")
+
+    return report_file
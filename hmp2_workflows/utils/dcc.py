@@ -29,11 +29,15 @@ furnished to do so, subject to the following conditions:
 """
 
 
+import collections
+import datetime
 import importlib
 import itertools
+import json
 import operator
 import os
 import tempfile
+import threading
 
 import cutlass
 import numpy as np
@@ -43,6 +47,53 @@ from cutlass.mixs import MIXS
 from cutlass.mims import MIMS
 from cutlass.mimarks import MIMARKS
 
+from hmp2_workflows.utils import dcc_cache
+from hmp2_workflows.utils import dcc_journal
+from hmp2_workflows.utils import dcc_ledger
+from hmp2_workflows.utils import sample_ids
+
+
+## Node types returned by WgsDnaPrep.child_seq_sets() and 
+## HostSeqPrep.derivations() respectively.
+WGS_SEQ_SET_NODE_TYPES = ['wgs_raw_seq_set', 'wgs_raw_seq_set_private', 
+                          'microb_transcriptomics_raw_seq_set']
+HOST_SEQ_SET_NODE_TYPES = ['host_wgs_raw_seq_set', 
+                           'host_transcriptomics_raw_seq_set',
+                           'host_epigenetics_raw_seq_set']
+
+## cutlass object attributes that can point at a local file to be pushed
+## to the DCC via aspera.
+LOCAL_FILE_FIELDS = ['local_file', 'local_raw_file', 'local_peak_file',
+                     'local_result_file', 'local_other_file']
+
+## Objects created while building an upload plan are given a placeholder ID 
+## of this prefix plus their local key so that children can link to them.
+PLAN_ID_PREFIX = 'plan:'
+
+## Local mirror of the OSDF study subtree (see set_osdf_cache). When set all
+## parent -> child lookups are answered from the mirror instead of OSDF.
+_osdf_cache = None
+
+## Ledger of files already pushed to the DCC (see set_upload_ledger). When
+## set unchanged files are skipped without fetching their DCC object.
+_upload_ledger = None
+
+## Append-only journal of completed metadata rows (see set_upload_journal) 
+## and the records it held when the run started.
+_upload_journal = None
+_journal_records = {}
+
+## Nodes pulled in bulk by prefetch_osdf_nodes keyed on node type and then
+## on the ID of every node they are linked too. Saves made from the upload
+## pool update the index so all access to it is guarded by a lock.
+_prefetched_nodes = {}
+_prefetch_lock = threading.RLock()
+
+## Upload plan being built (see start_upload_plan). When set saves are 
+## recorded in the plan rather than pushed to OSDF.
+_upload_plan = None
+_plan_diffs = {}
+
 
 def _convert(value, type_):
     """Casts the provided value to the specified type.
@@ -173,8 +224,6 @@ def create_seq_fname_map(data_type, data_files, tags=[]):
             file name) and values consisting of paths to the corresponding 
             data file.
     """
-    sample_id_map = {}
-
     ## We're going to make a bit of a dangerous assumption here. Currently we
     ## are seeing samples being named two ways:
     ##
@@ -186,49 +235,23 @@ def create_seq_fname_map(data_type, data_files, tags=[]):
     ## may not have hyphens or underscores separating it. The Broad samples 
     ## are also prefixed by the originating center represented by one 
     ## one character in front of our 'SM' prefix.
-    for file_type in data_files:
-        for data_file in data_files[file_type]:
-            type_tag = None
-
-            ## With proteomics datasets we sometimes get 'pool' files that 
-            ## can be ignored for the time being.
-            if 'pool' in data_file:
-                continue
-
-            (file_name, ext) = os.path.basename(data_file).split(os.extsep, 1)
-
-            for tag in tags:
-                if tag in file_name:
-                    file_name = file_name.replace("_" + tag, '')
-                    type_tag = tag if data_type == "MBX" else None
-    
-            if data_type == 'MPX':
-                sample_id = "%s-%s" % ('SM', 
-                                       file_name.replace('_', '-').split('-')[2])
-            elif data_type == 'MBX':
-                sample_id = "SM-" + file_name.rsplit('SM-', 1)[-1][:5]
-                
-                # MBX data is a bit tricky in that we have multiple sets of inputs and outputs
-                # so we need to take care of this in a bit of a unique way. Should figure out a 
-                # way to do this a bit cleaner for all data types
-            else:
-                sample_id = file_name
-                
-                ## TODO: This shouldn't be hardcoded
-                sample_id = (sample_id.replace('_taxonomic_profile', '')
-                                      .replace('_pathabundance', '')
-                                      .replace('_genefamilies', ''))
-        
-            
-
-            if type_tag:
-                sample_id_map.setdefault(sample_id, {}).setdefault(file_type + "_" + type_tag, [])
-                sample_id_map[sample_id][file_type + "_" + type_tag].append(data_file)
-            else: 
-                sample_id_map.setdefault(sample_id, {}).setdefault(file_type, [])
-                sample_id_map[sample_id][file_type].append(data_file)
-
-    return sample_id_map
+    ##
+    ## The rules for each of these live in hmp2_workflows.utils.sample_ids
+    ## and are applied over all files at once.
+    ##
+    ## With proteomics datasets we sometimes get 'pool' files that 
+    ## can be ignored for the time being.
+    data_files = dict((file_type, [data_file for data_file in data_files[file_type]
+                                   if 'pool' not in data_file])
+                      for file_type in data_files)
+
+    ## MBX data is a bit tricky in that we have multiple sets of inputs and 
+    ## outputs so file types are suffixed with any tag found in the file name.
+    extractor = sample_ids.DATA_TYPE_EXTRACTORS.get(data_type, 'analysis_output')
+    id_table = sample_ids.build_sample_id_table(data_files, extractor, tags,
+                                                keep_tags=(data_type == "MBX"))
+
+    return sample_ids.sample_id_table_to_map(id_table)
     
 
 def create_output_file_map(data_type, output_files, tags=[]):
@@ -248,35 +271,19 @@ def create_output_file_map(data_type, output_files, tags=[]):
     Returns: 
         dict: A dictionary containing output files grouped by an identifier
     """
-    output_map = {}       
-    
-    for output_type in output_files:
-        for output_file in output_files.get(output_type):
-            type_tag = None
-            basename = os.path.splitext(os.path.basename(output_file.replace('.gz', '')))[0]
-              
-            for tag in tags:
-                if tag in basename:
-                    file_name = basename.replace("_" + tag, '')
-                    type_tag = tag if data_type =="MBX" else None
-
-            ## We are assuming here that our basename split on '_' is going to 
-            ## provide us with our sample name.
-            sample_id = basename.split('_', 1)[0]
-
-            if "_TR" in basename:
-                sample_id += "_TR"
-            elif "_P" in basename:
-                sample_id += "_P"
-
-            if type_tag:
-                output_map.setdefault(sample_id, {}).setdefault(output_type + "_" + type_tag, [])
-                output_map[sample_id][output_type + "_" + type_tag].append(output_file)
-            else:
-                output_map.setdefault(sample_id, {}).setdefault(output_type, [])
-                output_map[sample_id][output_type].append(output_file)
-    
-    return output_map
+    ## We are assuming here that our basename split on '_' is going to 
+    ## provide us with our sample name.
+    id_table = sample_ids.build_sample_id_table(output_files, 'output_prefix', 
+                                                tags, keep_tags=(data_type == "MBX"),
+                                                strip_tags=False, strip_ext='last')
+
+    if not id_table.empty:
+        tr_mask = id_table['file_name'].str.contains('_TR', regex=False)
+        p_mask = ~tr_mask & id_table['file_name'].str.contains('_P', regex=False)
+        id_table.loc[tr_mask, 'sample_id'] += "_TR"
+        id_table.loc[p_mask, 'sample_id'] += "_P"
+
+    return sample_ids.sample_id_table_to_map(id_table)
 
 
 def map_sample_id_to_file(row, id_col, fname_map, is_proteomics):
@@ -381,8 +388,643 @@ def get_fields_to_update(new_metadata, osdf_object):
 
     updated_fields.extend([key for key in required_fields
                            if new_metadata.get(key) != getattr(osdf_object, key)])
+    updated_fields = np.unique(updated_fields).tolist()
+
+    if _upload_plan is not None:
+        _record_plan_diff(osdf_object, updated_fields)
+
+    return updated_fields
+
+
+def set_osdf_cache(cache):
+    """Sets the local OSDF mirror used to answer parent -> child lookups
+    and kept up to date as objects are saved. Passing None reverts to
+    querying OSDF directly.
+
+    Args:
+        cache (sqlite3.Connection): Connection to a local OSDF mirror
+            populated by hmp2_workflows.utils.dcc_cache.load_study_subtree
+
+    Requires:
+        None
+
+    Returns:
+        None
+
+    Example:
+        from hmp2_workflows.utils import dcc
+        from hmp2_workflows.utils import dcc_cache
+
+        cache = dcc_cache.open_osdf_cache('/tmp/ibdmdb_osdf.sqlite')
+        dcc_cache.load_study_subtree(cache, session, study.id)
+        dcc.set_osdf_cache(cache)
+    """
+    global _osdf_cache
+    _osdf_cache = cache
+
+
+def get_osdf_children(osdf_obj, node_types, live_lookup):
+    """Returns the children of the provided OSDF object. If a local OSDF 
+    mirror is in use the children are pulled from it otherwise the supplied
+    live lookup is invoked.
+
+    Args:
+        osdf_obj (cutlass.*): The parent OSDF object.
+        node_types (list): The node types of the children to return.
+        live_lookup (function): A function that retrieves the children 
+            directly from OSDF (i.e. sample.wgsDnaPreps)
+
+    Requires:
+        None
+
+    Returns:
+        iterator: The children connected to the supplied OSDF object.
+    """
+    ## An unsaved object cannot have anything linked to it yet.
+    if not osdf_obj.id or osdf_obj.id.startswith(PLAN_ID_PREFIX):
+        return []
+
+    if _osdf_cache is None:
+        return live_lookup()
+
+    return dcc_cache.get_cached_objects(_osdf_cache, osdf_obj.id, node_types)
+
+
+def save_osdf_object(osdf_obj):
+    """Saves the provided OSDF object and mirrors the saved object in the 
+    local OSDF mirror if one is in use. If an upload plan is being built 
+    the object is added to the plan instead of being saved.
+
+    Args:
+        osdf_obj (cutlass.*): The OSDF object to save.
+
+    Requires:
+        None
+
+    Returns:
+        boolean: True if the object was saved successfully.
+    """
+    if _upload_plan is not None:
+        _add_plan_entry(osdf_obj)
+        return True
+
+    success = osdf_obj.save()
+
+    if success and _osdf_cache is not None:
+        dcc_cache.cache_osdf_object(_osdf_cache, osdf_obj)
+
+    if success and _prefetched_nodes:
+        _index_prefetched_doc(_get_osdf_doc(osdf_obj))
+
+    if success and _upload_ledger is not None:
+        local_files = get_local_files(osdf_obj)
+        local_file = local_files.get('local_file', local_files.get('local_raw_file'))
+        checksums = getattr(osdf_obj, 'checksums', None) or {}
+
+        if local_file:
+            _record_ledger_upload(osdf_obj, local_file, checksums.get('md5'))
+
+    return success
+
+
+def set_upload_journal(journal_file):
+    """Loads the records of any previous run from the provided upload 
+    journal and opens it so that work completed by this run (see 
+    record_journal_entry) is appended to it. Passing None disables the 
+    journal.
+
+    Args:
+        journal_file (string): Path to the upload journal.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The records present in the journal at the start of this run.
+
+    Example:
+        from hmp2_workflows.utils import dcc
+
+        dcc.set_upload_journal('/tmp/ibdmdb_upload.journal')
+    """
+    global _upload_journal, _journal_records
+
+    if _upload_journal is not None:
+        _upload_journal.close()
+
+    _upload_journal = None
+    _journal_records = {}
+
+    if journal_file:
+        _journal_records = dcc_journal.read_upload_journal(journal_file)
+        _upload_journal = dcc_journal.open_upload_journal(journal_file)
+
+    return _journal_records
+
+
+def is_journaled(node_type, key, checksum=None):
+    """Checks whether the provided unit of work was completed by a previous
+    run according to the upload journal.
+
+    Args:
+        node_type (string): The OSDF node type (or other unit of work).
+        key (string): The local key identifying the work.
+        checksum (string): If provided the journaled checksum must also 
+            match for the work to be considered complete.
+
+    Requires:
+        None
+
+    Returns:
+        boolean: True if the work was journaled as complete.
+    """
+    record = _journal_records.get((node_type, key))
+
+    if not record:
+        return False
+
+    return checksum is None or record.get('checksum') == checksum
+
+
+def record_journal_entry(node_type, key, dcc_id=None, checksum=None):
+    """Appends a record of completed work to the upload journal. No 
+    records are written when no journal is set or when building an upload
+    plan.
+
+    Args:
+        node_type (string): The OSDF node type (or other unit of work).
+        key (string): The local key identifying the work.
+        dcc_id (string): The DCC ID of the saved object if any.
+        checksum (string): Checksum of the local data the work covered.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    if _upload_journal is None or _upload_plan is not None:
+        return
+
+    record = dcc_journal.append_journal_record(_upload_journal, node_type, 
+                                               key, dcc_id, checksum)
+    _journal_records[(node_type, key)] = record
+
+
+def _get_osdf_doc(osdf_obj):
+    """Returns the OSDF document representation of the provided object.
+
+    Args:
+        osdf_obj (cutlass.*): A saved OSDF object.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The OSDF document for the object.
+    """
+    doc = json.loads(osdf_obj.to_json())
+    doc['id'] = osdf_obj.id
+
+    return doc
+
+
+def set_upload_ledger(ledger):
+    """Sets the upload ledger consulted before any file-bearing OSDF object
+    is fetched from the DCC. Files whose path, mtime, size and checksum 
+    match the ledger are assumed to be unchanged in the DCC and are skipped
+    without a round trip. Passing None disables the ledger.
+
+    Args:
+        ledger (sqlite3.Connection): Connection to an upload ledger opened
+            with hmp2_workflows.utils.dcc_ledger.open_upload_ledger
+
+    Requires:
+        None
+
+    Returns:
+        None
+
+    Example:
+        from hmp2_workflows.utils import dcc
+        from hmp2_workflows.utils import dcc_ledger
+
+        dcc.set_upload_ledger(dcc_ledger.open_upload_ledger('/tmp/uploads.sqlite'))
+    """
+    global _upload_ledger
+    _upload_ledger = ledger
+
+
+def _get_ledger_object(local_file, md5sum):
+    """Checks the upload ledger for an unchanged copy of the provided file
+    and if found returns the OSDF object it was pushed with. The object 
+    stands in for the one that would otherwise be fetched from the DCC; 
+    callers still diff their metadata against it so metadata changes to an
+    unchanged file are pushed.
+
+    Args:
+        local_file (string): Path to the local file.
+        md5sum (string): The current md5 checksum of the file.
+
+    Requires:
+        None
+
+    Returns:
+        cutlass.*: The OSDF object the file was pushed with or None if the 
+            file is new or has changed.
+    """
+    if _upload_ledger is None or not md5sum:
+        return None
+
+    doc = dcc_ledger.lookup_upload(_upload_ledger, local_file, md5sum)
+    if not doc:
+        return None
+
+    osdf_obj = dcc_cache.load_osdf_doc(doc)
+    osdf_obj.updated = False
+
+    return osdf_obj
+
+
+def _record_ledger_upload(osdf_obj, local_file, md5sum):
+    """Records the provided file in the upload ledger as being in sync with
+    the DCC.
+
+    Args:
+        osdf_obj (cutlass.*): The saved OSDF object the file is attached to.
+        local_file (string): Path to the local file.
+        md5sum (string): The md5 checksum of the file in the DCC.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    if (_upload_ledger is None or _upload_plan is not None or not md5sum or
+        not osdf_obj.id or not os.path.exists(local_file)):
+        return
+
+    dcc_ledger.record_upload(_upload_ledger, local_file, md5sum, 
+                             _get_osdf_doc(osdf_obj))
+
+
+def get_local_files(osdf_obj):
+    """Returns any local files attached to the provided OSDF object that 
+    will be transferred when the object is saved keyed on the attribute 
+    holding them.
+
+    Args:
+        osdf_obj (cutlass.*): An iHMP OSDF object.
+
+    Requires:
+        None
+
+    Returns:
+        dict: Local file paths keyed on the attribute they are found under.
+    """
+    local_files = [(field, getattr(osdf_obj, field, None)) for field 
+                   in LOCAL_FILE_FIELDS]
+    return dict((field, local_file) for (field, local_file) in local_files
+                if local_file)
+
+
+def get_osdf_object_key(osdf_obj, doc=None):
+    """Builds a key that identifies the provided OSDF object locally; that 
+    is, without relying on its OSDF ID. The key is made up of the node type
+    and the local file uploaded with the object or its identifying field 
+    (visit_id, prep_id, etc.) Objects without either (i.e. attributes) 
+    are keyed on the node they are associated with.
+
+    Args:
+        osdf_obj (cutlass.*): An iHMP OSDF object.
+        doc (dict): The OSDF document for the object if already generated.
+
+    Requires:
+        None
+
+    Returns:
+        string: The local key for the object (i.e. visit:1234_1)
+    """
+    doc = doc if doc else json.loads(osdf_obj.to_json())
+    meta = doc.get('meta', {})
+
+    local_files = sorted(get_local_files(osdf_obj).values())
+    urls = sorted(dcc_cache.get_doc_urls(doc))
+
+    if local_files:
+        name = os.path.basename(local_files[0])
+    elif urls:
+        name = os.path.basename(urls[0])
+    else:
+        name = dcc_cache.get_doc_name(doc)
+
+    if not name:
+        name = ",".join(sorted(itertools.chain.from_iterable(doc.get('linkage', {}).values())))
+
+    return "%s:%s" % (doc['node_type'], name)
+
+
+def start_upload_plan():
+    """Switches the module into planning mode. Instead of being saved any 
+    created or updated OSDF objects are recorded in an upload plan along 
+    with why they need to be pushed to the DCC. Objects that are unchanged 
+    are recorded as skipped. The plan can be written to disk with 
+    write_upload_plan and pushed to the DCC using 
+    hmp2_workflows.tasks.dcc.apply_upload_plan.
+
+    Args:
+        None
+
+    Requires:
+        None
+
+    Returns:
+        None
+
+    Example:
+        from hmp2_workflows.utils import dcc
+
+        dcc.start_upload_plan()
+        dcc.crud_study(conf, session, project.id)
+        dcc.write_upload_plan('/tmp/ibdmdb_upload.plan.json')
+    """
+    global _upload_plan
+    _upload_plan = collections.OrderedDict()
+    _plan_diffs.clear()
+
+
+def _record_plan_diff(osdf_obj, fields_to_update):
+    """Records the outcome of diffing an OSDF object against its new 
+    metadata while building an upload plan. Unchanged objects are added to 
+    the plan as skipped while changed objects have the fields that differ 
+    stashed until the object is saved.
+
+    Args:
+        osdf_obj (cutlass.*): The OSDF object that was diffed.
+        fields_to_update (list): The fields that differ.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    if fields_to_update:
+        _plan_diffs[id(osdf_obj)] = (osdf_obj, fields_to_update)
+    elif osdf_obj.id:
+        key = get_osdf_object_key(osdf_obj)
+        if key not in _upload_plan:
+            _upload_plan[key] = {'key': key,
+                                 'node_type': key.split(':', 1)[0],
+                                 'action': 'skip',
+                                 'reason': 'No changes',
+                                 'id': osdf_obj.id,
+                                 'depends': []}
+
+
+def _add_plan_entry(osdf_obj):
+    """Adds the provided OSDF object to the upload plan being built. New 
+    objects are assigned a placeholder ID so that any children created 
+    beneath them in the plan can link to them.
+
+    Args:
+        osdf_obj (cutlass.*): The OSDF object to be saved.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    doc = json.loads(osdf_obj.to_json())
+    key = get_osdf_object_key(osdf_obj, doc)
+    (_, fields_to_update) = _plan_diffs.pop(id(osdf_obj), (None, None))
+
+    if osdf_obj.id and not osdf_obj.id.startswith(PLAN_ID_PREFIX):
+        action = 'update'
+        reason = 'Changed fields: %s' % ", ".join(fields_to_update or ['unknown'])
+    else:
+        action = 'create'
+        reason = 'Not found in the DCC'
+        osdf_obj._id = PLAN_ID_PREFIX + key
+        doc.pop('id', None)
+        doc.pop('ver', None)
+
+    depends = [parent_id[len(PLAN_ID_PREFIX):] for parent_id in 
+               itertools.chain.from_iterable(doc.get('linkage', {}).values())
+               if parent_id.startswith(PLAN_ID_PREFIX)]
+
+    _upload_plan[key] = {'key': key,
+                         'node_type': doc['node_type'],
+                         'action': action,
+                         'reason': reason,
+                         'id': doc.get('id'),
+                         'depends': depends,
+                         'local_files': get_local_files(osdf_obj),
+                         'doc': doc}
+
+
+def write_upload_plan(plan_file):
+    """Writes the upload plan built since start_upload_plan was called to 
+    the provided JSON file and leaves planning mode.
+
+    Args:
+        plan_file (string): Path to the JSON file to write the plan too.
+
+    Requires:
+        None
 
-    return np.unique(updated_fields).tolist()
+    Returns:
+        dict: A count of the planned actions keyed on (node type, action)
+    """
+    global _upload_plan
+
+    entries = _upload_plan.values()
+    summary = collections.Counter((entry['node_type'], entry['action']) for
+                                  entry in entries)
+
+    with open(plan_file, 'w') as plan_fh:
+        json.dump({'created': datetime.datetime.now().isoformat(),
+                   'summary': ["%s\t%s\t%s" % (node_type, action, count) for
+                               ((node_type, action), count) in 
+                               sorted(summary.items())],
+                   'entries': entries}, plan_fh, indent=1)
+
+    _upload_plan = None
+    _plan_diffs.clear()
+
+    return dict(summary)
+
+
+def read_upload_plan(plan_file):
+    """Reads an upload plan written by write_upload_plan.
+
+    Args:
+        plan_file (string): Path to the JSON upload plan.
+
+    Requires:
+        None
+
+    Returns:
+        list: The plan entries in the order they were planned.
+    """
+    with open(plan_file) as plan_fh:
+        return json.load(plan_fh).get('entries', [])
+
+
+def load_plan_entry(entry, resolved_ids):
+    """Rebuilds the cutlass object described by an upload plan entry, 
+    swapping any placeholder links for the OSDF ID's of parents created 
+    earlier in the apply.
+
+    Args:
+        entry (dict): An upload plan entry.
+        resolved_ids (dict): OSDF ID's of already applied entries keyed on
+            their local key.
+
+    Requires:
+        None
+
+    Returns:
+        cutlass.*: The object ready to be saved.
+    """
+    doc = json.loads(json.dumps(entry['doc']))
+
+    for (link_type, parent_ids) in doc.get('linkage', {}).iteritems():
+        for (idx, parent_id) in enumerate(parent_ids):
+            if parent_id.startswith(PLAN_ID_PREFIX):
+                parent_key = parent_id[len(PLAN_ID_PREFIX):]
+                if parent_key not in resolved_ids:
+                    raise ValueError('Parent %s of %s has not been applied' %
+                                     (parent_key, entry['key']))
+                parent_ids[idx] = resolved_ids[parent_key]
+
+    is_new = entry['action'] == 'create'
+    if is_new:
+        doc['id'] = PLAN_ID_PREFIX + entry['key']
+        doc['ver'] = None
+
+    osdf_obj = dcc_cache.load_osdf_doc(doc)
+
+    if is_new:
+        osdf_obj._id = None
+
+    for (field, local_file) in entry.get('local_files', {}).iteritems():
+        setattr(osdf_obj, field, local_file)
+
+    osdf_obj.updated = True
+    return osdf_obj
+
+
+def prefetch_osdf_nodes(session, node_types, study=None, namespace='ihmp'):
+    """Pulls every OSDF node of the provided node types (optionally 
+    restricted to a single study) using a handful of large paged OQL 
+    queries and indexes them in memory on the ID of every node they link 
+    too. Once prefetched all per-parent lookups for these node types 
+    (i.e. the AbundanceMatrix lookups in crud_abundance_matrix) are served 
+    from the index instead of issuing a query per parent.
+
+    Args:
+        session (cutlass.iHMPSession): Session object that represents a 
+            connection to the iHMP OSDF instance.
+        node_types (list): The OSDF node types to prefetch.
+        study (string): If provided only nodes whose meta.study field 
+            matches are prefetched.
+        namespace (string): OSDF namespace to query.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The number of nodes prefetched keyed on node type.
+
+    Example:
+        from hmp2_workflows.utils import dcc
+
+        dcc.prefetch_osdf_nodes(session, ['abundance_matrix'], study='ibd')
+    """
+    osdf = session.get_osdf()
+    node_counts = {}
+
+    for node_type in node_types:
+        query = '"%s"[node_type]' % node_type
+        if study:
+            query += ' && "%s"[meta.study]' % study
+
+        with _prefetch_lock:
+            _prefetched_nodes[node_type] = {}
+        node_counts[node_type] = 0
+
+        for doc in dcc_cache.oql_query_all(osdf, namespace, query):
+            _index_prefetched_doc(doc)
+            node_counts[node_type] += 1
+
+    return node_counts
+
+
+def _index_prefetched_doc(doc):
+    """Adds (or replaces) an OSDF document in the prefetched node index.
+
+    Args:
+        doc (dict): OSDF document.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    with _prefetch_lock:
+        node_index = _prefetched_nodes.get(doc['node_type'])
+
+        if node_index is None:
+            return
+
+        for parent_id in itertools.chain.from_iterable(doc.get('linkage', {}).values()):
+            linked_docs = node_index.setdefault(parent_id, [])
+            linked_docs[:] = [linked_doc for linked_doc in linked_docs 
+                              if linked_doc.get('id') != doc.get('id')]
+            linked_docs.append(doc)
+
+
+def _get_linked_nodes(session, node_type, link_type, parent_id, namespace='ihmp'):
+    """Returns an iterator of all nodes of the provided type linked to the
+    supplied parent ID via the given linkage field. Lookups are served from
+    the prefetched node index when the node type has been prefetched 
+    otherwise OSDF is queried directly.
+
+    Args:
+        session (cutlass.Session): The current OSDF session object.
+        node_type (string): The node type to retrieve (i.e. abundance_matrix)
+        link_type (string): The linkage field pointing at the parent 
+            (i.e. computed_from)
+        parent_id (string): The OSDF ID of the parent node.
+        namespace (string): OSDF namespace to query.
+
+    Requires:
+        None
+
+    Returns:
+        Iterator: An iterator containing all linked nodes.
+    """
+    if not parent_id:
+        return
+
+    with _prefetch_lock:
+        node_index = _prefetched_nodes.get(node_type)
+        if node_index is not None:
+            docs = [doc for doc in node_index.get(parent_id, [])
+                    if parent_id in doc.get('linkage', {}).get(link_type, [])]
+
+    if node_index is None:
+        linkage_query = ('"{}"[node_type] && "{}"[linkage.{}]'.format(node_type, 
+                                                                      parent_id, 
+                                                                      link_type))
+        docs = dcc_cache.oql_query_all(session.get_osdf(), namespace, linkage_query)
+
+    for doc in docs:
+        yield dcc_cache.load_osdf_doc(doc)
 
 
 def _get_host_assay_prep_abund_matrices(session, prep_id):
@@ -401,25 +1043,7 @@ def _get_host_assay_prep_abund_matrices(session, prep_id):
         Iterator: An iterator containing all children connected to the 
             supplied OSDF object.                    
     """
-    query = session.get_osdf().oql_query
-    linkage_query = ('"abundance_matrix"[node_type] && '
-                     '"{}"[linkage.computed_from]'.format(prep_id))
-
-    from cutlass.AbundanceMatrix import AbundanceMatrix
-    from cutlass.HostAssayPrep import HostAssayPrep
-
-    for page_no in itertools.count(1):
-        res = query(WgsRawSeqSet.namespace, linkage_query,
-                    page=page_no)
-        res_count = res['result_count']
-
-        for doc in res['results']:
-            yield AbundanceMatrix.load_abundance_matrix(doc)
-
-        res_count -= len(res['results'])
-
-        if res_count < 1:
-            break
+    return _get_linked_nodes(session, 'abundance_matrix', 'computed_from', prep_id)
 
 
 def _get_wgs_raw_seq_set_abund_matrices(session, seq_set_id):
@@ -439,26 +1063,7 @@ def _get_wgs_raw_seq_set_abund_matrices(session, seq_set_id):
         iterator: An iterator containing all found abundance matrices.                            
 
     """
-    if seq_set_id:
-        query = session.get_osdf().oql_query
-        linkage_query = ('"abundance_matrix"[node_type] && ' 
-                         '"{}"[linkage.computed_from]'.format(seq_set_id))
-
-        from cutlass.AbundanceMatrix import AbundanceMatrix
-        from cutlass.WgsRawSeqSet import WgsRawSeqSet            
-
-        for page_no in itertools.count(1):
-            res = query(WgsRawSeqSet.namespace, linkage_query,
-                        page=page_no)
-            res_count = res['result_count']
-
-            for doc in res['results']:
-                yield AbundanceMatrix.load_abundance_matrix(doc)
-
-            res_count -= len(res['results'])
-
-            if res_count < 1:
-                break
+    return _get_linked_nodes(session, 'abundance_matrix', 'computed_from', seq_set_id)
 
 
 def _get_microb_transcriptomics_raw_seq_set_abund_matrices(session, seq_set_id):
@@ -478,26 +1083,7 @@ def _get_microb_transcriptomics_raw_seq_set_abund_matrices(session, seq_set_id):
         iterator: An iterator containing all found abundance matrices.                            
 
     """
-    if seq_set_id:
-        query = session.get_osdf().oql_query
-        linkage_query = ('"abundance_matrix"[node_type] && ' 
-                         '"{}"[linkage.computed_from]'.format(seq_set_id))
-
-        from cutlass.AbundanceMatrix import AbundanceMatrix
-        from cutlass.MicrobTranscriptomicsRawSeqSet import MicrobTranscriptomicsRawSeqSet   
-
-        for page_no in itertools.count(1):
-            res = query(MicrobTranscriptomicsRawSeqSet.namespace, linkage_query,
-                        page=page_no)
-            res_count = res['result_count']
-
-            for doc in res['results']:
-                yield AbundanceMatrix.load_abundance_matrix(doc)
-
-            res_count -= len(res['results'])
-
-            if res_count < 1:
-                break
+    return _get_linked_nodes(session, 'abundance_matrix', 'computed_from', seq_set_id)
 
 
 def _get_serologies(session, prep_id):
@@ -516,25 +1102,7 @@ def _get_serologies(session, prep_id):
         Iterator: An iterator containing all children connected to the 
             supplied OSDF object.                    
     """
-    query = session.get_osdf().oql_query
-    linkage_query = ('"serology"[node_type] && '
-                     '"{}"[linkage.derived_from]'.format(prep_id))
-
-    from cutlass.Serology import Serology
-    from cutlass.HostAssayPrep import HostAssayPrep
-
-    for page_no in itertools.count(1):
-        res = query(Serology.namespace, linkage_query,
-                    page=page_no)
-        res_count = res['result_count']
-
-        for doc in res['results']:
-            yield Serology.load_serology(doc)
-
-        res_count -= len(res['results'])
-
-        if res_count < 1:
-            break
+    return _get_linked_nodes(session, 'serology', 'derived_from', prep_id)
 
 
 def _get_epigenetics_raw_seq_sets(session, prep_id):
@@ -553,25 +1121,8 @@ def _get_epigenetics_raw_seq_sets(session, prep_id):
         Iterator: An iterator containing all children connected to the 
             supplied OSDF object.                    
     """
-    osdf = session.get_osdf()
-
-    linkage_query = ('"host_epigenetics_raw_seq_set"[node_type] && '
-                     '"{}"[linkage.sequenced_from]'.format(prep_id))
-
-    from cutlass.HostEpigeneticsRawSeqSet import HostEpigeneticsRawSeqSet
-
-    for page_no in itertools.count(1):
-        res = osdf.oql_query(HostEpigeneticsRawSeqSet.namespace, linkage_query,
-                             page=page_no)
-        res_count = res['result_count']
-
-        for doc in res['results']:
-            yield HostEpigeneticsRawSeqSet.load_host_epigenetics_raw_seq_set(doc)
-
-        res_count -= len(res['results'])
-
-        if res_count < 1:
-            break
+    return _get_linked_nodes(session, 'host_epigenetics_raw_seq_set', 
+                             'sequenced_from', prep_id)
 
 
 def _get_host_variant_calls(session, seq_set_id):
@@ -590,25 +1141,7 @@ def _get_host_variant_calls(session, seq_set_id):
         Iterator: An iterator containing all children connected to the 
             supplied OSDF object.                    
     """
-    osdf = session.get_osdf()
-
-    linkage_query = ('"host_variant_call"[node_type] && '
-                     '"{}"[linkage.computed_from]'.format(seq_set_id))
-
-    from cutlass.HostVariantCall import HostVariantCall
-
-    for page_no in itertools.count(1):
-        res = osdf.oql_query(HostVariantCall.namespace, linkage_query,
-                             page=page_no)
-        res_count = res['result_count']
-
-        for doc in res['results']:
-            yield HostVariantCall.load_host_variant_call(doc)
-
-        res_count -= len(res['results'])
-
-        if res_count < 1:
-            break
+    return _get_linked_nodes(session, 'host_variant_call', 'computed_from', seq_set_id)
 
 
 def _get_abund_matrices(session, seq_set_id):
@@ -628,24 +1161,7 @@ def _get_abund_matrices(session, seq_set_id):
         iterator: An iterator containing all found abundance matrices.                            
 
     """
-    if seq_set_id:
-        query = session.get_osdf().oql_query
-        linkage_query = ('"abundance_matrix"[node_type] && ' 
-                         '"{}"[linkage.computed_from]'.format(seq_set_id))
-
-        from cutlass.AbundanceMatrix import AbundanceMatrix
-
-        for page_no in itertools.count(1):
-            res = query('ihmp', linkage_query, page=page_no)
-            res_count = res['result_count']
-
-            for doc in res['results']:
-                yield AbundanceMatrix.load_abundance_matrix(doc)
-
-            res_count -= len(res['results'])
-
-            if res_count < 1:
-                break
+    return _get_linked_nodes(session, 'abundance_matrix', 'computed_from', seq_set_id)
 
 
 def get_project(conf, session):
@@ -747,7 +1263,7 @@ def crud_study(conf, session, project_id):
         study.links['part_of'] = [project_id]
         
         if study.is_valid():
-            success = study.save()
+            success = save_osdf_object(study)
             if not success: 
                 raise ValueError('Saving study %s failed.' % study.name) 
         else:
@@ -803,7 +1319,8 @@ def _crud_subject_attribute(subject, metadata, study_id, conf):
         cutlass.SubjectAttribute: The created or updated OSDF 
             SubjectAttribute object.
     """
-    subject_attrs = list(subject.attributes())
+    subject_attrs = list(get_osdf_children(subject, ['subject_attr'],
+                                           subject.attributes))
     sa_col_map = conf.get('col_map')
 
 
@@ -830,7 +1347,7 @@ def _crud_subject_attribute(subject, metadata, study_id, conf):
         subject_attr.links['associated_with'] = [subject.id]
 
         if subject_attr.is_valid():
-            success = subject_attr.save()
+            success = save_osdf_object(subject_attr)
             if not success: 
                 raise ValueError('Saving subject attribute for subject %s failed.', 
                                   subject.rand_subject_id)
@@ -889,7 +1406,7 @@ def crud_subjects(subjects, study, baseline_metadata, conf):
             subject.links['participates_in'] = [study.id]
 
             if subject.is_valid():
-                success = subject.save()
+                success = save_osdf_object(subject)
                 if not success:
                     raise ValueError('Saving subject %s failed.' % subject_id)
             
@@ -957,7 +1474,7 @@ def crud_visit(visits, visit_num, subject_id, dtype_abbrev, metadata, conf):
         visit.links['by'] = [subject_id]
 
         if visit.is_valid():
-            success = visit.save()
+            success = save_osdf_object(visit)
             if not success:
                 raise ValueError('Saving visit %s failed.' % visit_num)
 
@@ -1031,7 +1548,8 @@ def _crud_visit_attribute(visit, metadata, conf):
         cutlass.VisitAttribute: The created or updated OSDF Visit Attribute
             object.
     """
-    visit_attrs = list(visit.visit_attributes())
+    visit_attrs = list(get_osdf_children(visit, ['visit_attr'],
+                                         visit.visit_attributes))
     visit_attr_conf = conf.get('visit_attribute')
     req_metadata = {}
 
@@ -1097,7 +1615,7 @@ def _crud_visit_attribute(visit, metadata, conf):
         visit_attr.links['associated_with'] = [visit.id]
 
         if visit_attr.is_valid():
-            success = visit_attr.save()
+            success = save_osdf_object(visit_attr)
             if not success: 
                 raise ValueError('Saving visit attribute for visit %s failed.', 
                                   visit.id)
@@ -1150,7 +1668,8 @@ def _crud_sample_attribute(sample, metadata, conf):
         cutlass.SampleAttribute: The created or updated OSDF Sample Attribute
             object.
     """
-    sample_attrs = list(sample.sampleAttributes())
+    sample_attrs = list(get_osdf_children(sample, ['sample_attr'],
+                                          sample.sampleAttributes))
 
     ## field so its more difficult to keep track of when we are dealing with
     ## updating an existing SampleAttribute object or we need to create a new 
@@ -1182,7 +1701,7 @@ def _crud_sample_attribute(sample, metadata, conf):
         sample_attr.links['associated_with'] = [sample.id]
 
         if sample_attr.is_valid():
-            success = sample_attr.save()
+            success = save_osdf_object(sample_attr)
             if not success: 
                 raise ValueError('Saving sample attribute for sample %s failed.', 
                                   sample.id)
@@ -1250,7 +1769,7 @@ def crud_sample(samples, sample_id, visit_id, conf, metadata):
         sample.links['collected_during'] = [visit_id]
 
         if sample.is_valid():
-            success = sample.save()
+            success = save_osdf_object(sample)
             if not success:
                 raise ValueError('Saving sample % failed.' % sample_id)
         else:
@@ -1286,7 +1805,9 @@ def crud_wgs_dna_prep(sample, study_id, dtype_abbrev, conf, metadata):
     """
     prep_id = "%s_%s" % (metadata.get('External ID'), dtype_abbrev)
 
-    wgs_dna_preps = group_osdf_objects(sample.wgsDnaPreps(),
+    wgs_dna_preps = group_osdf_objects(get_osdf_children(sample, 
+                                                         ['wgs_dna_prep'],
+                                                         sample.wgsDnaPreps),
                                        'prep_id')
     wgs_dna_prep = wgs_dna_preps.get(prep_id)
 
@@ -1313,7 +1834,7 @@ def crud_wgs_dna_prep(sample, study_id, dtype_abbrev, conf, metadata):
         wgs_dna_prep.links['prepared_from'] = [sample.id]
 
         if wgs_dna_prep.is_valid():
-            success = wgs_dna_prep.save()
+            success = save_osdf_object(wgs_dna_prep)
             if not success:
                 raise ValueError('Saving WGS DNA prep %s failed.' % 
                                  req_metadata.get('prep_id'))
@@ -1349,7 +1870,9 @@ def crud_sixs_dna_prep(sample, study_id, dtype_abbrev, conf, metadata):
     """
     prep_id = "%s_%s" % (metadata.get('External ID'), dtype_abbrev)
 
-    sixs_dna_preps = group_osdf_objects(sample.sixteenSDnaPreps(),
+    sixs_dna_preps = group_osdf_objects(get_osdf_children(sample,
+                                                          ['16s_dna_prep'],
+                                                          sample.sixteenSDnaPreps),
                                        'prep_id')
     sixs_dna_prep = sixs_dna_preps.get(prep_id)
 
@@ -1377,7 +1900,7 @@ def crud_sixs_dna_prep(sample, study_id, dtype_abbrev, conf, metadata):
         sixs_dna_prep.links['prepared_from'] = [sample.id]
 
         if sixs_dna_prep.is_valid():
-            success = sixs_dna_prep.save()
+            success = save_osdf_object(sixs_dna_prep)
             if not success:
                 raise ValueError('Saving 16S DNA prep %s failed.' % 
                                  req_metadata.get('prep_id'))
@@ -1413,7 +1936,9 @@ def crud_host_assay_prep(sample, study_id, dtype_abbrev, conf, metadata):
     """
     prep_id = "%s_%s" % (metadata.get('External ID'), dtype_abbrev)
 
-    host_assay_preps = group_osdf_objects(sample.hostAssayPreps(),
+    host_assay_preps = group_osdf_objects(get_osdf_children(sample,
+                                                            ['host_assay_prep'],
+                                                            sample.hostAssayPreps),
                                           'prep_id')
     host_assay_prep = host_assay_preps.get(prep_id)
 
@@ -1440,7 +1965,7 @@ def crud_host_assay_prep(sample, study_id, dtype_abbrev, conf, metadata):
         host_assay_prep.links['prepared_from'] = [sample.id]
 
         if host_assay_prep.is_valid():
-            success = host_assay_prep.save()
+            success = save_osdf_object(host_assay_prep)
             if not success:
                 raise ValueError('Saving host assay prep %s failed.' % 
                                  req_metadata.get('prep_id'))
@@ -1476,7 +2001,9 @@ def crud_host_seq_prep(sample, study_id, dtype_abbrev, conf, metadata):
     """
     prep_id = "%s_%s" % (metadata.get('External ID'), dtype_abbrev)
 
-    host_seq_preps = group_osdf_objects(sample.hostSeqPreps(),
+    host_seq_preps = group_osdf_objects(get_osdf_children(sample,
+                                                          ['host_seq_prep'],
+                                                          sample.hostSeqPreps),
                                         'prep_id')
     host_seq_prep = host_seq_preps.get(prep_id)
 
@@ -1511,7 +2038,7 @@ def crud_host_seq_prep(sample, study_id, dtype_abbrev, conf, metadata):
         host_seq_prep.links['prepared_from'] = [sample.id]
 
         if host_seq_prep.is_valid():
-            success = host_seq_prep.save()
+            success = save_osdf_object(host_seq_prep)
             if not success:
                 raise ValueError('Saving host seq prep %s failed.' % 
                                  req_metadata.get('prep_id'))
@@ -1547,7 +2074,9 @@ def crud_microb_assay_prep(sample, study_id, dtype_abbrev, conf, metadata):
     """
     prep_id = "%s_%s" % (metadata.get('External ID'), dtype_abbrev)
 
-    microbiome_preps = group_osdf_objects(sample.microbAssayPreps(),
+    microbiome_preps = group_osdf_objects(get_osdf_children(sample,
+                                                            ['microb_assay_prep'],
+                                                            sample.microbAssayPreps),
                                           'prep_id')
     microbiome_prep = microbiome_preps.get(prep_id)
 
@@ -1577,7 +2106,7 @@ def crud_microb_assay_prep(sample, study_id, dtype_abbrev, conf, metadata):
         microbiome_prep.links['prepared_from'] = [sample.id]
 
         if microbiome_prep.is_valid():
-            success = microbiome_prep.save()
+            success = save_osdf_object(microbiome_prep)
             if not success:
                 raise ValueError('Saving microbiome prep %s failed.' % 
                                  req_metadata.get('prep_id'))
@@ -1619,16 +2148,21 @@ def crud_serology(session, prep, md5sum, sample_id, study_name, conf, metadata):
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    serologies = group_osdf_objects(_get_serologies(session, prep.id), 'comment')
-    serologies = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                      in serologies.items())
-    
-    serology = serologies.get(raw_file_name)
+    serology = _get_ledger_object(metadata.get('seq_file'), md5sum)
 
     if not serology:
-        serology = cutlass.Serology()
-    else:
-        serology = serologies[0]
+        serologies = group_osdf_objects(get_osdf_children(prep, ['serology'],
+                                                        lambda: _get_serologies(session, prep.id)),
+                                      'comment')
+        serologies = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                          in serologies.items())
+
+        serology = serologies.get(raw_file_name)
+
+        if not serology:
+            serology = cutlass.Serology()
+        else:
+            serology = serologies[0]
 
     req_metadata.update(conf.get('serology'))
 
@@ -1642,6 +2176,8 @@ def crud_serology(session, prep, md5sum, sample_id, study_name, conf, metadata):
     req_metadata['tags'] = []
 
     fields_to_update = get_fields_to_update(req_metadata, serology)
+    if not fields_to_update:
+        _record_ledger_upload(serology, metadata.get('seq_file'), md5sum)
 
     map(lambda key: setattr(serology, key, req_metadata.get(key)),
         fields_to_update)
@@ -1688,23 +2224,27 @@ def crud_proteome(prep, md5sum, sample_id, conf, metadata):
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    proteomes = group_osdf_objects(prep.proteomes(),
-                                   'raw_url')
-    proteomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                      in proteomes.items())
-    
-    proteome = proteomes.get(raw_file_name)
+    proteome = _get_ledger_object(metadata.get('seq_file'), md5sum)
 
     if not proteome:
-        proteome = cutlass.Proteome()
-
-        ## TODO: Talk to Rick about these dummy files and how we might replace them
-        ## with real files.
-        req_metadata['local_peak_file'] = tempfile.NamedTemporaryFile(delete=False).name
-        req_metadata['local_result_file'] = tempfile.NamedTemporaryFile(delete=False).name
-        req_metadata['local_other_file'] = tempfile.NamedTemporaryFile(delete=False).name
-    else:
-        proteome = proteome[0]
+        proteomes = group_osdf_objects(get_osdf_children(prep, ['proteome'],
+                                                         prep.proteomes),
+                                       'raw_url')
+        proteomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                          in proteomes.items())
+
+        proteome = proteomes.get(raw_file_name)
+
+        if not proteome:
+            proteome = cutlass.Proteome()
+
+            ## TODO: Talk to Rick about these dummy files and how we might replace them
+            ## with real files.
+            req_metadata['local_peak_file'] = tempfile.NamedTemporaryFile(delete=False).name
+            req_metadata['local_result_file'] = tempfile.NamedTemporaryFile(delete=False).name
+            req_metadata['local_other_file'] = tempfile.NamedTemporaryFile(delete=False).name
+        else:
+            proteome = proteome[0]
 
     req_metadata.update(conf.get('proteome'))
 
@@ -1716,6 +2256,8 @@ def crud_proteome(prep, md5sum, sample_id, conf, metadata):
     req_metadata['local_raw_file'] = metadata.get('seq_file')
 
     fields_to_update = get_fields_to_update(req_metadata, proteome)
+    if not fields_to_update:
+        _record_ledger_upload(proteome, metadata.get('seq_file'), md5sum)
 
     map(lambda key: setattr(proteome, key, req_metadata.get(key)),
         fields_to_update)
@@ -1761,20 +2303,25 @@ def crud_host_wgs_raw_seq_set(prep, md5sum, sample_id, conf, metadata):
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    ## By setting our files to private (required) we lose the ability to parse
-    ## out the filenames from the existing transcriptomics sequence sets so we 
-    ## need to store this information somewhere else; the comment.
-    host_wgs_raw_seq_sets = group_osdf_objects(prep.derivations(),
-                                               'comment')
-    host_wgs_raw_seq_sets = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                                 in host_wgs_raw_seq_sets.items())
-    
-    host_wgs_raw_seq_set = host_wgs_raw_seq_sets.get(raw_file_name)
+    host_wgs_raw_seq_set = _get_ledger_object(metadata.get('seq_file'), md5sum)
 
     if not host_wgs_raw_seq_set:
-        host_wgs_raw_seq_set = cutlass.HostWgsRawSeqSet()
-    else:
-        host_wgs_raw_seq_set = host_wgs_raw_seq_set[0]
+        ## By setting our files to private (required) we lose the ability to parse
+        ## out the filenames from the existing transcriptomics sequence sets so we 
+        ## need to store this information somewhere else; the comment.
+        host_wgs_raw_seq_sets = group_osdf_objects(get_osdf_children(prep,
+                                                                     HOST_SEQ_SET_NODE_TYPES,
+                                                                     prep.derivations),
+                                                   'comment')
+        host_wgs_raw_seq_sets = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                                     in host_wgs_raw_seq_sets.items())
+
+        host_wgs_raw_seq_set = host_wgs_raw_seq_sets.get(raw_file_name)
+
+        if not host_wgs_raw_seq_set:
+            host_wgs_raw_seq_set = cutlass.HostWgsRawSeqSet()
+        else:
+            host_wgs_raw_seq_set = host_wgs_raw_seq_set[0]
 
     req_metadata.update(conf.get('host_genome'))
     req_metadata['checksums'] = { "md5": md5sum }
@@ -1786,6 +2333,9 @@ def crud_host_wgs_raw_seq_set(prep, md5sum, sample_id, conf, metadata):
     req_metadata['tags'] = []
 
     fields_to_update = get_fields_to_update(req_metadata, host_wgs_raw_seq_set)
+    if not fields_to_update:
+        _record_ledger_upload(host_wgs_raw_seq_set, metadata.get('seq_file'), md5sum)
+
     map(lambda key: setattr(host_wgs_raw_seq_set, key, req_metadata.get(key)),
         fields_to_update)
 
@@ -1831,20 +2381,25 @@ def crud_host_tx_raw_seq_set(prep, md5sum, sample_id, conf, metadata):
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    ## By setting our files to private (required) we lose the ability to parse
-    ## out the filenames from the existing transcriptomics sequence sets so we 
-    ## need to store this information somewhere else; the comment.
-    transcriptomes = group_osdf_objects(prep.derivations(),
-                                       'comment')
-    transcriptomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                           in transcriptomes.items())
-    
-    transcriptome = transcriptomes.get(raw_file_name)
+    transcriptome = _get_ledger_object(metadata.get('seq_file'), md5sum)
 
     if not transcriptome:
-        transcriptome = cutlass.HostTranscriptomicsRawSeqSet()
-    else:
-        transcriptome = transcriptome[0]
+        ## By setting our files to private (required) we lose the ability to parse
+        ## out the filenames from the existing transcriptomics sequence sets so we 
+        ## need to store this information somewhere else; the comment.
+        transcriptomes = group_osdf_objects(get_osdf_children(prep,
+                                                             HOST_SEQ_SET_NODE_TYPES,
+                                                             prep.derivations),
+                                           'comment')
+        transcriptomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                               in transcriptomes.items())
+
+        transcriptome = transcriptomes.get(raw_file_name)
+
+        if not transcriptome:
+            transcriptome = cutlass.HostTranscriptomicsRawSeqSet()
+        else:
+            transcriptome = transcriptome[0]
 
     req_metadata.update(conf.get('host_transcriptome'))
     req_metadata['checksums'] = { "md5": md5sum }
@@ -1857,6 +2412,9 @@ def crud_host_tx_raw_seq_set(prep, md5sum, sample_id, conf, metadata):
     req_metadata['tags'] = []
 
     fields_to_update = get_fields_to_update(req_metadata, transcriptome)
+    if not fields_to_update:
+        _record_ledger_upload(transcriptome, metadata.get('seq_file'), md5sum)
+
     map(lambda key: setattr(transcriptome, key, req_metadata.get(key)),
         fields_to_update)
 
@@ -1903,18 +2461,23 @@ def crud_wgs_raw_seq_set(prep, seq_file, md5sum, sample_id, conf, metadata, priv
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    group_key = 'urls' if not private else 'comment'
-    metagenomes = group_osdf_objects(prep.child_seq_sets(),
-                                     group_key)
-    metagenomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                          in metagenomes.items())
-    
-    metagenome = metagenomes.get(raw_file_name)
+    metagenome = _get_ledger_object(seq_file, md5sum)
 
     if not metagenome:
-        metagenome = cutlass.WgsRawSeqSet()
-    else:
-        metagenome = metagenome[0]
+        group_key = 'urls' if not private else 'comment'
+        metagenomes = group_osdf_objects(get_osdf_children(prep,
+                                                           WGS_SEQ_SET_NODE_TYPES,
+                                                           prep.child_seq_sets),
+                                         group_key)
+        metagenomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                              in metagenomes.items())
+
+        metagenome = metagenomes.get(raw_file_name)
+
+        if not metagenome:
+            metagenome = cutlass.WgsRawSeqSet()
+        else:
+            metagenome = metagenome[0]
 
     req_metadata.update(conf.get('metagenome'))
     req_metadata['local_file'] = seq_file
@@ -1926,21 +2489,22 @@ def crud_wgs_raw_seq_set(prep, seq_file, md5sum, sample_id, conf, metadata, priv
         req_metadata['private_files'] = True
 
     fields_to_update = get_fields_to_update(req_metadata, metagenome)
+    if not fields_to_update:
+        _record_ledger_upload(metagenome, seq_file, md5sum)
+
     map(lambda key: setattr(metagenome, key, req_metadata.get(key)),
         fields_to_update)
 
+    metagenome.updated = False
     if fields_to_update:
         metagenome.links['sequenced_from'] = [prep.id]
 
-        if metagenome.is_valid():
-            success = metagenome.save()
-
-            if not success:
-                raise ValueError('Saving raw WGS seq set %s failed.' % seq_file)
-        else:
+        if not metagenome.is_valid():
             raise ValueError('WGS raw seq set validation failed: %s' % 
                              metagenome.validate())
 
+        metagenome.updated = True
+
     return metagenome
 
 
@@ -1974,17 +2538,22 @@ def crud_microb_transcriptomics_raw_seq_set(prep, seq_file, md5sum, sample_id, c
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    metatranscriptomes = group_osdf_objects(prep.child_seq_sets(),
-                                            'urls')
-    metatranscriptomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                             in metatranscriptomes.items())
-    
-    metatranscriptome = metatranscriptomes.get(raw_file_name)
+    metatranscriptome = _get_ledger_object(seq_file, md5sum)
 
     if not metatranscriptome:
-        metatranscriptome = cutlass.MicrobTranscriptomicsRawSeqSet()
-    else:
-        metatranscriptome = metatranscriptome[0]
+        metatranscriptomes = group_osdf_objects(get_osdf_children(prep,
+                                                                  WGS_SEQ_SET_NODE_TYPES,
+                                                                  prep.child_seq_sets),
+                                                'urls')
+        metatranscriptomes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                                 in metatranscriptomes.items())
+
+        metatranscriptome = metatranscriptomes.get(raw_file_name)
+
+        if not metatranscriptome:
+            metatranscriptome = cutlass.MicrobTranscriptomicsRawSeqSet()
+        else:
+            metatranscriptome = metatranscriptome[0]
 
     req_metadata.update(conf.get('metatranscriptome'))
     req_metadata['local_file'] = seq_file
@@ -1992,21 +2561,22 @@ def crud_microb_transcriptomics_raw_seq_set(prep, seq_file, md5sum, sample_id, c
     req_metadata['checksums'] = { "md5": md5sum }
 
     fields_to_update = get_fields_to_update(req_metadata, metatranscriptome)
+    if not fields_to_update:
+        _record_ledger_upload(metatranscriptome, seq_file, md5sum)
+
     map(lambda key: setattr(metatranscriptome, key, req_metadata.get(key)),
         fields_to_update)
 
+    metatranscriptome.updated = False
     if fields_to_update:
         metatranscriptome.links['sequenced_from'] = [prep.id]
 
-        if metatranscriptome.is_valid():
-            success = metatranscriptome.save()
-
-            if not success:
-                raise ValueError('Saving raw MTX seq set %s failed.' % seq_file)
-        else:
+        if not metatranscriptome.is_valid():
             raise ValueError('Microbe Transcritpome validation failed: %s' % 
                              metatranscriptome.validate())
 
+        metatranscriptome.updated = True
+
     return metatranscriptome
 
 
@@ -2035,16 +2605,21 @@ def crud_sixs_raw_seq_set(prep, md5sum, conf, metadata):
     req_metadata = {}
 
 
-    sixs_raw_seqs = group_osdf_objects([raw_seq for raw_seq in prep.children(flatten=True) if 
-                                        isinstance(raw_seq, cutlass.SixteenSRawSeqSet)], 
-                                        'urls')
-    sixs_raw_seqs = dict((os.path.basename(k), v) for (k,v) in sixs_raw_seqs.items())
-    sixs_raw_seq = sixs_raw_seqs.get(raw_file_name)
+    sixs_raw_seq = _get_ledger_object(seq_file, md5sum)
 
     if not sixs_raw_seq:
-        sixs_raw_seq = cutlass.SixteenSRawSeqSet()
-    else:
-        sixs_raw_seq = sixs_raw_seq[0]
+        sixs_raw_seqs = get_osdf_children(prep, ['16s_raw_seq_set'],
+                                          lambda: prep.children(flatten=True))
+        sixs_raw_seqs = group_osdf_objects([raw_seq for raw_seq in sixs_raw_seqs if 
+                                            isinstance(raw_seq, cutlass.SixteenSRawSeqSet)], 
+                                            'urls')
+        sixs_raw_seqs = dict((os.path.basename(k), v) for (k,v) in sixs_raw_seqs.items())
+        sixs_raw_seq = sixs_raw_seqs.get(raw_file_name)
+
+        if not sixs_raw_seq:
+            sixs_raw_seq = cutlass.SixteenSRawSeqSet()
+        else:
+            sixs_raw_seq = sixs_raw_seq[0]
 
     req_metadata.update(conf.get('amplicon_raw'))
     req_metadata['local_file'] = seq_file
@@ -2052,24 +2627,22 @@ def crud_sixs_raw_seq_set(prep, md5sum, conf, metadata):
     req_metadata['checksums'] = { "md5": md5sum }
 
     fields_to_update = get_fields_to_update(req_metadata, sixs_raw_seq)
+    if not fields_to_update:
+        _record_ledger_upload(sixs_raw_seq, seq_file, md5sum)
+
     map(lambda key: setattr(sixs_raw_seq, key, req_metadata.get(key)),
         fields_to_update)
 
     sixs_raw_seq.updated = False
     if fields_to_update:
-        sixs_raw_seq.updated = True
         sixs_raw_seq.links['sequenced_from'] = [prep.id]
 
-        if sixs_raw_seq.is_valid():
-            success = sixs_raw_seq.save()
-
-            if not success:
-                raise ValueError('Saving 16S raw seq set %s failed.' %
-                                 req_metadata['local_file'])
-        else:
+        if not sixs_raw_seq.is_valid():
             raise ValueError('16S raw sequence set validation failed: %s' % 
                              sixs_raw_seq.validate())
 
+        sixs_raw_seq.updated = True
+
     return sixs_raw_seq
 
 def crud_metabolome(prep, metabolome_file, md5sum, sample_id, study_id, conf, metadata):
@@ -2102,13 +2675,17 @@ def crud_metabolome(prep, metabolome_file, md5sum, sample_id, study_id, conf, me
 
     raw_file_name = os.path.basename(metabolome_file)
 
-    metabolomes = group_osdf_objects(prep.metabolomes(),
-                                     'urls')
-    metabolomes = dict((os.path.basename(k), v) for (k,v) 
-                      in metabolomes.items())
-    
-    metabolome = metabolomes.get(raw_file_name)
-    metabolome = cutlass.Metabolome() if not metabolome else metabolome[0]
+    metabolome = _get_ledger_object(metabolome_file, md5sum)
+
+    if not metabolome:
+        metabolomes = group_osdf_objects(get_osdf_children(prep, ['metabolome'],
+                                                           prep.metabolomes),
+                                         'urls')
+        metabolomes = dict((os.path.basename(k), v) for (k,v) 
+                          in metabolomes.items())
+
+        metabolome = metabolomes.get(raw_file_name)
+        metabolome = cutlass.Metabolome() if not metabolome else metabolome[0]
 
     req_metadata.update(conf.get('metabolome'))
 
@@ -2122,23 +2699,23 @@ def crud_metabolome(prep, metabolome_file, md5sum, sample_id, study_id, conf, me
     req_metadata['tags'].append(metadata.get('diagnosis'))
 
     fields_to_update = get_fields_to_update(req_metadata, metabolome)
+    if not fields_to_update:
+        _record_ledger_upload(metabolome, metabolome_file, md5sum)
 
     map(lambda key: setattr(metabolome, key, req_metadata.get(key)),
         fields_to_update)
 
+    metabolome.updated = False
     if fields_to_update:
         metabolome.study = prep.study
         metabolome.links['derived_from'] = [prep.id]
 
-        if metabolome.is_valid():
-            success = metabolome.save()
-            if not success:
-                raise ValueError('Saving metabolome %s failed.' % 
-                                 metabolome_file)
-        else:
+        if not metabolome.is_valid():
             raise ValueError('Metabolome validation failed: %s' % 
                                 metabolome.validate())
 
+        metabolome.updated = True
+
     return metabolome       
 
 
@@ -2173,13 +2750,19 @@ def crud_host_epigenetics_raw_seq_set(session, prep, seq_file, md5sum, sample_id
 
     raw_file_name = os.path.basename(seq_file)
 
-    host_epigenetics_raw_seq_sets = group_osdf_objects(_get_epigenetics_raw_seq_sets(session, prep.id), 'comment')
-    host_epigenetics_raw_seq_sets = dict((os.path.basename(k), v) for (k,v)
-                                         in host_epigenetics_raw_seq_sets.items())
-    
-    host_epigenetics_raw_seq_set = host_epigenetics_raw_seq_sets.get(raw_file_name)
-    host_epigenetics_raw_seq_set = (cutlass.HostEpigeneticsRawSeqSet() if not host_epigenetics_raw_seq_set 
-                                     else host_epigenetics_raw_seq_set[0])
+    host_epigenetics_raw_seq_set = _get_ledger_object(seq_file, md5sum)
+
+    if not host_epigenetics_raw_seq_set:
+        host_epigenetics_raw_seq_sets = group_osdf_objects(get_osdf_children(prep,
+                                                                             ['host_epigenetics_raw_seq_set'],
+                                                                             lambda: _get_epigenetics_raw_seq_sets(session, prep.id)),
+                                                           'comment')
+        host_epigenetics_raw_seq_sets = dict((os.path.basename(k), v) for (k,v)
+                                             in host_epigenetics_raw_seq_sets.items())
+
+        host_epigenetics_raw_seq_set = host_epigenetics_raw_seq_sets.get(raw_file_name)
+        host_epigenetics_raw_seq_set = (cutlass.HostEpigeneticsRawSeqSet() if not host_epigenetics_raw_seq_set 
+                                         else host_epigenetics_raw_seq_set[0])
 
     req_metadata.update(conf.get('methylome'))
 
@@ -2194,24 +2777,24 @@ def crud_host_epigenetics_raw_seq_set(session, prep, seq_file, md5sum, sample_id
     req_metadata['tags'].append(metadata.get('diagnosis'))
 
     fields_to_update = get_fields_to_update(req_metadata, host_epigenetics_raw_seq_set)
+    if not fields_to_update:
+        _record_ledger_upload(host_epigenetics_raw_seq_set, seq_file, md5sum)
 
     map(lambda key: setattr(host_epigenetics_raw_seq_set, key, req_metadata.get(key)),
         fields_to_update)
 
+    host_epigenetics_raw_seq_set.updated = False
     if fields_to_update:
         host_epigenetics_raw_seq_set.subtype = "host"
         host_epigenetics_raw_seq_set.study = study_id
         host_epigenetics_raw_seq_set.links['sequenced_from'] = [prep.id]
 
-        if host_epigenetics_raw_seq_set.is_valid():
-            success = host_epigenetics_raw_seq_set.save()
-            if not success:
-                raise ValueError('Saving host_epigenetics_raw_seq_set %s failed.' % 
-                                 seq_file)        
-        else:
+        if not host_epigenetics_raw_seq_set.is_valid():
             raise ValueError('HostEpigeneticsRawSeqSet validation failed: %s' % 
                              host_epigenetics_raw_seq_set.validate())
 
+        host_epigenetics_raw_seq_set.updated = True
+
     return host_epigenetics_raw_seq_set
 
 
@@ -2240,13 +2823,18 @@ def crud_host_variant_call(session, seq_set, variant_file, md5sum, study_id, con
  
     raw_file_name = os.path.splitext(os.path.basename(variant_file.replace('.gz', '')))[0]
 
-    host_variant_calls = group_osdf_objects(_get_host_variant_calls(session, seq_set.id), 'comment')
-    host_variant_calls = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                               in host_variant_calls.items())
-    
-    host_variant_call = host_variant_calls.get(raw_file_name)
-    host_variant_call = (cutlass.HostVariantCall() if not host_variant_call
-                         else host_variant_call[0])
+    host_variant_call = _get_ledger_object(variant_file, md5sum)
+
+    if not host_variant_call:
+        host_variant_calls = group_osdf_objects(get_osdf_children(seq_set, ['host_variant_call'],
+                                                                lambda: _get_host_variant_calls(session, seq_set.id)),
+                                              'comment')
+        host_variant_calls = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                                   in host_variant_calls.items())
+
+        host_variant_call = host_variant_calls.get(raw_file_name)
+        host_variant_call = (cutlass.HostVariantCall() if not host_variant_call
+                             else host_variant_call[0])
 
     req_metadata.update(conf.get('variant_call'))
 
@@ -2261,6 +2849,8 @@ def crud_host_variant_call(session, seq_set, variant_file, md5sum, study_id, con
     req_metadata['tags'].append(metadata.get('diagnosis'))
 
     fields_to_update = get_fields_to_update(req_metadata, host_variant_call)
+    if not fields_to_update:
+        _record_ledger_upload(host_variant_call, variant_file, md5sum)
 
     map(lambda key: setattr(host_variant_call, key, req_metadata.get(key)),
         fields_to_update)
@@ -2306,17 +2896,22 @@ def crud_sixs_trimmed_seq_set(dcc_parent, md5sum, conf, metadata, url_param='_ur
     sixs_trimmed_fname = os.path.basename(seq_file)
     data_type = metadata.get('data_type')
 
-    sixs_trimmed_seqs = group_osdf_objects([trim_seq for trim_seq in dcc_parent.children(flatten=True) if 
-                                            isinstance(trim_seq, cutlass.SixteenSTrimmedSeqSet)], 
-                                           url_param)
-    sixs_trimmed_seqs = dict((os.path.basename(k), v) for (k,v)
-                             in sixs_trimmed_seqs.items())
-    sixs_trimmed_seq = sixs_trimmed_seqs.get(sixs_trimmed_fname)
+    sixs_trimmed_seq = _get_ledger_object(seq_file, md5sum)
 
-    if sixs_trimmed_seq:
-        sixs_trimmed_seq = sixs_trimmed_seq[0]
-    else:
-        sixs_trimmed_seq = cutlass.SixteenSTrimmedSeqSet()
+    if not sixs_trimmed_seq:
+        sixs_trimmed_seqs = get_osdf_children(dcc_parent, ['16s_trimmed_seq_set'],
+                                              lambda: dcc_parent.children(flatten=True))
+        sixs_trimmed_seqs = group_osdf_objects([trim_seq for trim_seq in sixs_trimmed_seqs if 
+                                                isinstance(trim_seq, cutlass.SixteenSTrimmedSeqSet)], 
+                                               url_param)
+        sixs_trimmed_seqs = dict((os.path.basename(k), v) for (k,v)
+                                 in sixs_trimmed_seqs.items())
+        sixs_trimmed_seq = sixs_trimmed_seqs.get(sixs_trimmed_fname)
+
+        if sixs_trimmed_seq:
+            sixs_trimmed_seq = sixs_trimmed_seq[0]
+        else:
+            sixs_trimmed_seq = cutlass.SixteenSTrimmedSeqSet()
 
     req_metadata.update(conf.get('amplicon_trimmed'))
 
@@ -2325,81 +2920,23 @@ def crud_sixs_trimmed_seq_set(dcc_parent, md5sum, conf, metadata, url_param='_ur
     req_metadata['checksums'] = { "md5": md5sum }
 
     fields_to_update = get_fields_to_update(req_metadata, sixs_trimmed_seq)
+    if not fields_to_update:
+        _record_ledger_upload(sixs_trimmed_seq, seq_file, md5sum)
+
     map(lambda key: setattr(sixs_trimmed_seq, key, req_metadata.get(key)),
         fields_to_update)
 
     sixs_trimmed_seq.updated = False
     if fields_to_update:
-        sixs_trimmed_seq.updated = True
         sixs_trimmed_seq.links['computed_from'] = [dcc_parent.id]
 
-        if sixs_trimmed_seq.is_valid():
-            success = sixs_trimmed_seq.save()
-            if not success:
-                raise ValueError('Saving 16S trimmed seq %s failed.' %
-                                 req_metadata.get('local_file'))
-        else:
+        if not sixs_trimmed_seq.is_valid():
             raise ValueError('16S trimmed sequence set validation failed: %s' % 
                              sixs_trimmed_seq.validate())
 
-    return sixs_trimmed_seq
-
-
-def crud_viral_seq_set(dcc_parent, viral_seq_file, md5sum, conf, metadata, url_param='_urls'):
-    """Creates or updates an iHMP OSDF ViralSeqSet record.
-
-    Args:
-        dcc_parent (cutlass.<SEQ OR ASSAY PREP OBJECTS>): Any OSDF sequence set object 
-            or an assay prep from which an abundance matrice may be derived.
-             (i.e. WgsRawSeqSet or HostAssayPrep)
-        viral_seq_file (string): Path the viral sequences file to be uploaded.
-        md5sum (string): md5 checksum for the associated sequence file.
-        conf (dict): Config dictionary containing some "hard-coded" pieces of
-            metadata assocaited with all transcriptomes
-        metadata (pandas.Series): Metadata associated with this transcriptome
-
-    Requires:
-        None
-
-    Returns:
-        cutlass.ViralSeqSet: Cutlass object representation of the viral sequences
-    """
-    req_metadata = {}
-    
-    viral_seq_fname = os.path.basename(viral_seq_file)
-
-    viral_seqs = group_osdf_objects([trim_seq for trim_seq in dcc_parent.children(flatten=True) if 
-                                     isinstance(trim_seq, cutlass.SixteenSTrimmedSeqSet)], 
-                                    url_param)
-    viral_seqs = dict((os.path.basename(k), v) for (k,v)
-                      in sixs_trimmed_seqs.items())
-    viral_seq = viral_seqs.get(viral_seq_fname)
-
-    viral_seq = viral_seq[0] if viral_seq else cutlass.ViralSeqSet()
-
-    req_metadata.update(conf.get('viral_seq_set'))
-
-    req_metadata['local_file'] = viral_seq_file
-    req_metadata['size'] =  os.path.getsize(viral_seq_file)
-    req_metadata['checksums'] = { "md5": md5sum }
-
-    fields_to_update = get_fields_to_update(req_metadata, viral_seq)
-    map(lambda key: setattr(viral_seq, key, req_metadata.get(key)),
-        fields_to_update)
-
-    if fields_to_update:
-        viral_seq.links['computed_from'] = [dcc_parent.id]
-
-        if viral_seq.is_valid():
-            success = viral_seq.save()
-            if not success:
-                raise ValueError('Saving viral seq %s failed.' %
-                                 req_metadata.get('local_file'))
-        else:
-            raise ValueError('Viral seq set validation failed: %s' % 
-                             viral_seq.validate())
+        sixs_trimmed_seq.updated = True
 
-    return viral_seq
+    return sixs_trimmed_seq
 
 
 def crud_abundance_matrix(session, dcc_parent, abund_file, md5sum, sample_id, 
@@ -2434,16 +2971,21 @@ def crud_abundance_matrix(session, dcc_parent, abund_file, md5sum, sample_id,
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    abund_matrices = group_osdf_objects(_get_abund_matrices(session, dcc_parent.id), url_param)
-
-    abund_matrices = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                           in abund_matrices.items())
-    abund_matrix = abund_matrices.get(abund_fname)
+    abund_matrix = _get_ledger_object(abund_file, md5sum)
 
     if not abund_matrix:
-        abund_matrix = cutlass.AbundanceMatrix()
-    else:
-        abund_matrix = abund_matrix[0]
+        abund_matrices = group_osdf_objects(get_osdf_children(dcc_parent, ['abundance_matrix'],
+                                                             lambda: _get_abund_matrices(session, dcc_parent.id)),
+                                            url_param)
+
+        abund_matrices = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                               in abund_matrices.items())
+        abund_matrix = abund_matrices.get(abund_fname)
+
+        if not abund_matrix:
+            abund_matrix = cutlass.AbundanceMatrix()
+        else:
+            abund_matrix = abund_matrix[0]
 
     req_metadata.update(conf.get('abundance_matrix'))
     req_metadata['local_file'] = abund_file
@@ -2490,6 +3032,9 @@ def crud_abundance_matrix(session, dcc_parent, abund_file, md5sum, sample_id,
 
 
     fields_to_update = get_fields_to_update(req_metadata, abund_matrix)
+    if not fields_to_update:
+        _record_ledger_upload(abund_matrix, abund_file, md5sum)
+
     map(lambda key: setattr(abund_matrix, key, req_metadata.get(key)),
         fields_to_update)
 
@@ -2536,17 +3081,21 @@ def crud_viral_seq_set(raw_seq_set, seq_file, md5sum, sample_id, conf, metadata)
     ## Setup our 'static' metadata pulled from our YAML config
     req_metadata = {}
 
-    viromes = group_osdf_objects(raw_seq_set.viral_seq_sets(),
-                                 'urls')
-    viromes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
-                   in viromes.items())
-    
-    virome = viromes.get(raw_file_name)
+    virome = _get_ledger_object(raw_file, md5sum)
 
-    if not virome:  
-         virome = cutlass.ViralSeqSet()
-    else:
-         virome = virome[0]
+    if not virome:
+        viromes = group_osdf_objects(get_osdf_children(raw_seq_set, ['viral_seq_set'],
+                                                       raw_seq_set.viral_seq_sets),
+                                     'urls')
+        viromes = dict((os.path.splitext(os.path.basename(k))[0], v) for (k,v) 
+                       in viromes.items())
+
+        virome = viromes.get(raw_file_name)
+
+        if not virome:  
+             virome = cutlass.ViralSeqSet()
+        else:
+             virome = virome[0]
 
     req_metadata.update(conf.get('virome'))
     req_metadata['checksums'] = { "md5": md5sum }
@@ -2555,6 +3104,9 @@ def crud_viral_seq_set(raw_seq_set, seq_file, md5sum, sample_id, conf, metadata)
     req_metadata['tags'] = []
 
     fields_to_update = get_fields_to_update(req_metadata, virome)
+    if not fields_to_update:
+        _record_ledger_upload(virome, raw_file, md5sum)
+
     map(lambda key: setattr(virome, key, req_metadata.get(key)),
         fields_to_update)
 
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.dcc_cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A local SQLite mirror of an iHMP OSDF study subtree. The mirror is bulk-loaded
+once per upload run and kept in sync as objects are saved so that the
+parent -> child lookups made while uploading to the DCC can be answered
+without a round trip to OSDF.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import itertools
+import json
+import os
+import sqlite3
+import threading
+
+import cutlass
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    node_type TEXT NOT NULL,
+    name TEXT,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    id TEXT NOT NULL,
+    link_type TEXT NOT NULL,
+    parent_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_parent_idx ON links (parent_id, link_type);
+CREATE INDEX IF NOT EXISTS links_id_idx ON links (id);
+"""
+
+## Mapping of OSDF node types to the cutlass class used to load them.
+OSDF_NODE_CLASSES = {
+    'study': 'Study',
+    'subject': 'Subject',
+    'subject_attr': 'SubjectAttribute',
+    'visit': 'Visit',
+    'visit_attr': 'VisitAttribute',
+    'sample': 'Sample',
+    'sample_attr': 'SampleAttribute',
+    'wgs_dna_prep': 'WgsDnaPrep',
+    '16s_dna_prep': 'SixteenSDnaPrep',
+    'host_seq_prep': 'HostSeqPrep',
+    'host_assay_prep': 'HostAssayPrep',
+    'microb_assay_prep': 'MicrobiomeAssayPrep',
+    'wgs_raw_seq_set': 'WgsRawSeqSet',
+    'wgs_raw_seq_set_private': 'WgsRawSeqSetPrivate',
+    'microb_transcriptomics_raw_seq_set': 'MicrobTranscriptomicsRawSeqSet',
+    '16s_raw_seq_set': 'SixteenSRawSeqSet',
+    '16s_trimmed_seq_set': 'SixteenSTrimmedSeqSet',
+    'host_wgs_raw_seq_set': 'HostWgsRawSeqSet',
+    'host_transcriptomics_raw_seq_set': 'HostTranscriptomicsRawSeqSet',
+    'host_epigenetics_raw_seq_set': 'HostEpigeneticsRawSeqSet',
+    'host_variant_call': 'HostVariantCall',
+    'viral_seq_set': 'ViralSeqSet',
+    'abundance_matrix': 'AbundanceMatrix',
+    'proteome': 'Proteome',
+    'metabolome': 'Metabolome',
+    'serology': 'Serology',
+}
+
+## The linkage fields children use to point back at a parent of the given
+## node type. Anything not listed here is a prep, sequence set or product.
+OSDF_CHILD_LINKS = {
+    'study': ['participates_in'],
+    'subject': ['associated_with', 'by'],
+    'visit': ['associated_with', 'collected_during'],
+    'sample': ['associated_with', 'prepared_from'],
+    'subject_attr': [],
+    'visit_attr': [],
+    'sample_attr': [],
+}
+OSDF_PRODUCT_LINKS = ['sequenced_from', 'derived_from', 'computed_from']
+
+## Meta fields that act as the local identifier of a node (in order of
+## preference).
+OSDF_NAME_FIELDS = ['rand_subject_id', 'visit_id', 'prep_id', 'name', 'comment']
+
+## Meta fields holding file URL's for a node.
+OSDF_URL_FIELDS = ['urls', 'raw_url']
+
+## sqlite3 connections are shared across the upload worker threads so all
+## writes are serialized through this lock.
+_cache_lock = threading.RLock()
+
+
+def open_osdf_cache(cache_file):
+    """Opens (creating if needed) the SQLite database housing the local
+    mirror of the OSDF study subtree.
+
+    Args:
+        cache_file (string): Path to the SQLite database file.
+
+    Requires:
+        None
+
+    Returns:
+        sqlite3.Connection: A connection to the local OSDF mirror.
+
+    Example:
+        from hmp2_workflows.utils import dcc_cache
+
+        cache = dcc_cache.open_osdf_cache('/tmp/ibdmdb_osdf.sqlite')
+    """
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache = sqlite3.connect(cache_file, check_same_thread=False)
+    cache.executescript(CACHE_SCHEMA)
+
+    return cache
+
+
+def get_doc_name(doc):
+    """Returns the field used to identify the provided OSDF document locally
+    (rand_subject_id, visit_id, prep_id, etc.)
+
+    Args:
+        doc (dict): OSDF document.
+
+    Requires:
+        None
+
+    Returns:
+        string: The local identifier for the document if one exists.
+    """
+    meta = doc.get('meta', {})
+    return next((meta.get(field) for field in OSDF_NAME_FIELDS
+                 if meta.get(field)), None)
+
+
+def get_doc_urls(doc):
+    """Returns all file URL's attached to the provided OSDF document.
+
+    Args:
+        doc (dict): OSDF document.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of all URL's found in the document.
+    """
+    meta = doc.get('meta', {})
+    urls = []
+
+    for field in OSDF_URL_FIELDS:
+        field_urls = meta.get(field) or []
+        if isinstance(field_urls, basestring):
+            field_urls = [field_urls]
+        urls.extend(field_urls)
+
+    return urls
+
+
+def cache_osdf_docs(cache, docs):
+    """Inserts or replaces the provided OSDF documents in the local mirror.
+
+    Args:
+        cache (sqlite3.Connection): Connection to the local OSDF mirror.
+        docs (list): A list of OSDF documents (as returned from an OQL
+            query) to store.
+
+    Requires:
+        None
+
+    Returns:
+        int: The number of documents stored.
+    """
+    doc_count = 0
+
+    with _cache_lock, cache:
+        for doc in docs:
+            node_id = doc['id']
+
+            cache.execute('DELETE FROM links WHERE id = ?', (node_id,))
+            cache.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)',
+                          (node_id, doc['node_type'], get_doc_name(doc),
+                           json.dumps(doc)))
+
+            for (link_type, parent_ids) in doc.get('linkage', {}).iteritems():
+                cache.executemany('INSERT INTO links VALUES (?, ?, ?)',
+                                  [(node_id, link_type, parent_id) for
+                                   parent_id in parent_ids])
+
+            doc_count += 1
+
+    return doc_count
+
+
+def cache_osdf_object(cache, osdf_obj):
+    """Updates the local mirror with a freshly saved cutlass object.
+
+    Args:
+        cache (sqlite3.Connection): Connection to the local OSDF mirror.
+        osdf_obj (cutlass.*): A saved cutlass object.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    doc = json.loads(osdf_obj.to_json())
+    doc['id'] = osdf_obj.id
+
+    cache_osdf_docs(cache, [doc])
+
+
+def load_osdf_doc(doc):
+    """Converts an OSDF document into its cutlass object representation.
+
+    Args:
+        doc (dict): OSDF document.
+
+    Requires:
+        None
+
+    Returns:
+        cutlass.*: The cutlass object represented by the document.
+    """
+    node_type = doc['node_type']
+    cls = getattr(cutlass, OSDF_NODE_CLASSES[node_type])
+
+    loader = getattr(cls, 'load_%s' % node_type, None)
+    if not loader:
+        loader = next(getattr(cls, attr) for attr in dir(cls)
+                      if attr.startswith('load_'))
+
+    return loader(doc)
+
+
+def get_cached_docs(cache, parent_id, node_types=None):
+    """Retrieves the OSDF documents linked to the provided parent ID from
+    the local mirror.
+
+    Args:
+        cache (sqlite3.Connection): Connection to the local OSDF mirror.
+        parent_id (string): OSDF ID of the parent node.
+        node_types (list): Restrict the children returned to these node
+            types.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of OSDF documents linked to the parent node.
+    """
+    query = ('SELECT DISTINCT nodes.doc FROM links JOIN nodes ON '
+             'links.id = nodes.id WHERE links.parent_id = ?')
+    params = [parent_id]
+
+    if node_types:
+        query += ' AND nodes.node_type IN (%s)' % ','.join('?' * len(node_types))
+        params.extend(node_types)
+
+    with _cache_lock:
+        rows = cache.execute(query, params).fetchall()
+
+    return [json.loads(row[0]) for row in rows]
+
+
+def get_cached_objects(cache, parent_id, node_types=None):
+    """Retrieves the cutlass objects linked to the provided parent ID from
+    the local mirror.
+
+    Args:
+        cache (sqlite3.Connection): Connection to the local OSDF mirror.
+        parent_id (string): OSDF ID of the parent node.
+        node_types (list): Restrict the children returned to these node
+            types.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of cutlass objects linked to the parent node.
+    """
+    return [load_osdf_doc(doc) for doc in
+            get_cached_docs(cache, parent_id, node_types)]
+
+
+def oql_query_all(osdf, namespace, query):
+    """Pages through all results of the provided OQL query.
+
+    Args:
+        osdf (osdf.OSDF): OSDF connection (session.get_osdf())
+        namespace (string): OSDF namespace to query.
+        query (string): The OQL query.
+
+    Requires:
+        None
+
+    Returns:
+        iterator: An iterator over all OSDF documents matching the query.
+    """
+    seen_count = 0
+
+    for page_no in itertools.count(1):
+        res = osdf.oql_query(namespace, query, page=page_no)
+
+        for doc in res['results']:
+            yield doc
+
+        seen_count += len(res['results'])
+
+        if not res['results'] or seen_count >= res['result_count']:
+            break
+
+
+def _get_linked_docs(osdf, namespace, parent_ids, link_type, batch_size):
+    """Retrieves all OSDF documents linked to any of the provided parent
+    ID's through the given link type. Parent ID's are OR'd together in
+    batches so a whole level of the tree is fetched in a handful of queries.
+
+    Args:
+        osdf (osdf.OSDF): OSDF connection (session.get_osdf())
+        namespace (string): OSDF namespace to query.
+        parent_ids (list): OSDF ID's of the parent nodes.
+        link_type (string): The linkage field pointing at the parents.
+        batch_size (int): The number of parent ID's to query at once.
+
+    Requires:
+        None
+
+    Returns:
+        iterator: An iterator over all linked OSDF documents.
+    """
+    for idx in xrange(0, len(parent_ids), batch_size):
+        batch_ids = parent_ids[idx:idx+batch_size]
+        query = ' || '.join('"%s"[linkage.%s]' % (parent_id, link_type)
+                            for parent_id in batch_ids)
+
+        for doc in oql_query_all(osdf, namespace, query):
+            yield doc
+
+
+def load_study_subtree(cache, session, study_id, namespace='ihmp', batch_size=50):
+    """Bulk-loads every node beneath the provided study into the local
+    mirror. The tree is walked one level at a time with each level fetched
+    using batched OQL queries rather than one query per parent node. Any
+    previously mirrored nodes are discarded.
+
+    Args:
+        cache (sqlite3.Connection): Connection to the local OSDF mirror.
+        session (cutlass.iHMPSession): Session object that represents a
+            connection to the iHMP OSDF instance.
+        study_id (string): OSDF ID of the study to mirror.
+        namespace (string): OSDF namespace to query.
+        batch_size (int): The number of parent ID's to include per query.
+
+    Requires:
+        None
+
+    Returns:
+        int: The number of nodes mirrored.
+
+    Example:
+        import cutlass
+
+        from hmp2_workflows.utils import dcc_cache
+
+        session = cutlass.iHMPSession('user', 'pass')
+        cache = dcc_cache.open_osdf_cache('/tmp/ibdmdb_osdf.sqlite')
+        dcc_cache.load_study_subtree(cache, session, study.id)
+    """
+    osdf = session.get_osdf()
+
+    with _cache_lock, cache:
+        for table in ['nodes', 'links']:
+            cache.execute('DELETE FROM %s' % table)
+
+    node_count = 0
+    seen_ids = set([study_id])
+    frontier = [(study_id, 'study')]
+
+    while frontier:
+        links_to_parents = {}
+        for (parent_id, node_type) in frontier:
+            for link_type in OSDF_CHILD_LINKS.get(node_type, OSDF_PRODUCT_LINKS):
+                links_to_parents.setdefault(link_type, []).append(parent_id)
+
+        docs = []
+        for (link_type, parent_ids) in links_to_parents.iteritems():
+            for doc in _get_linked_docs(osdf, namespace, parent_ids,
+                                        link_type, batch_size):
+                if doc['id'] not in seen_ids:
+                    seen_ids.add(doc['id'])
+                    docs.append(doc)
+
+        node_count += cache_osdf_docs(cache, docs)
+        frontier = [(doc['id'], doc['node_type']) for doc in docs]
+
+    return node_count
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.dcc_journal
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An append-only journal of work completed against the DCC. Every record is a
+single tab-delimited line (node type, local key, DCC ID, checksum, time) 
+written and flushed to disk as soon as the work it describes succeeds, so 
+an upload that dies part way through can be restarted and fast-forwarded 
+past everything already done.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import datetime
+import os
+import threading
+
+
+JOURNAL_FIELDS = ['node_type', 'key', 'id', 'checksum', 'recorded']
+
+## Records are appended from the upload worker threads so writes are 
+## serialized through this lock.
+_journal_lock = threading.RLock()
+
+
+def read_upload_journal(journal_file):
+    """Reads all complete records from an upload journal. A partially 
+    written trailing line (i.e. the process died mid-write) is ignored.
+
+    Args:
+        journal_file (string): Path to the upload journal.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The latest journal record for every (node type, key) pair.
+
+    Example:
+        from hmp2_workflows.utils import dcc_journal
+
+        records = dcc_journal.read_upload_journal('/tmp/ibdmdb_upload.journal')
+    """
+    records = {}
+
+    if not os.path.exists(journal_file):
+        return records
+
+    with open(journal_file) as journal_fh:
+        for line in journal_fh:
+            if not line.endswith('\n'):
+                break
+
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != len(JOURNAL_FIELDS):
+                continue
+
+            record = dict(zip(JOURNAL_FIELDS, fields))
+            records[(record['node_type'], record['key'])] = record
+
+    return records
+
+
+def open_upload_journal(journal_file):
+    """Opens an upload journal for appending, creating it if it does not 
+    exist. Any partially written trailing record is truncated so that new
+    records always start on a fresh line.
+
+    Args:
+        journal_file (string): Path to the upload journal.
+
+    Requires:
+        None
+
+    Returns:
+        file: A file handle opened for appending to the journal.
+    """
+    journal_dir = os.path.dirname(os.path.abspath(journal_file))
+    if not os.path.exists(journal_dir):
+        os.makedirs(journal_dir)
+
+    if os.path.exists(journal_file):
+        with open(journal_file, 'rb+') as journal_fh:
+            contents = journal_fh.read()
+            if contents and not contents.endswith('\n'):
+                journal_fh.truncate(contents.rfind('\n') + 1)
+
+    return open(journal_file, 'a')
+
+
+def append_journal_record(journal_fh, node_type, key, dcc_id, checksum):
+    """Appends a single record to the upload journal and forces it to disk.
+
+    Args:
+        journal_fh (file): Handle returned by open_upload_journal.
+        node_type (string): The OSDF node type (or other unit of work) 
+            completed.
+        key (string): The local key identifying the completed work.
+        dcc_id (string): The DCC ID of the saved object if any.
+        checksum (string): Checksum of the local data the work was 
+            completed for.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The record written to the journal.
+    """
+    record = dict(zip(JOURNAL_FIELDS,
+                      [node_type, key, dcc_id or '', checksum or '',
+                       datetime.datetime.now().isoformat()]))
+
+    with _journal_lock:
+        journal_fh.write("\t".join(record[field] for field in JOURNAL_FIELDS) + "\n")
+        journal_fh.flush()
+        os.fsync(journal_fh.fileno())
+
+    return record
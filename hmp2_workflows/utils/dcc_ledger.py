@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.dcc_ledger
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A local ledger of files pushed to the DCC. Each file is recorded along with
+its mtime, size and md5 checksum at the time it was pushed and the OSDF
+document it was attached to. On subsequent uploads any file whose mtime,
+size and checksum still match the ledger can be skipped without fetching
+its DCC object.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    node_type TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    doc TEXT NOT NULL,
+    recorded TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_node_idx ON uploads (node_id);
+"""
+
+## The ledger is written to from the upload worker threads so all access is
+## serialized through this lock.
+_ledger_lock = threading.RLock()
+
+
+def open_upload_ledger(ledger_file):
+    """Opens (creating if needed) the SQLite database housing the upload
+    ledger.
+
+    Args:
+        ledger_file (string): Path to the SQLite database file.
+
+    Requires:
+        None
+
+    Returns:
+        sqlite3.Connection: A connection to the upload ledger.
+
+    Example:
+        from hmp2_workflows.utils import dcc_ledger
+
+        ledger = dcc_ledger.open_upload_ledger('/tmp/ibdmdb_uploads.sqlite')
+    """
+    ledger_dir = os.path.dirname(os.path.abspath(ledger_file))
+    if not os.path.exists(ledger_dir):
+        os.makedirs(ledger_dir)
+
+    ledger = sqlite3.connect(ledger_file, check_same_thread=False)
+    ledger.executescript(LEDGER_SCHEMA)
+
+    return ledger
+
+
+def lookup_upload(ledger, local_file, md5sum):
+    """Checks whether the provided file has already been pushed to the DCC
+    unchanged. A file is considered unchanged if its mtime and size match
+    those recorded when it was pushed and the provided checksum matches the
+    checksum that was pushed.
+
+    Args:
+        ledger (sqlite3.Connection): Connection to the upload ledger.
+        local_file (string): Path to the local file.
+        md5sum (string): The current md5 checksum of the file.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The OSDF document the file was last pushed with or None if
+            the file is not in the ledger or has changed since.
+    """
+    local_file = os.path.abspath(local_file)
+
+    with _ledger_lock:
+        row = ledger.execute('SELECT mtime, size, md5, doc FROM uploads '
+                             'WHERE path = ?', (local_file,)).fetchone()
+
+    if not row or row[2] != md5sum:
+        return None
+
+    try:
+        file_stat = os.stat(local_file)
+    except OSError:
+        return None
+
+    if file_stat.st_size != row[1] or file_stat.st_mtime != row[0]:
+        return None
+
+    return json.loads(row[3])
+
+
+def record_upload(ledger, local_file, md5sum, doc):
+    """Records that the provided file has been pushed to the DCC as part of
+    the supplied OSDF document.
+
+    Args:
+        ledger (sqlite3.Connection): Connection to the upload ledger.
+        local_file (string): Path to the local file.
+        md5sum (string): The md5 checksum that was pushed with the file.
+        doc (dict): The OSDF document the file is attached to.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    local_file = os.path.abspath(local_file)
+    file_stat = os.stat(local_file)
+
+    with _ledger_lock, ledger:
+        ledger.execute('INSERT OR REPLACE INTO uploads VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?, ?)',
+                       (local_file, file_stat.st_mtime, file_stat.st_size,
+                        md5sum, doc['node_type'], doc['id'], json.dumps(doc),
+                        datetime.datetime.now().isoformat()))
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.fastq
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Streaming FASTQ utilities. The main entry point splits an interleaved (or
+name-sorted) FASTQ file into mate 1, mate 2 and orphan files in a single
+pass, reading and writing gzip'd files through external (parallel)
+compressors.
+
+Unsorted input can be grouped by read name with a bounded-memory external 
+merge sort: only a (name hash, offset, length) index entry per read is 
+sorted, in fixed-size runs spilled to disk, and the reads themselves are 
+fetched by seeking into the (decompressed) input once the runs are merged.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import collections
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+from distutils.spawn import find_executable
+
+from hmp2_workflows.utils.files import get_compress_cmd
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+## Each read is indexed by the 64-bit hash of its name, its offset and its 
+## length in the decompressed input. 
+INDEX_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<u8'), ('length', '<u4')])
+
+## Number of index entries sorted in memory at once (~20 bytes each).
+SORT_BUFFER_RECORDS = 5000000
+
+SPLIT_STATS_FIELDS = ['reads', 'bytes', 'pairs', 'orphans', 'mate_1_bytes',
+                      'mate_2_bytes', 'orphan_bytes']
+
+
+class FastqWriter(object):
+    """A FASTQ output file. Files ending in .gz are written through an
+    external compressor so compression runs in parallel with parsing.
+    """
+
+    def __init__(self, output_file, threads=1, level=None):
+        self.bytes = 0
+        self._out_fh = open(output_file, 'wb')
+        self._proc = None
+
+        if output_file.endswith('.gz'):
+            self._proc = subprocess.Popen(get_compress_cmd('pigz', threads, level),
+                                          stdin=subprocess.PIPE,
+                                          stdout=self._out_fh,
+                                          bufsize=BUFFER_SIZE)
+            self._fh = self._proc.stdin
+        else:
+            self._fh = self._out_fh
+
+    def write(self, record):
+        """Writes a FASTQ record, a list of its four lines."""
+        record_str = "".join(record)
+        self.bytes += len(record_str)
+        self._fh.write(record_str)
+
+    def close(self):
+        """Flushes and closes the output file."""
+        if self._proc:
+            self._proc.stdin.close()
+            if self._proc.wait():
+                raise OSError('Compressing FASTQ output failed')
+
+        self._out_fh.close()
+
+
+def open_fastq(input_file):
+    """Opens a (possibly gzip'd) FASTQ file for reading. gzip'd files are
+    decompressed by pigz, or gzip if pigz is not installed, in a separate
+    process.
+
+    Args:
+        input_file (string): Path to the FASTQ file.
+
+    Requires:
+        None
+
+    Returns:
+        tuple: A file handle to read from and the decompression process (or
+            None if the file is not compressed).
+    """
+    if not input_file.endswith('.gz'):
+        return (open(input_file, 'rb', BUFFER_SIZE), None)
+
+    decompressor = 'pigz' if find_executable('pigz') else 'gzip'
+    proc = subprocess.Popen([decompressor, '-dc', input_file],
+                            stdout=subprocess.PIPE,
+                            bufsize=BUFFER_SIZE)
+
+    return (proc.stdout, proc)
+
+
+def read_fastq_records(fastq_fh):
+    """Yields the records in an open FASTQ file.
+
+    Args:
+        fastq_fh (file): An open FASTQ file handle.
+
+    Requires:
+        None
+
+    Returns:
+        generator: Each record as a list of its four lines.
+    """
+    while True:
+        header = fastq_fh.readline()
+        if not header:
+            break
+
+        record = [header, fastq_fh.readline(), fastq_fh.readline(),
+                  fastq_fh.readline()]
+        if not record[-1]:
+            raise ValueError('Truncated FASTQ record', header.strip())
+
+        yield record
+
+
+def get_read_name(header):
+    """Returns the name of a read and its mate number from a FASTQ header
+    line. Mate numbers are taken from a trailing /1 or /2 and are None if
+    the read name carries no such suffix.
+
+    Args:
+        header (string): The FASTQ header line.
+
+    Requires:
+        None
+
+    Returns:
+        tuple: The read name and mate number.
+    """
+    read_name = header[1:].split(None, 1)[0]
+
+    if read_name[-2:] in ('/1', '/2'):
+        return (read_name[:-2], int(read_name[-1]))
+
+    return (read_name, None)
+
+
+def get_name_hash(read_name):
+    """Returns a 64-bit hash of the provided read name.
+
+    Args:
+        read_name (string): The read name without any /1 or /2 suffix.
+
+    Requires:
+        None
+
+    Returns:
+        int: The hash of the read name.
+    """
+    return struct.unpack('<Q', hashlib.md5(read_name).digest()[:8])[0]
+
+
+def _write_sorted_run(index, run_dir):
+    """Sorts a block of index entries on name hash and writes them to a new
+    run file. The sort is stable so mates keep their input order.
+    """
+    index = index[np.argsort(index['hash'], kind='mergesort')]
+
+    (run_fd, run_file) = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    with os.fdopen(run_fd, 'wb') as run_fh:
+        index.tofile(run_fh)
+
+    return run_file
+
+
+def _read_sorted_run(run_file, block_records=65536):
+    """Yields (hash, offset, length) tuples from a sorted run file reading
+    a block of entries at a time.
+    """
+    with open(run_file, 'rb') as run_fh:
+        while True:
+            block = np.fromfile(run_fh, dtype=INDEX_DTYPE, count=block_records)
+            if not len(block):
+                break
+
+            for entry in block.tolist():
+                yield entry
+
+
+def sort_fastq_records(input_file, tmp_dir=None, 
+                       buffer_records=SORT_BUFFER_RECORDS):
+    """Yields the records of a FASTQ file grouped by read name so that
+    mates are adjacent, using bounded memory. A single pass over the input
+    builds an index of (name hash, offset, length) entries that is sorted 
+    in runs of buffer_records entries spilled to disk. gzip'd input is 
+    decompressed to a scratch file during that pass so that reads can be 
+    fetched by seeking once the runs are k-way merged. Reads sharing a 
+    name hash are ordered by name, then input order, so hash collisions 
+    never split a pair.
+
+    Args:
+        input_file (string): Path to the FASTQ file.
+        tmp_dir (string): Directory to write scratch files under. Defaults 
+            to the system temp directory.
+        buffer_records (int): Number of index entries sorted in memory at
+            once.
+
+    Requires:
+        None
+
+    Returns:
+        generator: Each record as a list of its four lines.
+
+    Example:
+        from hmp2_workflows.utils import fastq
+
+        for record in fastq.sort_fastq_records('/tmp/foo.fastq.gz', '/scratch'):
+            print record[0]
+    """
+    scratch_dir = tempfile.mkdtemp(dir=tmp_dir)
+
+    try:
+        (in_fh, in_proc) = open_fastq(input_file)
+
+        data_file = input_file
+        data_fh = None
+        if in_proc:
+            data_file = os.path.join(scratch_dir, 'reads.fastq')
+            data_fh = open(data_file, 'wb', BUFFER_SIZE)
+
+        run_files = []
+        index = np.empty(buffer_records, dtype=INDEX_DTYPE)
+        (num_entries, offset) = (0, 0)
+
+        for record in read_fastq_records(in_fh):
+            record_len = sum(len(line) for line in record)
+            index[num_entries] = (get_name_hash(get_read_name(record[0])[0]),
+                                  offset, record_len)
+            num_entries += 1
+            offset += record_len
+
+            if data_fh:
+                data_fh.write("".join(record))
+
+            if num_entries == buffer_records:
+                run_files.append(_write_sorted_run(index, scratch_dir))
+                num_entries = 0
+
+        if num_entries:
+            run_files.append(_write_sorted_run(index[:num_entries], scratch_dir))
+        del index
+
+        if in_proc and in_proc.wait():
+            raise OSError('Decompressing FASTQ input failed', input_file)
+        in_fh.close()
+        if data_fh:
+            data_fh.close()
+
+        merged_entries = heapq.merge(*[_read_sorted_run(run_file) 
+                                       for run_file in run_files])
+
+        with open(data_file, 'rb') as reads_fh:
+            for (_name_hash, entries) in itertools.groupby(merged_entries, 
+                                                           lambda entry: entry[0]):
+                records = []
+                for (_name_hash, read_offset, read_len) in entries:
+                    reads_fh.seek(read_offset)
+                    records.append(reads_fh.read(read_len).splitlines(True))
+
+                if len(records) > 2:
+                    records.sort(key=lambda record: get_read_name(record[0])[0])
+
+                for record in records:
+                    yield record
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def split_interleaved_fastq(input_file, mate_1_file, mate_2_file,
+                            orphan_file=None, threads=1, level=None,
+                            sort=False, tmp_dir=None, 
+                            buffer_records=SORT_BUFFER_RECORDS):
+    """Splits an interleaved or name-sorted FASTQ file into mate 1, mate 2
+    and orphan FASTQ files in a single pass. Consecutive reads sharing a
+    name are paired; any read without a mate next to it is an orphan. Reads
+    with a /1 or /2 suffix are routed to the matching mate file, otherwise
+    the first read of a pair is treated as mate 1.
+
+    Args:
+        input_file (string): Path to the interleaved FASTQ file.
+        mate_1_file (string): Path to the mate 1 output file.
+        mate_2_file (string): Path to the mate 2 output file.
+        orphan_file (string): Path to the orphans output file. Orphans are
+            dropped if not provided.
+        threads (int): Number of threads given to each output compressor.
+        level (int): gzip compression level.
+        sort (boolean): Group reads by name with sort_fastq_records before
+            splitting; needed when mates are not already adjacent.
+        tmp_dir (string): Directory to write sort scratch files under.
+        buffer_records (int): Number of index entries sorted in memory at
+            once.
+
+    Requires:
+        None
+
+    Returns:
+        collections.OrderedDict: Read and byte counts keyed on the fields
+            in SPLIT_STATS_FIELDS.
+
+    Example:
+        from hmp2_workflows.utils import fastq
+
+        stats = fastq.split_interleaved_fastq('/tmp/foo.fastq.gz',
+                                              '/tmp/foo_R1.fastq.gz',
+                                              '/tmp/foo_R2.fastq.gz',
+                                              '/tmp/foo_orphans.fastq.gz',
+                                              threads=4)
+    """
+    stats = collections.OrderedDict((field, 0) for field in SPLIT_STATS_FIELDS)
+
+    mate_1_writer = FastqWriter(mate_1_file, threads, level)
+    mate_2_writer = FastqWriter(mate_2_file, threads, level)
+    orphan_writer = FastqWriter(orphan_file, threads, level) if orphan_file else None
+
+    def _write_orphan(record):
+        stats['orphans'] += 1
+        if orphan_writer:
+            orphan_writer.write(record)
+
+    in_proc = None
+    if sort:
+        records = sort_fastq_records(input_file, tmp_dir, buffer_records)
+    else:
+        (in_fh, in_proc) = open_fastq(input_file)
+        records = read_fastq_records(in_fh)
+
+    prev_record = None
+    prev_name = None
+    for record in records:
+        stats['reads'] += 1
+        stats['bytes'] += sum(len(line) for line in record)
+        (read_name, mate) = get_read_name(record[0])
+
+        if prev_record and read_name == prev_name[0]:
+            if mate == 1 or prev_name[1] == 2:
+                (prev_record, record) = (record, prev_record)
+
+            mate_1_writer.write(prev_record)
+            mate_2_writer.write(record)
+            stats['pairs'] += 1
+
+            prev_record = None
+            prev_name = None
+        else:
+            if prev_record:
+                _write_orphan(prev_record)
+
+            prev_record = record
+            prev_name = (read_name, mate)
+
+    if prev_record:
+        _write_orphan(prev_record)
+
+    if not sort:
+        if in_proc and in_proc.wait():
+            raise OSError('Decompressing FASTQ input failed', input_file)
+        in_fh.close()
+
+    for writer in filter(None, [mate_1_writer, mate_2_writer, orphan_writer]):
+        writer.close()
+
+    stats['mate_1_bytes'] = mate_1_writer.bytes
+    stats['mate_2_bytes'] = mate_2_writer.bytes
+    stats['orphan_bytes'] = orphan_writer.bytes if orphan_writer else 0
+
+    return stats
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.file_index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A cached index of all files found under a directory tree. A tree is scanned
+once, level by level, with the directories of each level listed in parallel
+and the listing of every directory is persisted to a JSON manifest alongside
+the directory's mtime. Later scans only re-list directories whose mtime has
+changed and file pattern/extension queries are answered from memory rather
+than walking the tree again.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import hashlib
+import json
+import os
+import re
+import stat
+import time
+
+from multiprocessing.pool import ThreadPool
+
+
+## Per-user cache root; a directory shared between users (i.e. under /tmp)
+## would let anyone plant manifests or pickles that our workflows trust.
+USER_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                              os.path.join(os.path.expanduser('~'), '.cache'),
+                              'hmp2_workflows')
+
+DEFAULT_INDEX_DIR = os.path.join(USER_CACHE_DIR, 'file_index')
+
+## Directories modified this close (in seconds) to the time they were last
+## scanned are always re-listed; many filesystems (i.e. Lustre) only store
+## mtimes to the second.
+MTIME_RESOLUTION = 2
+
+## Indexes already loaded by this process keyed on root directory.
+_FILE_INDEXES = {}
+
+
+def make_private_dir(dir_path):
+    """Creates the provided directory accessible only by the current user. 
+    If the directory already exists it must be owned by the current user 
+    and must not be writable by anyone else.
+
+    Args:
+        dir_path (string): The directory to create or check.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the directory.
+    """
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, 0700)
+        return dir_path
+
+    dir_stat = os.stat(dir_path)
+    if (dir_stat.st_uid != os.getuid() or 
+        dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise OSError('Cache directory is not private to the current user', 
+                      dir_path)
+
+    return dir_path
+
+
+def _scandir(dir_path):
+    """Lists a directory returning the names of its files and its
+    subdirectories. Symlinks to directories are listed as files and not
+    followed, mirroring glob2.
+    """
+    try:
+        from os import scandir
+    except ImportError:
+        try:
+            from scandir import scandir
+        except ImportError:
+            scandir = None
+
+    files = []
+    subdirs = []
+
+    if scandir:
+        for entry in scandir(dir_path):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(dir_path):
+            entry_path = os.path.join(dir_path, name)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                subdirs.append(name)
+            else:
+                files.append(name)
+
+    return (sorted(files), sorted(subdirs))
+
+
+def _scan_dir(args):
+    """Lists a single directory of the tree, re-using the manifest entry
+    for the directory if its mtime is unchanged since the last scan.
+    """
+    (root, rel_dir, cached_entry, last_scan) = args
+    dir_path = os.path.join(root, rel_dir)
+
+    try:
+        mtime = os.stat(dir_path).st_mtime
+        if (cached_entry and cached_entry['mtime'] == mtime and
+            mtime < last_scan - MTIME_RESOLUTION):
+            return (rel_dir, cached_entry, False)
+
+        (files, subdirs) = _scandir(dir_path)
+    except OSError:
+        ## The directory was removed since its parent was listed.
+        return (rel_dir, None, True)
+
+    return (rel_dir, {'mtime': mtime, 'files': files, 'subdirs': subdirs}, True)
+
+
+def scan_tree(root, manifest=None, threads=8):
+    """Scans the provided directory tree one level at a time listing the
+    directories of each level in a pool of threads. If a manifest from a
+    previous scan is provided only directories whose mtime has changed are
+    listed again.
+
+    Args:
+        root (string): The directory to scan.
+        manifest (dict): Optional manifest returned by an earlier scan of
+            the same directory.
+        threads (int): Number of directories listed in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        dict: A manifest holding the scan time and the mtime, files and
+            subdirectories of each directory keyed on path relative to root.
+
+    Example:
+        from hmp2_workflows.utils import file_index
+
+        manifest = file_index.scan_tree('/seq/ibdmdb/processing')
+    """
+    cached_dirs = manifest.get('dirs', {}) if manifest else {}
+    last_scan = manifest.get('scan_time', 0) if manifest else 0
+
+    scan_time = time.time()
+    dirs = {}
+    listed_dirs = 0
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        level = ['']
+        while level:
+            results = pool.map(_scan_dir, [(root, rel_dir, cached_dirs.get(rel_dir),
+                                            last_scan) for rel_dir in level])
+
+            level = []
+            for (rel_dir, entry, listed) in results:
+                listed_dirs += listed
+                if entry is None:
+                    continue
+
+                dirs[rel_dir] = entry
+                level.extend(os.path.join(rel_dir, subdir) for subdir
+                             in entry['subdirs'])
+    finally:
+        pool.close()
+        pool.join()
+
+    return {'root': root, 'scan_time': scan_time, 'dirs': dirs,
+            'listed_dirs': listed_dirs}
+
+
+def get_index_file(root, index_dir=None):
+    """Returns the path of the manifest file for the provided directory.
+
+    Args:
+        root (string): The indexed directory.
+        index_dir (string): Directory housing manifests. Defaults to 
+            DEFAULT_INDEX_DIR which is created private to the current user.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the JSON manifest.
+    """
+    index_dir = index_dir if index_dir else make_private_dir(DEFAULT_INDEX_DIR)
+    return os.path.join(index_dir, "%s.json" %
+                        hashlib.md5(os.path.abspath(root)).hexdigest())
+
+
+def load_file_index(root, index_dir=None, refresh=False, threads=8):
+    """Returns the index of all files found under the provided directory.
+    The first call in a process loads the manifest persisted by any earlier
+    run, refreshes it by re-listing any directories modified since then and
+    saves it; later calls are answered from memory unless refresh is set.
+
+    Args:
+        root (string): The directory to index.
+        index_dir (string): Directory housing manifests.
+        refresh (boolean): Re-check the tree even if it has already been
+            indexed by this process.
+        threads (int): Number of directories listed in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The tree's manifest with an additional 'files' key holding
+            the path of every file relative to root.
+
+    Example:
+        from hmp2_workflows.utils import file_index
+
+        index = file_index.load_file_index('/seq/ibdmdb/processing')
+    """
+    root = os.path.abspath(root)
+    if root in _FILE_INDEXES and not refresh:
+        return _FILE_INDEXES[root]
+
+    index_file = get_index_file(root, index_dir)
+
+    manifest = _FILE_INDEXES.get(root)
+    if not manifest and os.path.exists(index_file):
+        with open(index_file) as index_fh:
+            manifest = json.load(index_fh)
+
+    manifest = scan_tree(root, manifest, threads)
+
+    if not os.path.exists(os.path.dirname(index_file)):
+        os.makedirs(os.path.dirname(index_file))
+
+    tmp_index_file = index_file + '.tmp'
+    with open(tmp_index_file, 'w') as index_fh:
+        json.dump(manifest, index_fh)
+    os.rename(tmp_index_file, index_file)
+
+    manifest['files'] = sorted(os.path.join(rel_dir, file_name) for (rel_dir, entry)
+                               in manifest['dirs'].iteritems()
+                               for file_name in entry['files'])
+    _FILE_INDEXES[root] = manifest
+
+    return manifest
+
+
+def _glob_to_regex(pattern):
+    """Translates a glob2-style pattern into a regular expression matched
+    against paths relative to the indexed directory. '**/' matches zero or
+    more directories and, as with glob, wildcards do not match names
+    beginning with '.'
+    """
+    regex = ''
+    idx = 0
+
+    while idx < len(pattern):
+        at_name_start = idx == 0 or pattern[idx - 1] == '/'
+
+        if pattern.startswith('**/', idx):
+            regex += r'(?:[^./][^/]*/)*'
+            idx += 3
+        elif pattern[idx] == '*':
+            regex += r'(?!\.)[^/]*' if at_name_start else r'[^/]*'
+            idx += 1
+        elif pattern[idx] == '?':
+            regex += r'[^./]' if at_name_start else r'[^/]'
+            idx += 1
+        elif pattern[idx] == '[' and ']' in pattern[idx + 2:]:
+            end = pattern.index(']', idx + 2)
+            char_class = pattern[idx + 1:end]
+            if char_class.startswith('!'):
+                char_class = '^' + char_class[1:]
+            regex += '[%s]' % char_class.replace('\\', '\\\\')
+            idx = end + 1
+        else:
+            regex += re.escape(pattern[idx])
+            idx += 1
+
+    return re.compile(regex + r'\Z')
+
+
+def query_file_index(index, pattern=None, extension=None):
+    """Returns all files in the provided index matching a glob pattern
+    and/or extension.
+
+    Args:
+        index (dict): An index returned by load_file_index.
+        pattern (string): A glob pattern relative to the indexed directory.
+            May contain '**/' to match any number of subdirectories.
+        extension (string): If provided only files with this extension are
+            returned.
+
+    Requires:
+        None
+
+    Returns:
+        list: Full paths of all matching files.
+
+    Example:
+        from hmp2_workflows.utils import file_index
+
+        index = file_index.load_file_index('/seq/ibdmdb/processing')
+        profiles = file_index.query_file_index(index, '**/*',
+                                               '_taxonomic_profile.tsv')
+    """
+    pattern = (pattern if pattern else '*') + (extension if extension else '')
+    pattern_regex = _glob_to_regex(pattern)
+
+    return [os.path.join(index['root'], rel_path) for rel_path in index['files']
+            if pattern_regex.match(rel_path)]
+
+
+def split_glob_root(search_path):
+    """Splits a glob pattern into the longest leading directory that holds
+    no wildcards and the remainder of the pattern.
+
+    Args:
+        search_path (string): A glob pattern.
+
+    Requires:
+        None
+
+    Returns:
+        string: The leading directory.
+        string: The pattern relative to the leading directory.
+    """
+    parts = search_path.split(os.sep)
+
+    root_parts = []
+    for part in parts[:-1]:
+        if any(char in part for char in '*?['):
+            break
+        root_parts.append(part)
+
+    root = os.sep.join(root_parts) or os.curdir
+    if search_path.startswith(os.sep) and not root_parts[1:]:
+        root = os.sep
+
+    return (root, os.sep.join(parts[len(root_parts):]))
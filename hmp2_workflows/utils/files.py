@@ -28,8 +28,13 @@ furnished to do so, subject to the following conditions:
     THE SOFTWARE.
 """
 
+import csv
 import datetime
 import os
+import re
+import subprocess
+
+from distutils.spawn import find_executable
 
 import pandas as pd
 
@@ -37,6 +42,29 @@ from glob2 import glob
 
 from biobakery_workflows import utilities as bb_utils
 
+from hmp2_workflows.utils.file_index import (load_file_index, query_file_index,
+                                             split_glob_root)
+from hmp2_workflows.utils.gid_index import get_sequence_files_from_gids
+from hmp2_workflows.utils.metadata_cache import load_metadata
+
+
+## Commands used to compress tarballs keyed on compressor name. pigz and 
+## zstd compress using multiple threads; plain gzip is used if pigz is not
+## installed.
+COMPRESSORS = {
+    'pigz': lambda threads, level: ['pigz', '-p', str(threads), '-%s' % (level or 6)],
+    'gzip': lambda threads, level: ['gzip', '-%s' % (level or 6)],
+    'zstd': lambda threads, level: ['zstd', '-q', '-T%s' % threads, '-%s' % (level or 3)],
+}
+
+## Columns of the table returned by build_tax_profile_match_table
+TAX_MATCH_FIELDS = ['mtx_file', 'sample_name', 'tax_profile_fname', 'tax_profile', 
+                    'status']
+
+## Workbook formats openpyxl can read; anything else (i.e. legacy .xls) is
+## read with pandas even when read_only mode is requested.
+OPENPYXL_EXTENSIONS = ['.xlsx', '.xlsm', '.xltx', '.xltm']
+
 
 def create_project_dirs(directories, project, submit_date, data_type):
     """Creates project directories that are required for raw, intermediate
@@ -87,7 +115,8 @@ def create_project_dirs(directories, project, submit_date, data_type):
     return project_dirs
 
 
-def find_files(path, pattern=None, extension=None):
+def find_files(path, pattern=None, extension=None, use_index=False, 
+               index_dir=None):
     """Searches a directory in a recurisve fashion for all files. If the 
     extension and/or pattern parameters are provided a search for files 
     that match the provided pattern and/or have the provided extension 
@@ -99,6 +128,11 @@ def find_files(path, pattern=None, extension=None):
             Can include the wildcard character '*'
         extension (string): If provided return files that match this 
             extension.
+        use_index (boolean): Answer the search from a cached index of the
+            directory tree (see hmp2_workflows.utils.file_index) rather than
+            walking it. The tree is indexed once per process so files 
+            created after the first search will not be found.
+        index_dir (string): Directory housing file index manifests.
 
     Requires:
         None
@@ -133,11 +167,20 @@ def find_files(path, pattern=None, extension=None):
     else:
         search_path = os.path.join(search_path, "*")
 
+    if use_index:
+        (root, rel_pattern) = split_glob_root(search_path)
+        if not os.path.isdir(root):
+            return []
+
+        index = load_file_index(root, index_dir)
+        return query_file_index(index, rel_pattern)
+
     files = glob(search_path)
     return files
         
 
-def get_sequence_file_from_gid(gid, broad_storage_path):
+def get_sequence_file_from_gid(gid, broad_storage_path, use_index=False,
+                               index_file=None):
     """Given a Broad Project GID for an associated sample do a search
     over the Broad sequence storage to find the associated raw sequence 
     files.
@@ -147,6 +190,11 @@ def get_sequence_file_from_gid(gid, broad_storage_path):
             These identifiers are unique per sequencing run per sample.
         broad_storage_path (string): The path to the Broad sequencing product
             archive.
+        use_index (boolean): Look the GID up in the archive's GID index 
+            (see hmp2_workflows.utils.gid_index) instead of searching the 
+            archive. Use hmp2_workflows.utils.gid_index.get_sequence_files_from_gids
+            to look up many GID's at once.
+        index_file (string): Path to the GID index.
 
     Requires:
         None
@@ -168,6 +216,10 @@ def get_sequence_file_from_gid(gid, broad_storage_path):
     """
     seq_file = None
 
+    if use_index:
+        return get_sequence_files_from_gids([gid], broad_storage_path, 
+                                            index_file)[gid]
+
     broad_gid_dir = os.path.join(broad_storage_path, gid)
     if os.path.exists(broad_gid_dir):
         seq_file_path = os.path.join(broad_gid_dir, "*", "current")
@@ -181,70 +233,354 @@ def get_sequence_file_from_gid(gid, broad_storage_path):
     return seq_file
 
 
+def build_tax_profile_match_table(mtx_fastqs, mtx_ext, mtx_col_id,
+                                  tax_profiles, tax_col_id,
+                                  metadata_file,
+                                  tags=None,
+                                  tax_tag='_taxonomic_profile.tsv'):
+    """Pairs MTX sequence files with MGX taxonomic profiles using the 
+    supplied HMP2 metadata file. MTX sample names, metadata rows and 
+    taxonomic profile basenames are each indexed once and joined with 
+    two merges; every MTX file is reported along with the reason it could
+    not be paired if no matching taxonomic profile was found.
+
+    Args:
+        mtx_fastqs (list): MTX sequence files to pair.
+        mtx_ext (string): Extension stripped from MTX files to get their 
+            sample names.
+        mtx_col_id (string): Metadata column holding MTX sample names.
+        tax_profiles (list): MGX taxonomic profiles to pair against.
+        tax_col_id (string): Metadata column holding the MGX sample name 
+            each taxonomic profile is named after.
+        metadata_file (string): Path to the HMP2 metadata file.
+        tags (list): Any tags that are attached to MTX files that can be 
+            stripped prior to matching.
+        tax_tag (string): Suffix appended to MGX sample names to build 
+            taxonomic profile file names.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: A table with the columns in TAX_MATCH_FIELDS. 
+            status is one of matched, not_in_metadata, no_tax_profile_id 
+            or tax_profile_missing.
+    """
+    mtx_fastqs = list(mtx_fastqs)
+    mtx_df = pd.DataFrame({'mtx_file': mtx_fastqs,
+                           'sample_name': bb_utils.sample_names(mtx_fastqs, mtx_ext)},
+                          columns=['mtx_file', 'sample_name'], dtype=object)
+
+    for tag in tags or []:
+        mtx_df['sample_name'] = mtx_df['sample_name'].str.replace(re.escape(tag), '')
+
+    metadata_df = load_metadata(metadata_file, columns=[mtx_col_id, tax_col_id],
+                                data_types=['metatranscriptomics'])
+    metadata_df = metadata_df[metadata_df[mtx_col_id].isin(mtx_df['sample_name'])]
+
+    tax_ids = metadata_df[tax_col_id]
+    sample_tax_df = pd.DataFrame({'sample_name': metadata_df[mtx_col_id],
+                                  'tax_profile_fname': tax_ids.dropna().astype(str) + tax_tag},
+                                 columns=['sample_name', 'tax_profile_fname'],
+                                 dtype=object)
+    sample_tax_df = sample_tax_df.drop_duplicates()
+
+    tax_profiles = list(tax_profiles)
+    tax_df = pd.DataFrame({'tax_profile_fname': [os.path.basename(tax_profile) 
+                                                 for tax_profile in tax_profiles],
+                           'tax_profile': tax_profiles},
+                          columns=['tax_profile_fname', 'tax_profile'], dtype=object)
+    tax_df = tax_df.drop_duplicates('tax_profile_fname')
+
+    match_df = mtx_df.merge(sample_tax_df, on='sample_name', how='left', 
+                            indicator='in_metadata')
+    match_df = match_df.merge(tax_df, on='tax_profile_fname', how='left')
+
+    match_df['status'] = 'matched'
+    match_df.loc[match_df['tax_profile'].isnull(), 'status'] = 'tax_profile_missing'
+    match_df.loc[match_df['tax_profile_fname'].isnull(), 'status'] = 'no_tax_profile_id'
+    match_df.loc[match_df['in_metadata'] == 'left_only', 'status'] = 'not_in_metadata'
+
+    return match_df[TAX_MATCH_FIELDS]
+
+
 def match_tax_profiles(mtx_fastqs, mtx_ext, mtx_col_id,
                        tax_profiles, tax_col_id, 
                        metadata_file,
                        tags=None,
-                       tax_tag='_taxonomic_profile.tsv'):
-    """Takes two sets of files and attempts to match them together based on 
-    the supplied HMP2 metadata file. Test
+                       tax_tag='_taxonomic_profile.tsv',
+                       report_file=None):
+    """Takes a set of MTX sequence files and a set of MGX taxonomic 
+    profiles and attempts to match them together based on the supplied 
+    HMP2 metadata file.
 
     Args:
-        files_a (list): The first set of files to match against.
-        files_a_id (string): Column to search for filename/ID in.
-        files_b (list): The second set of files to match against.
-        files_b_id (string): Column to search for filename/ID in. 
-        data_type (string): Data-type that files "B" are.
-        metadata_file (string): Path to a tab-delimited look-up file that 
-            could provide a way to match any files up.
+        mtx_fastqs (list): MTX sequence files to pair.
+        mtx_ext (string): Extension stripped from MTX files to get their 
+            sample names.
+        mtx_col_id (string): Metadata column holding MTX sample names.
+        tax_profiles (list): MGX taxonomic profiles to pair against.
+        tax_col_id (string): Metadata column holding the MGX sample name 
+            each taxonomic profile is named after.
+        metadata_file (string): Path to the HMP2 metadata file.
         tags (list): Any tags that are attached to files that can be 
             stripped prior to matching.
+        tax_tag (string): Suffix appended to MGX sample names to build 
+            taxonomic profile file names.
+        report_file (string): Optional path to write a tab-delimited report
+            of every MTX file and why it did or did not match.
 
     Requires:
         None
 
     Returns:
-        list: A list of files in set a that match to files set b; in order
-        list: A list of files in set b that match to files in set a; in order
+        list: A list of MTX files that match to taxonomic profiles; in order
+        list: A list of taxonomic profiles that match to MTX files; in order
+
+    Example:
+        from hmp2_workflows.utils import files
+
+        mtx_fastqs = ['/tmp/sampleA.fastq', '/tmp/sampleC.fastq']
+        tax_profiles = ['/tmp/sampleD_taxonomic_profile.tsv', 
+                        '/tmp/sampleB_taxonomic_profile.tsv']
+
+        (matched_fqs, matched_profiles) = files.match_tax_profiles(mtx_fastqs,
+                                                                   '.fastq',
+                                                                   'External ID',
+                                                                   tax_profiles,
+                                                                   'MGX External ID',
+                                                                   '/tmp/hmp2_metadata.csv')
+    """
+    match_df = build_tax_profile_match_table(mtx_fastqs, mtx_ext, mtx_col_id,
+                                             tax_profiles, tax_col_id,
+                                             metadata_file, tags, tax_tag)
+
+    if report_file:
+        match_df.to_csv(report_file, sep='\t', index=False)
+
+    unmatched_df = match_df[match_df['status'] != 'matched']
+    if not unmatched_df.empty:
+        print "Could not match %s MTX files to taxonomic profiles: %s" % (
+            len(unmatched_df), 
+            ", ".join("%s=%s" % (status, count) for (status, count) 
+                      in unmatched_df['status'].value_counts().iteritems()))
+
+    matched_df = match_df[match_df['status'] == 'matched']
+    return (matched_df['mtx_file'].tolist(), matched_df['tax_profile'].tolist())
+
+
+def get_compress_cmd(compressor='pigz', threads=1, level=None):
+    """Returns the command used to compress a stream with the requested
+    compressor. pigz falls back to gzip if it is not installed.
+
+    Args:
+        compressor (string): One of pigz, gzip or zstd.
+        threads (int): Number of threads used by the compressor.
+        level (int): Compression level passed to the compressor.
+
+    Requires:
+        None
+
+    Returns:
+        list: The compression command.
+    """
+    if compressor not in COMPRESSORS:
+        raise ValueError('Unknown compressor', compressor)
+
+    if compressor == 'pigz' and not find_executable('pigz'):
+        compressor = 'gzip'
+
+    return COMPRESSORS[compressor](threads, level)
+
+
+def create_tarball(files, output_tarball, compress=True, compressor='pigz',
+                   threads=1, level=None):
+    """Creates a tarball containing the provided files. Files are added to 
+    the tarball under their basenames, without any of their directory 
+    structure, and symlinks are followed. If compression is requested the 
+    tar stream is piped through the chosen compressor.
+
+    Args:
+        files (list): A list of files to package together into a tarball.
+        output_tarball (string): The desired output tarball file.
+        compress (boolean): Compress the tarball.
+        compressor (string): One of pigz, gzip or zstd.
+        threads (int): Number of threads used by the compressor.
+        level (int): Compression level passed to the compressor.
+
+    Requires:
+        tar: GNU tar
+        pigz: Parallel gzip (optional)
+        zstd: Zstandard compression (optional)
+
+    Returns:
+        string: Path to the newly created tarball file.
 
     Example:
         from hmp2_workflows.utils import files
 
-        files_a = ['sampleA.fastq', 'sampleC.fastq', 'sampleD.fastq']
-        files_b = ['sampleC_tax.tsv', 'sampleA_tax.tsv', 'sampleD_tax.tsv']
+        files.create_tarball(['/tmp/a/foo.tsv', '/tmp/b/bar.tsv'],
+                             '/tmp/foo_bar.tgz', threads=4)
+    """
+    compress_cmd = get_compress_cmd(compressor, threads, level) if compress else None
+
+    tar_cmd = ['tar', '-hcf', '-']
+    for tar_file in files:
+        tar_cmd.extend(['-C', os.path.dirname(os.path.abspath(tar_file)),
+                        os.path.basename(tar_file)])
+
+    tmp_tarball = output_tarball + '.tmp'
+    with open(tmp_tarball, 'wb') as tar_fh:
+        if not compress:
+            subprocess.check_call(tar_cmd, stdout=tar_fh)
+        else:
+            tar_proc = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+            compress_proc = subprocess.Popen(compress_cmd,
+                                             stdin=tar_proc.stdout,
+                                             stdout=tar_fh)
+            tar_proc.stdout.close()
+
+            if compress_proc.wait() or tar_proc.wait():
+                os.remove(tmp_tarball)
+                raise OSError('Failed to create tarball', output_tarball)
+
+    os.rename(tmp_tarball, output_tarball)
+
+    return output_tarball
+
+
+def get_sheet_csv_file(csv_file, sheet_name, sheet_idx):
+    """Returns the CSV file a worksheet of an Excel workbook is written to.
+    The first worksheet is written to the provided CSV file with any others
+    written alongside it, suffixed with their (sanitized) sheet name.
+
+    Args:
+        csv_file (string): The CSV file the workbook is converted to.
+        sheet_name (string): The name of the worksheet.
+        sheet_idx (int): The position of the worksheet in the workbook.
 
-        (matched_files_a, matched_files_b) = files.match_files(files_a, files_b)
-        # matched_files_a
-        # ['sampleA.fastq', 'sampleC.fastq', 'sampleD.fastq']
-        # matched_files_b
-        # ['sampleA_tax.tsv', 'sampleC_tax.tsv', 'sampleD_tax.tsv']
+    Requires:
+        None
+
+    Returns:
+        string: Path to the CSV file for this worksheet.
     """
-    matching_mtx_fastq = []
-    matching_tax_profiles = []
- 
-    # Making the assumption here that the sample ID we will use for lookup in 
-    # our metadata file is the filename once we remove the extension
-    mtx_sample_names = bb_utils.sample_names(mtx_fastqs, mtx_ext)
+    if sheet_idx == 0:
+        return csv_file
 
-    if tags:
-        mtx_sample_names = [name.replace(tag, '') for tag in tags 
-                            for name in mtx_sample_names if tag in name]
+    sheet_tag = str(re.sub(r'[^A-Za-z0-9_.-]+', '_', unicode(sheet_name)).strip('_'))
+    return "%s_%s.csv" % (os.path.splitext(csv_file)[0], sheet_tag)
 
-    mtx_sample_map = dict(zip(mtx_sample_names, mtx_fastqs))    
 
-    tax_profiles_fnames = map(os.path.basename, tax_profiles)
-    tax_profiles_map = dict(zip(tax_profiles_fnames, tax_profiles))
+def _is_openpyxl_workbook(excel_file):
+    """Returns True if the provided workbook can be read with openpyxl."""
+    return os.path.splitext(excel_file)[1].lower() in OPENPYXL_EXTENSIONS
 
-    metadata_df = pd.read_csv(metadata_file)
-    metadata_df_subset = metadata_df[(metadata_df.data_type == "metatranscriptomics") &
-                                     (metadata_df[mtx_col_id].isin(mtx_sample_names))]
 
-    for (idx, row) in metadata_df_subset.iterrows():
-        mtx_id = row.get(mtx_col_id)
-        tax_profile_fname = row.get(tax_col_id) + tax_tag 
+def get_sheet_csv_files(excel_file, csv_file, read_only=False):
+    """Returns the CSV files every worksheet of an Excel workbook is 
+    written to by convert_excel_to_csv when all_sheets is True.
+
+    Args:
+        excel_file (string): Path to the Excel workbook.
+        csv_file (string): The CSV file the workbook is converted to.
+        read_only (boolean): Read the sheet names with openpyxl's read-only
+            reader. Ignored for workbooks openpyxl cannot read (.xls).
+
+    Requires:
+        openpyxl: Required for read_only mode.
+
+    Returns:
+        list: Path to the CSV file for each worksheet in workbook order.
+    """
+    if read_only and _is_openpyxl_workbook(excel_file):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(excel_file, read_only=True)
+        sheet_names = workbook.sheetnames
+        workbook.close()
+    else:
+        sheet_names = pd.ExcelFile(excel_file).sheet_names
+
+    return [get_sheet_csv_file(csv_file, sheet_name, sheet_idx) for
+            (sheet_idx, sheet_name) in enumerate(sheet_names)]
+
+
+def _format_excel_value(value):
+    """Formats a cell value read by openpyxl the way pandas writes it."""
+    if value is None:
+        return ''
+    elif isinstance(value, float):
+        return str(int(value)) if value.is_integer() else repr(value)
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def convert_excel_to_csv(excel_file, csv_file, all_sheets=False, 
+                         read_only=False):
+    """Converts an Excel workbook to CSV. By default only the first 
+    worksheet is converted; if all_sheets is True every worksheet is 
+    converted from a single read of the workbook (see get_sheet_csv_file 
+    for how the extra CSV files are named).
+
+    The read_only mode streams rows out of an XLSX workbook with openpyxl's
+    read-only reader rather than loading each sheet into a DataFrame, 
+    keeping memory flat for large workbooks. Output follows the layout of 
+    pandas.DataFrame.to_csv, including the leading index column, but cell 
+    values are written as stored in the workbook. openpyxl only reads XLSX
+    workbooks so legacy .xls files are always converted with pandas.
+
+    Args:
+        excel_file (string): Path to the Excel workbook.
+        csv_file (string): Path to the CSV file to write the first 
+            worksheet to.
+        all_sheets (boolean): Convert every worksheet in the workbook.
+        read_only (boolean): Stream XLSX rows with openpyxl.
+
+    Requires:
+        openpyxl: Required for read_only mode.
+
+    Returns:
+        list: The CSV files written.
+
+    Example:
+        from hmp2_workflows.utils import files
+
+        csv_files = files.convert_excel_to_csv('/tmp/HMP2_metabolomics.xlsx',
+                                               '/tmp/HMP2_metabolomics.csv',
+                                               all_sheets=True)
+    """
+    csv_files = []
+
+    if read_only and _is_openpyxl_workbook(excel_file):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(excel_file, read_only=True, data_only=True)
+        worksheets = workbook.worksheets if all_sheets else workbook.worksheets[:1]
+
+        for (sheet_idx, worksheet) in enumerate(worksheets):
+            sheet_csv = get_sheet_csv_file(csv_file, worksheet.title, sheet_idx)
+
+            with open(sheet_csv, 'wb') as csv_fh:
+                csv_writer = csv.writer(csv_fh, lineterminator='\n')
+
+                for (row_idx, row) in enumerate(worksheet.iter_rows()):
+                    row_values = [_format_excel_value(cell.value) for cell in row]
+                    row_label = '' if row_idx == 0 else row_idx - 1
+                    csv_writer.writerow([row_label] + row_values)
+
+            csv_files.append(sheet_csv)
+
+        workbook.close()
+    else:
+        workbook = pd.ExcelFile(excel_file)
+        sheet_names = workbook.sheet_names if all_sheets else workbook.sheet_names[:1]
 
-        if tax_profile_fname in tax_profiles_fnames:
-            matching_mtx_fastq.append(mtx_sample_map.get(mtx_id))
-            matching_tax_profiles.append(tax_profiles_map.get(tax_profile_fname))
+        for (sheet_idx, sheet_name) in enumerate(sheet_names):
+            sheet_csv = get_sheet_csv_file(csv_file, sheet_name, sheet_idx)
+            workbook.parse(sheet_name).to_csv(sheet_csv)
+            csv_files.append(sheet_csv)
 
-    return (matching_mtx_fastq, matching_tax_profiles)
\ No newline at end of file
+    return csv_files
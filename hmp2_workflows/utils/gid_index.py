@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.gid_index
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An on-disk index mapping Broad Project GID's to the raw sequence files
+(BAMs) housed under the Broad sequencing product archive. The archive is
+scanned once in a pool of threads and the index stored as a tab-delimited
+table alongside the mtime of each GID directory; later loads only search
+GID directories added to the archive or modified since the index was 
+written and lookups fall back to a live search of the archive for any GID 
+missing from the index, without indexed files or whose indexed files no 
+longer exist.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import hashlib
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from glob2 import glob
+
+from hmp2_workflows.utils.file_index import (DEFAULT_INDEX_DIR, MTIME_RESOLUTION,
+                                             make_private_dir)
+
+
+## Header line of the index; holds the time the archive was last scanned.
+INDEX_HEADER = '#scan_time'
+
+## Indexes already loaded by this process keyed on index file.
+_GID_INDEXES = {}
+
+
+def find_gid_sequence_files(gid, broad_storage_path):
+    """Searches the Broad sequencing product archive for all BAMs under
+    <broad_storage_path>/<gid>/*/current
+
+    Args:
+        gid (string): The Broad Project GID.
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+
+    Requires:
+        None
+
+    Returns:
+        list: Paths to all BAMs found for the GID.
+    """
+    return sorted(glob(os.path.join(broad_storage_path, gid, "*", "current",
+                                    "*.bam")))
+
+
+def _find_gid_sequence_files(args):
+    (gid, broad_storage_path) = args
+    return (gid, find_gid_sequence_files(gid, broad_storage_path))
+
+
+def get_gid_mtime(gid, broad_storage_path):
+    """Returns the latest mtime of a GID directory, its sample directories
+    and their current directories. A BAM added under an existing GID only
+    changes the mtime of the current directory it is written to.
+
+    Args:
+        gid (string): The Broad Project GID.
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+
+    Requires:
+        None
+
+    Returns:
+        float: The latest mtime found for the GID.
+    """
+    gid_dir = os.path.join(broad_storage_path, gid)
+    mtimes = [os.stat(gid_dir).st_mtime]
+
+    for sample_dir in os.listdir(gid_dir):
+        for sub_dir in [(sample_dir,), (sample_dir, "current")]:
+            try:
+                mtimes.append(os.stat(os.path.join(gid_dir, *sub_dir)).st_mtime)
+            except OSError:
+                continue
+
+    return max(mtimes)
+
+
+def _scan_gid(args):
+    """Returns the mtime and sequence files of a single GID directory,
+    re-using the indexed entry for the GID if its mtime is unchanged since
+    the last scan.
+    """
+    (gid, broad_storage_path, cached_entry, last_scan) = args
+
+    try:
+        gid_mtime = get_gid_mtime(gid, broad_storage_path)
+    except OSError:
+        ## The GID directory was removed since the archive was listed.
+        return (gid, None)
+
+    if (cached_entry and cached_entry[0] == gid_mtime and
+        gid_mtime < last_scan - MTIME_RESOLUTION):
+        return (gid, cached_entry)
+
+    return (gid, (gid_mtime, find_gid_sequence_files(gid, broad_storage_path)))
+
+
+def get_gid_index_file(broad_storage_path, index_dir=None):
+    """Returns the default path of the GID index for the provided archive.
+
+    Args:
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+        index_dir (string): Directory housing indexes.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the GID index.
+    """
+    index_dir = index_dir if index_dir else make_private_dir(DEFAULT_INDEX_DIR)
+    return os.path.join(index_dir, "broad_gids_%s.tsv" %
+                        hashlib.md5(os.path.abspath(broad_storage_path)).hexdigest())
+
+
+def read_gid_index(index_file):
+    """Reads a GID index from disk.
+
+    Args:
+        index_file (string): Path to the GID index.
+
+    Requires:
+        None
+
+    Returns:
+        float: The time the archive was scanned when the index was written.
+        dict: Tuples of the GID directory mtime and list of sequence files 
+            keyed on GID; GID's without any sequence files have an empty 
+            list.
+    """
+    gid_index = {}
+
+    with open(index_file) as index_fh:
+        (header, scan_time) = index_fh.readline().rstrip('\n').split('\t')
+        if header != INDEX_HEADER:
+            raise ValueError('Unrecognized GID index', index_file)
+
+        for line in index_fh:
+            (gid, gid_mtime, seq_file) = line.rstrip('\n').split('\t')
+            gid_files = gid_index.setdefault(gid, (float(gid_mtime), []))[1]
+            if seq_file:
+                gid_files.append(seq_file)
+
+    return (float(scan_time), gid_index)
+
+
+def write_gid_index(index_file, scan_time, gid_index):
+    """Writes a GID index to disk as a tab-delimited table of GID, GID 
+    directory mtime and sequence file.
+
+    Args:
+        index_file (string): Path to the GID index.
+        scan_time (float): The time the archive was scanned.
+        gid_index (dict): Tuples of GID directory mtime and list of sequence
+            files keyed on GID.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the GID index.
+    """
+    index_dir = os.path.dirname(index_file)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    tmp_index_file = index_file + '.tmp'
+    with open(tmp_index_file, 'w') as index_fh:
+        index_fh.write("%s\t%r\n" % (INDEX_HEADER, scan_time))
+
+        for gid in sorted(gid_index):
+            (gid_mtime, seq_files) = gid_index[gid]
+            for seq_file in seq_files or ['']:
+                index_fh.write("%s\t%r\t%s\n" % (gid, gid_mtime, seq_file))
+
+    os.rename(tmp_index_file, index_file)
+
+    return index_file
+
+
+def build_gid_index(broad_storage_path, gid_index=None, last_scan=0, 
+                    threads=16):
+    """Scans the Broad sequencing product archive for the sequence files of
+    every GID directory. If an existing index is provided only GID's missing
+    from it or whose directory mtime has changed since the last scan are 
+    searched again and GID's no longer in the archive are dropped.
+
+    Args:
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+        gid_index (dict): An existing index to update.
+        last_scan (float): The time the existing index was scanned.
+        threads (int): Number of GID directories checked in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        float: The time the archive was scanned.
+        dict: Tuples of GID directory mtime and list of sequence files keyed 
+            on GID.
+
+    Example:
+        from hmp2_workflows.utils import gid_index
+
+        (scan_time, gids) = gid_index.build_gid_index('/n/broad/seq_archive')
+    """
+    gid_index = gid_index or {}
+
+    scan_time = time.time()
+    storage_gids = sorted(gid for gid in os.listdir(broad_storage_path)
+                          if os.path.isdir(os.path.join(broad_storage_path, gid)))
+
+    pool = ThreadPool(max(1, min(threads, len(storage_gids))))
+    try:
+        results = pool.map(_scan_gid, [(gid, broad_storage_path, 
+                                        gid_index.get(gid), last_scan) 
+                                       for gid in storage_gids])
+    finally:
+        pool.close()
+        pool.join()
+
+    return (scan_time, dict((gid, entry) for (gid, entry) in results if entry))
+
+
+def load_gid_index(broad_storage_path, index_file=None, threads=16):
+    """Loads the GID index for the provided archive, building it if it does
+    not exist and otherwise re-scanning any GID's added or modified since it
+    was written.
+
+    Args:
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+        index_file (string): Path to the GID index. Defaults to a file under
+            hmp2_workflows.utils.file_index.DEFAULT_INDEX_DIR
+        threads (int): Number of GID directories checked in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        dict: Lists of sequence files keyed on GID.
+    """
+    index_file = (index_file if index_file
+                  else get_gid_index_file(broad_storage_path))
+
+    if index_file in _GID_INDEXES:
+        return _GID_INDEXES[index_file]
+
+    (last_scan, gid_index) = (0, None)
+    if os.path.exists(index_file):
+        try:
+            (last_scan, gid_index) = read_gid_index(index_file)
+        except ValueError:
+            ## Indexes written in an older layout are rebuilt from scratch.
+            (last_scan, gid_index) = (0, None)
+
+    (scan_time, gid_index) = build_gid_index(broad_storage_path, gid_index,
+                                             last_scan, threads)
+    write_gid_index(index_file, scan_time, gid_index)
+
+    gid_map = dict((gid, seq_files) for (gid, (gid_mtime, seq_files))
+                   in gid_index.iteritems())
+    _GID_INDEXES[index_file] = gid_map
+
+    return gid_map
+
+
+def get_sequence_files_from_gids(gids, broad_storage_path, index_file=None,
+                                 threads=16):
+    """Looks up the raw sequence files for a batch of Broad Project GID's
+    in the GID index. Any GID missing from the index, without indexed 
+    sequence files or whose indexed sequence files no longer exist is 
+    searched for in the archive directly.
+
+    Args:
+        gids (list): Broad Project GID's to look up.
+        broad_storage_path (string): The path to the Broad sequencing product
+            archive.
+        index_file (string): Path to the GID index.
+        threads (int): Number of GID directories searched in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        dict: The sequence file for each GID keyed on GID; None if no
+            sequence file could be found.
+
+    Example:
+        from hmp2_workflows.utils import gid_index
+
+        seq_files = gid_index.get_sequence_files_from_gids(['19047774', '19047775'],
+                                                           '/n/broad/seq_archive/')
+    """
+    gid_map = load_gid_index(broad_storage_path, index_file, threads)
+
+    seq_files_map = {}
+    missed_gids = []
+    for gid in gids:
+        seq_files = gid_map.get(gid)
+
+        if not seq_files or not all(os.path.exists(seq_file) for seq_file
+                                    in seq_files):
+            missed_gids.append(gid)
+        else:
+            seq_files_map[gid] = seq_files
+
+    if missed_gids:
+        pool = ThreadPool(max(1, min(threads, len(missed_gids))))
+        try:
+            seq_files_map.update(pool.map(_find_gid_sequence_files,
+                                          [(gid, broad_storage_path) for gid in missed_gids]))
+        finally:
+            pool.close()
+            pool.join()
+
+    seq_file_map = {}
+    for gid in gids:
+        seq_files = seq_files_map[gid]
+
+        if len(seq_files) > 1:
+            raise OSError('Multiple sequence files exist for GID', gid)
+
+        seq_file_map[gid] = seq_files[0] if seq_files else None
+
+    return seq_file_map
@@ -150,6 +150,10 @@ def generate_collection_statistics(metadata_df, collection_dict):
     the number of weeks between the past collection date and days between
     the last collection date respectively.
 
+    The collection dates for all subjects are flattened into a single table
+    and joined against the metadata on subject and collection number in 
+    one pass.
+
     Args:
         metadata_df (pandas.DataFrame): DataFrame containing all metadata
         collection_dict (dict): Dictionary containing collection dates for
@@ -162,37 +166,26 @@ def generate_collection_statistics(metadata_df, collection_dict):
         pandas.DataFrame: Updated DataFrame with week_num and interval_days
             columns populated for each row.
     """
-    def _add_collection_columns(row):
-        """Adds the week_num and interval_days columns to the provided row
-        of a dataframe.
-
-        Args:
-            row (pandas.Series): A row of the metadata dataframe
-
-        Requires:
-            None
+    collection_df = pd.concat(collection_dict.values())
+    initial_dates = (collection_df.groupby('Subject')['Actual Date of Receipt']
+                     .transform('first'))
 
-        Returns:
-            pandas.Series: Modified row containing populated week_num and
-                interval_day columns.
-        """
-        subject_id = row['Subject']
-        visit_num = row['Collection #']
-        receipt_date = row['Actual Date of Receipt']
-
-        collection_dates = collection_dict.get(subject_id)
-        initial_visit_date = collection_dates.iloc[0]['Actual Date of Receipt']
-        subj_collection_row = collection_dates[collection_dates['Collection #']
-                                               == visit_num]
-        prev_visit_date = subj_collection_row['prev_coll_date'].values[0]
+    collection_df = pd.DataFrame({'Subject': collection_df['Subject'],
+                                  'Collection #': collection_df['Collection #'],
+                                  'initial_coll_date': initial_dates,
+                                  'prev_coll_date': collection_df['prev_coll_date'].fillna(initial_dates)})
+    collection_df = collection_df.drop_duplicates(['Subject', 'Collection #'])
 
-        if pd.isnull(prev_visit_date):
-            prev_visit_date = initial_visit_date
+    visits_df = metadata_df[['Subject', 'Collection #', 'Actual Date of Receipt']]
+    visits_df = visits_df.merge(collection_df, on=['Subject', 'Collection #'],
+                                how='left').set_index(metadata_df.index)
 
-        row['week_num'] = (receipt_date - initial_visit_date).days / 7
-        row['interval_days'] = (receipt_date - prev_visit_date).days
+    metadata_df['week_num'] = (visits_df['Actual Date of Receipt'] - 
+                               visits_df['initial_coll_date']).dt.days // 7
+    metadata_df['interval_days'] = (visits_df['Actual Date of Receipt'] - 
+                                    visits_df['prev_coll_date']).dt.days
 
-        return row
+    return metadata_df
 
 
 def reorder_columns(metadata_df, cols_to_move):
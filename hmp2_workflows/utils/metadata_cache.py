@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.metadata_cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A shared access layer for the HMP2 metadata table. The first time a
+metadata CSV is requested it is parsed once and written to a columnar cache
+keyed on the md5 hash of the CSV: one pickled column per file with string 
+columns stored as categoricals. Every subsequent request reads only the 
+columns asked for plus any of the External ID, Site/Sub/Coll ID or 
+data_type columns needed to filter rows.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+from hmp2_workflows.utils.file_index import USER_CACHE_DIR, make_private_dir
+
+
+## Columns rows can be filtered on. There is no index; each filter reads 
+## and scans the whole column.
+INDEX_COLUMNS = ['External ID', 'Site/Sub/Coll ID', 'data_type']
+
+## Cached columns are unpickled so the default cache must only be writable 
+## by the current user.
+DEFAULT_CACHE_DIR = os.path.join(USER_CACHE_DIR, 'metadata_cache')
+
+## md5 hashes of metadata files keyed on path; re-used as long as the
+## file's size and mtime are unchanged.
+_file_hashes = {}
+_cache_lock = threading.RLock()
+
+
+def get_file_hash(metadata_file):
+    """Returns the md5 hash of the provided file. Hashes are remembered for
+    the life of the process and only recomputed if the file changes.
+
+    Args:
+        metadata_file (string): Path to the metadata file.
+
+    Requires:
+        None
+
+    Returns:
+        string: The md5 hexdigest of the file.
+    """
+    metadata_file = os.path.abspath(metadata_file)
+    file_stat = os.stat(metadata_file)
+    file_key = (file_stat.st_size, file_stat.st_mtime)
+
+    cached_hash = _file_hashes.get(metadata_file)
+    if cached_hash and cached_hash[0] == file_key:
+        return cached_hash[1]
+
+    file_hash = hashlib.md5()
+    with open(metadata_file, 'rb') as metadata_fh:
+        for chunk in iter(lambda: metadata_fh.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    _file_hashes[metadata_file] = (file_key, file_hash.hexdigest())
+    return file_hash.hexdigest()
+
+
+def build_metadata_cache(metadata_file, dtype=None, cache_dir=None,
+                         header='infer'):
+    """Parses the provided metadata CSV and writes it to the cache if a
+    cached copy of this exact file does not already exist.
+
+    Args:
+        metadata_file (string): Path to the metadata CSV.
+        dtype (string): Passed through to pandas.read_csv; tables read with
+            dtype='str' are cached separately from those with inferred
+            types.
+        cache_dir (string): Directory housing the cache. Defaults to
+            DEFAULT_CACHE_DIR which is created private to the current user.
+        header (int): Passed through to pandas.read_csv; tables read 
+            without a header (header=None) are cached separately.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the cached table.
+
+    Example:
+        from hmp2_workflows.utils import metadata_cache
+
+        metadata_cache.build_metadata_cache('/tmp/hmp2_metadata.csv')
+    """
+    cache_dir = cache_dir or make_private_dir(DEFAULT_CACHE_DIR)
+    dtype_tag = 'str' if dtype in ('str', str, 'object', object) else 'inferred'
+    table_dir = os.path.join(cache_dir, "%s.%s" % (get_file_hash(metadata_file), 
+                                                   dtype_tag))
+    if header is None:
+        table_dir += '.noheader'
+
+    with _cache_lock:
+        if os.path.exists(os.path.join(table_dir, 'columns.pkl')):
+            return table_dir
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        metadata_df = pd.read_csv(metadata_file, dtype=dtype, header=header)
+
+        ## Columns are written to a scratch directory that is only moved
+        ## into place once complete so a half-written cache is never read.
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        for (idx, col) in enumerate(metadata_df.columns):
+            col_values = metadata_df[col]
+
+            ## Most metadata columns hold a handful of distinct values so 
+            ## string columns are stored as categoricals; this keeps the 
+            ## cache small and makes loading it far cheaper than re-parsing 
+            ## the CSV. Object columns mixing strings with other types are 
+            ## pickled as-is so their values round-trip unchanged.
+            if (col_values.dtype == object and
+                col_values.dropna().map(lambda val: isinstance(val, basestring)).all()):
+                col_values = col_values.astype('category')
+
+            col_values.to_pickle(os.path.join(tmp_dir, "col_%s.pkl" % idx))
+
+        pd.to_pickle(metadata_df.columns.tolist(), 
+                     os.path.join(tmp_dir, 'columns.pkl'))
+
+        try:
+            os.rename(tmp_dir, table_dir)
+        except OSError:
+            ## Another process cached the same file first.
+            shutil.rmtree(tmp_dir)
+
+    return table_dir
+
+
+def _read_column(table_dir, columns, col):
+    """Reads a single column of a cached metadata table."""
+    col_values = pd.read_pickle(os.path.join(table_dir, "col_%s.pkl" % 
+                                             columns.index(col)))
+
+    if col_values.dtype.name == 'category':
+        col_values = col_values.astype(object)
+
+    return col_values
+
+
+def load_metadata(metadata_file, columns=None, dtype=None, parse_dates=None,
+                  external_ids=None, site_sub_coll_ids=None, data_types=None,
+                  cache_dir=None, header='infer'):
+    """Loads the HMP2 metadata table from the cache (building it if needed),
+    returning only the requested columns and any rows matching the provided
+    filters.
+
+    Args:
+        metadata_file (string): Path to the metadata CSV.
+        columns (list): Columns to return. All columns are returned if not
+            provided.
+        dtype (string): Pass 'str' to load every column as a string,
+            mirroring pandas.read_csv(..., dtype='str')
+        parse_dates (list): Columns to convert to datetimes.
+        external_ids (list): Only return rows with these External ID's.
+        site_sub_coll_ids (list): Only return rows with these Site/Sub/Coll
+            ID's.
+        data_types (list): Only return rows of these data types.
+        cache_dir (string): Directory housing the cache.
+        header (int): Pass None to load a table without a header row, 
+            mirroring pandas.read_csv(..., header=None)
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The requested metadata.
+
+    Example:
+        from hmp2_workflows.utils import metadata_cache
+
+        mtx_df = metadata_cache.load_metadata('/tmp/hmp2_metadata.csv',
+                                              columns=['External ID', 'reads_raw'],
+                                              data_types=['metatranscriptomics'])
+    """
+    table_dir = build_metadata_cache(metadata_file, dtype, cache_dir, header)
+    table_cols = pd.read_pickle(os.path.join(table_dir, 'columns.pkl'))
+    columns = table_cols if columns is None else list(columns)
+
+    missing_cols = set(columns) - set(table_cols)
+    if missing_cols:
+        raise KeyError('Columns not found in metadata file: %s' % 
+                       ", ".join(sorted(missing_cols)))
+
+    row_mask = None
+    for (col, values) in zip(INDEX_COLUMNS, [external_ids, site_sub_coll_ids, 
+                                             data_types]):
+        if values is None:
+            continue
+
+        col_mask = _read_column(table_dir, table_cols, col).astype(str).isin(map(str, values))
+        row_mask = col_mask if row_mask is None else row_mask & col_mask
+
+    metadata_df = pd.DataFrame(collections.OrderedDict(
+        (col, _read_column(table_dir, table_cols, col)) for col in columns))
+
+    if row_mask is not None:
+        metadata_df = metadata_df[row_mask.values]
+
+    for col in (parse_dates or []):
+        if col in metadata_df.columns:
+            metadata_df[col] = pd.to_datetime(metadata_df[col])
+
+    return metadata_df
@@ -28,7 +28,11 @@ furnished to do so, subject to the following conditions:
     THE SOFTWARE.
 """
 
+import collections
 import datetime
+import functools
+import itertools
+import multiprocessing
 import os
 import re
 
@@ -36,6 +40,28 @@ import yaml
 
 from biobakery_workflows import utilities as bb_utils
 
+from hmp2_workflows.utils import sample_ids
+
+
+## virMAP taxonomic levels in order and the pattern used to split a virMAP
+## classification (i.e. superkingdom=Viruses;order=Caudovirales;taxId=28883)
+## into level/name pairs.
+VIRMAP_TAX_LABELS = ['superkingdom', 'phylum', 'class', 'order', 'family', 
+                     'genus', 'species']
+VIRMAP_TAX_LEVEL_PATTERN = re.compile(r'(\w+)=')
+
+## Lines of a virMAP profile relabeled at a time and the I/O buffer size
+## used when streaming profiles.
+VIRMAP_CHUNK_LINES = 10000
+VIRMAP_BUFFER_SIZE = 1024 * 1024
+
+## Labels given to each level of a CMMR OTU taxonomy, the lines of an OTU 
+## table relabeled at a time and the I/O buffer size used when streaming
+## OTU tables.
+CMMR_TAX_LEVEL_LABELS = ['k', 'p', 'c', 'o', 'f', 'g']
+CMMR_CHUNK_LINES = 100000
+CMMR_BUFFER_SIZE = 1024 * 1024
+
 
 def create_merged_md5sum_file(checksum_files, merged_checksum_file):
     """Parses a list of files containing md5checksums for a respective 
@@ -191,8 +217,7 @@ def get_sample_id_from_fname(filename):
     ## Just in-case we don't have a basename here; get our basename
     filename = os.path.basename(filename)
 
-    pattern = re.compile('.*[-|_]?(S[M|m]-?[0-9a-zA-Z]{4,5})[-|_]?.*')
-    matches = re.match(pattern, filename)
+    matches = sample_ids.ID_EXTRACTORS['broad_sample'].pattern.match(filename)
     if matches:
         sample_id = matches.group(1)
         sample_id = (sample_id.replace(sample_id[:2], sample_id[:2] + '-', 1) if '-' not in sample_id
@@ -224,24 +249,70 @@ def reset_column_headers(data_frame, header_col=0):
     return data_frame
 
 
-def relabel_virmap_taxonomy_classes(virmap_profile, out_dir):
-    """Relabels virMAP produced taxonomic profiles to the more traditional 
-    "k__", "o__", etc. labeling we use in other taxonomic profiles produced 
-    during HMP2 analysis.
+def lru_memoize(maxsize=100000):
+    """Decorator caching the results of a single-argument function, 
+    discarding the least recently used result once maxsize results are
+    cached.
 
     Args:
-        virmap_profile (string): Path to the virMAP profile to be relabeled.
-        out_dir (string): Path to save relabeled profile file too.
+        maxsize (int): Maximum number of results cached.
 
     Requires:
         None
 
     Returns:
-        string: Path to modofieid virMAP profile.
+        function: The decorator.
+
+    Example:
+        from hmp2_workflows.utils.misc import lru_memoize
+
+        @lru_memoize(maxsize=1000)
+        def fix_label(label):
+            return label.replace(' ', '_')
     """
-    relab_virmap_profile = os.path.join(out_dir, 'virmap_profile.relab.tsv')
+    def decorator(func):
+        cache = collections.OrderedDict()
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            if arg in cache:
+                value = cache.pop(arg)
+            else:
+                value = func(arg)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+
+            cache[arg] = value
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+@lru_memoize()
+def relabel_virmap_taxonomy(taxonomy_class):
+    """Relabels a single virMAP taxonomic classification to the more
+    traditional "k__", "o__", etc. labeling we use in other taxonomic 
+    profiles. Taxonomy strings repeat across virMAP profiles so results
+    are memoized.
+
+    Args:
+        taxonomy_class (string): A virMAP taxonomic classification.
+
+    Requires:
+        None
 
+    Returns:
+        string: The relabeled taxonomy.
+
+    Example:
+        from hmp2_workflows.utils.misc import relabel_virmap_taxonomy
 
+        relabel_virmap_taxonomy('superkingdom=Viruses;order=Caudovirales;taxId=28883')
+        ## 'k__Viruses|p__Viruses__noname|o__Caudovirales'
+    """
     # This is going to be a bit weird. But the basic premise is that we we 
     # are provided with a taxonomic classification that resembles the following:
     # 
@@ -250,57 +321,206 @@ def relabel_virmap_taxonomy_classes(virmap_profile, out_dir):
     # This indicates that classifications at the kingdom level and order level 
     # were made but nothing in between the levels was classified. So we should 
     # end up taggin these as <TAXONOMIC LEVEL>_Viruses_noname
-    tax_labels = ['superkingdom', 'phylum', 'class', 'order', 'family', 
-                  'genus', 'species']
-
-    # And now the fun begins...
-    relab_virmap_fh = open(relab_virmap_profile, 'w')
+    relabeled_tax_levels = []
+    end_pos = 0
+
+    tax_groups = list(zip(*[iter(VIRMAP_TAX_LEVEL_PATTERN.split(taxonomy_class)[1:-2])] * 2))
+
+    for (tax_level, tax_name) in tax_groups:
+        tax_name = tax_name[:-1].replace(' ', '_').replace(';', '_')
+
+        if tax_level == "superkingdom":
+            relabeled_tax_levels.append('k__%s' % tax_name)
+            end_pos = end_pos + 1
+            continue
+        if tax_level == "subfamily":
+            # We don't really care about sub-family in this case so skip it
+            continue
+        elif tax_level == "taxId":
+            break
+        else:
+            # Take the taxonomic level we are at end then the 
+            # most current taxonomic level we know we have a  
+            # validly labeled.
+            class_label_idx = VIRMAP_TAX_LABELS.index(tax_level)
+
+            if end_pos != class_label_idx-1:
+               tax_label_subset = VIRMAP_TAX_LABELS[end_pos:class_label_idx-1]
+               relabeled_tax_levels.extend(['%s__Viruses__noname' % 
+                                            tax_label[0] for tax_label in tax_label_subset])
+
+            relabeled_tax_levels.append('%s__%s' % (tax_level[0], tax_name))
+            end_pos = class_label_idx
+
+    return '|'.join(relabeled_tax_levels)
+
+
+def relabel_virmap_taxonomy_classes(virmap_profile, out_dir, out_file=None,
+                                    chunk_size=VIRMAP_CHUNK_LINES):
+    """Relabels virMAP produced taxonomic profiles to the more traditional 
+    "k__", "o__", etc. labeling we use in other taxonomic profiles produced 
+    during HMP2 analysis. The profile is streamed through in chunks of 
+    lines.
 
-    with open(virmap_profile) as virmap_fh:
-        for line in virmap_fh:
-            if line.startswith('ID'):
-                relab_virmap_fh.write(line)
-                continue
+    Args:
+        virmap_profile (string): Path to the virMAP profile to be relabeled.
+        out_dir (string): Path to save relabeled profile file too.
+        out_file (string): Name of the relabeled profile; defaults to 
+            virmap_profile.relab.tsv
+        chunk_size (int): Number of lines relabeled and written at a time.
 
-            line_elts = line.strip().split('\t')
-            (taxonomy_class, abundances) = (line_elts[0], line_elts[1:])
- 
-            relabeled_tax_levels = []
-            end_pos = 0
+    Requires:
+        None
 
-            tax_groups = list(zip(*[iter(re.split('(\w+)=', taxonomy_class)[1:-2])] * 2))
+    Returns:
+        string: Path to modofieid virMAP profile.
+    """
+    relab_virmap_profile = os.path.join(out_dir, out_file if out_file 
+                                                 else 'virmap_profile.relab.tsv')
 
-            for (tax_level, tax_name) in tax_groups:
-                tax_name = tax_name[:-1].replace(' ', '_').replace(';', '_')
+    with open(virmap_profile, 'r', VIRMAP_BUFFER_SIZE) as virmap_fh, \
+         open(relab_virmap_profile, 'w', VIRMAP_BUFFER_SIZE) as relab_virmap_fh:
+        for lines in iter(lambda: list(itertools.islice(virmap_fh, chunk_size)), []):
+            relabeled_lines = []
 
-                if tax_level == "superkingdom":
-                    relabeled_tax_levels.append('k__%s' % tax_name)
-                    end_pos = end_pos + 1
+            for line in lines:
+                if line.startswith('ID'):
+                    relabeled_lines.append(line)
                     continue
-                if tax_level == "subfamily":
-                    # We don't really care about sub-family in this case so skip it
-                    continue
-                elif tax_level == "taxId":
-                    break
-                else:
-                    # Take the taxonomic level we are at end then the 
-                    # most current taxonomic level we know we have a  
-                    # validly labeled.
-                    class_label_idx = tax_labels.index(tax_level)
-
-                    if end_pos != class_label_idx-1:
-                       tax_label_subset = tax_labels[end_pos:class_label_idx-1]
-                       relabeled_tax_levels.extend(['%s__Viruses__noname' % 
-                                                    tax_label[0] for tax_label in tax_label_subset])
-
-                    relabeled_tax_levels.append('%s__%s' % (tax_level[0], tax_name.replace(' ', '_')))
-                    end_pos = class_label_idx
-
-            relab_virmap_fh.write('|'.join(relabeled_tax_levels) + '\t' + '\t'.join(line_elts[1:]) + '\n')
-                
-            relabeled_tax_levels = []
-            end_pos = 0
-
-        relab_virmap_fh.close()
-    
-    return relab_virmap_profile
\ No newline at end of file
+
+                line_elts = line.strip().split('\t')
+                relabeled_lines.append(relabel_virmap_taxonomy(line_elts[0]) + '\t' + 
+                                       '\t'.join(line_elts[1:]) + '\n')
+
+            relab_virmap_fh.writelines(relabeled_lines)
+
+    return relab_virmap_profile
+
+
+def _relabel_virmap_profile(args):
+    (virmap_profile, out_dir, out_file) = args
+    return relabel_virmap_taxonomy_classes(virmap_profile, out_dir, out_file)
+
+
+def relabel_virmap_profiles(virmap_profiles, out_dir, processes=4):
+    """Relabels many virMAP profiles in a pool of processes. Each relabeled
+    profile is named after its input with a .relab.tsv extension.
+
+    Args:
+        virmap_profiles (list): Paths to the virMAP profiles to be relabeled.
+        out_dir (string): Path to save relabeled profiles too.
+        processes (int): Number of profiles relabeled in parallel.
+
+    Requires:
+        None
+
+    Returns:
+        list: Paths to the relabeled profiles; in order.
+
+    Example:
+        from hmp2_workflows.utils.misc import relabel_virmap_profiles
+
+        relab_profiles = relabel_virmap_profiles(['/tmp/a.rel_abund.tsv',
+                                                  '/tmp/b.rel_abund.tsv'],
+                                                 '/tmp/relab')
+    """
+    jobs = [(virmap_profile, out_dir, 
+             os.path.splitext(os.path.basename(virmap_profile))[0] + '.relab.tsv') 
+            for virmap_profile in virmap_profiles]
+
+    if processes <= 1 or len(jobs) <= 1:
+        return map(_relabel_virmap_profile, jobs)
+
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        return pool.map(_relabel_virmap_profile, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@lru_memoize()
+def relabel_cmmr_taxonomy(taxonomy):
+    """Labels the taxonomic levels of a single CMMR OTU taxonomy in the 
+    format that some of the biobakery viz functions can handle. Far fewer
+    distinct taxonomies exist than OTU's so results are memoized.
+
+    Args:
+        taxonomy (string): A CMMR taxonomy (i.e. __Bacteria; Firmicutes)
+
+    Requires:
+        None
+
+    Returns:
+        string: The relabeled taxonomy.
+
+    Example:
+        from hmp2_workflows.utils.misc import relabel_cmmr_taxonomy
+
+        relabel_cmmr_taxonomy('__Bacteria; Firmicutes; __c')
+        ## 'k__Bacteria; p__Firmicutes; c__'
+    """
+    new_taxonomy = []
+
+    for (idx, tax_level) in enumerate(taxonomy.split('; ')):
+        tax_label = CMMR_TAX_LEVEL_LABELS[idx]
+
+        if len(tax_level) == 3:
+            level_labeled = tax_level[-1::-1]
+        else:
+            if "__" in tax_level:
+                level_labeled = tax_label + tax_level
+            else:
+                level_labeled = "%s__%s" % (tax_label, tax_level)
+
+        new_taxonomy.append(level_labeled)
+
+    return '; '.join(new_taxonomy)
+
+
+def relabel_cmmr_otu_table(otu_table, fixed_otu_table, 
+                           chunk_size=CMMR_CHUNK_LINES):
+    """Relabels the taxonomy column of a CMMR OTU table. The table is 
+    streamed through in chunks of lines; the taxonomy column of each chunk
+    is split off, only its distinct taxonomies are relabeled and the 
+    results are mapped back onto every OTU.
+
+    Args:
+        otu_table (string): Path to the CMMR OTU table.
+        fixed_otu_table (string): Path to write the relabeled OTU table to.
+        chunk_size (int): Number of lines relabeled and written at a time.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the relabeled OTU table.
+
+    Example:
+        from hmp2_workflows.utils.misc import relabel_cmmr_otu_table
+
+        relabel_cmmr_otu_table('/tmp/OTU_Table.tsv', 
+                               '/tmp/OTU_Table_taxonomy_fix.tsv')
+    """
+    with open(otu_table, 'r', CMMR_BUFFER_SIZE) as otu_fh, \
+         open(fixed_otu_table, 'w', CMMR_BUFFER_SIZE) as fixed_otu_fh:
+        for lines in iter(lambda: list(itertools.islice(otu_fh, chunk_size)), []):
+            comment_rows = [(idx, line) for (idx, line) in enumerate(lines) 
+                            if line.startswith('#')]
+
+            otu_rows = [line.strip().rsplit('\t', 1) for line in lines 
+                        if not line.startswith('#')]
+            taxonomies = [otu_row[-1] for otu_row in otu_rows]
+            otu_ids = [otu_row[0] if len(otu_row) > 1 else '' for otu_row in otu_rows]
+
+            taxonomy_map = dict((taxonomy, relabel_cmmr_taxonomy(taxonomy)) 
+                                for taxonomy in set(taxonomies))
+
+            fixed_lines = ["%s\t%s\n" % (otu_id, taxonomy_map[taxonomy]) for (otu_id, taxonomy)
+                           in itertools.izip(otu_ids, taxonomies)]
+            for (idx, line) in comment_rows:
+                fixed_lines.insert(idx, line)
+
+            fixed_otu_fh.writelines(fixed_lines)
+
+    return fixed_otu_table
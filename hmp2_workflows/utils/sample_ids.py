@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.sample_ids
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A registry of precompiled rules used to extract HMP2 sample identifiers
+from file names. Each rule covers one data type and file source (Broad
+BAMs, PNNL proteomics raw files, Broad metabolomics files, analysis
+outputs) and is applied to a whole list of files at once, producing a
+mapping table in which any file a rule could not parse is left without a
+sample ID.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import collections
+import os
+import re
+
+import pandas as pd
+
+
+SampleIdRule = collections.namedtuple('SampleIdRule', ['pattern', 'prefix',
+                                                       'replace'])
+
+## Rules are keyed on name. A rule either extracts the first group of its
+## pattern (prepending prefix) or, if replace is set, substitutes every
+## match of its pattern with replace.
+ID_EXTRACTORS = {}
+
+## The rule used for each data type when mapping input files; any data type
+## not listed here uses the 'analysis_output' rule.
+DATA_TYPE_EXTRACTORS = {
+    'MPX': 'pnnl_raw',
+    'MBX': 'broad_mbx',
+}
+
+TABLE_COLUMNS = ['file', 'file_type', 'file_name', 'sample_id', 'type_tag']
+
+
+def register_id_extractor(name, pattern, prefix='', replace=None):
+    """Adds a sample ID extraction rule to the registry.
+
+    Args:
+        name (string): Name of the rule.
+        pattern (string): Regular expression applied to file names. Unless
+            replace is provided the first group is taken as the sample ID.
+        prefix (string): String prepended to every extracted sample ID.
+        replace (string): If provided every match of pattern is replaced
+            with this string and the result is used as the sample ID.
+
+    Requires:
+        None
+
+    Returns:
+        SampleIdRule: The registered rule.
+
+    Example:
+        from hmp2_workflows.utils import sample_ids
+
+        sample_ids.register_id_extractor('htx_bam', r'^(\w+?)_htx')
+    """
+    rule = SampleIdRule(re.compile(pattern), prefix, replace)
+    ID_EXTRACTORS[name] = rule
+
+    return rule
+
+
+## PNNL: 160513-SM-AHYMJ-14.raw -> SM-AHYMJ
+register_id_extractor('pnnl_raw', r'^[^-_]*[-_][^-_]*[-_]([^-_]*)', prefix='SM-')
+
+## Broad MBX: 0396_XAV_iHMP2_FFA_SM-AF6NB.raw.gz -> SM-AF6NB
+register_id_extractor('broad_mbx', r'^(?:.*SM-)?(.{0,5})', prefix='SM-')
+
+## Broad BAM's and MetaPhlAn2/HUMAnN2 outputs: MSM5LLHX_taxonomic_profile -> MSM5LLHX
+register_id_extractor('analysis_output',
+                      r'_taxonomic_profile|_pathabundance|_genefamilies',
+                      replace='')
+
+## Analysis outputs keyed on their prefix: MSM5LLHX_pathabundance_relab -> MSM5LLHX
+register_id_extractor('output_prefix', r'^([^_]*)')
+
+## Any file carrying a Broad sample ID: CSM5MCVZ.bam, 160916_SM-9W3BK_307.raw
+register_id_extractor('broad_sample', r'.*[-|_]?(S[M|m]-?[0-9a-zA-Z]{4,5})[-|_]?.*')
+
+
+def extract_sample_ids(file_names, extractor):
+    """Applies the named extraction rule to a collection of file names.
+
+    Args:
+        file_names (list): File names (without directories or extensions).
+        extractor (string): Name of the rule in ID_EXTRACTORS to apply.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.Series: The sample ID for each file name; null where the rule
+            did not match.
+
+    Example:
+        from hmp2_workflows.utils import sample_ids
+
+        ids = sample_ids.extract_sample_ids(['160513-SM-AHYMJ-14'], 'pnnl_raw')
+    """
+    if extractor not in ID_EXTRACTORS:
+        raise KeyError('Unknown sample ID extractor', extractor)
+
+    rule = ID_EXTRACTORS[extractor]
+    file_names = pd.Series(list(file_names), dtype=object)
+
+    if file_names.empty:
+        return file_names
+
+    if rule.replace is not None:
+        return file_names.map(lambda file_name: rule.pattern.sub(rule.replace,
+                                                                 file_name))
+
+    return rule.prefix + file_names.str.extract(rule.pattern, expand=False)
+
+
+def _apply_tags(file_names, tags, keep_tags):
+    """Strips any of the provided tags from each file name returning the
+    stripped names and the last tag found in each (if keep_tags is set).
+    """
+    type_tags = pd.Series([None] * len(file_names), index=file_names.index,
+                          dtype=object)
+
+    for tag in tags or []:
+        tag_mask = file_names.str.contains(tag, regex=False)
+        file_names = file_names.where(~tag_mask,
+                                      file_names.str.replace(re.escape("_" + tag), ''))
+        if keep_tags:
+            type_tags[tag_mask] = tag
+
+    return (file_names, type_tags)
+
+
+def build_sample_id_table(data_files, extractor, tags=None, keep_tags=False,
+                          strip_tags=True, strip_ext='all'):
+    """Builds a table mapping each of the provided files to the sample ID
+    extracted from its name.
+
+    Args:
+        data_files (dict): Lists of files keyed on file type.
+        extractor (string): Name of the rule in ID_EXTRACTORS to apply.
+        tags (list): Tags that may be embedded (as _<TAG>) in file names.
+        keep_tags (boolean): Record the tag found in each file name in the
+            type_tag column.
+        strip_tags (boolean): Remove any tags found from file names before
+            extracting sample ID's.
+        strip_ext (string): 'all' drops everything after the first '.' of
+            a file name; 'last' drops only the final extension after
+            removing any .gz.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: A table with the columns in TABLE_COLUMNS; files
+            that could not be mapped have a null sample_id.
+
+    Example:
+        from hmp2_workflows.utils import sample_ids
+
+        id_table = sample_ids.build_sample_id_table({'raw': ['/tmp/160513-SM-AHYMJ-14.raw']},
+                                                    'pnnl_raw')
+    """
+    file_types = []
+    files = []
+    for file_type in data_files:
+        files.extend(data_files[file_type])
+        file_types.extend([file_type] * len(data_files[file_type]))
+
+    id_table = pd.DataFrame({'file': files, 'file_type': file_types},
+                            columns=TABLE_COLUMNS)
+    if id_table.empty:
+        return id_table
+
+    if strip_ext == 'all':
+        file_names = id_table['file'].map(os.path.basename).str.split('.', n=1).str[0]
+    else:
+        file_names = (id_table['file'].str.replace(re.escape('.gz'), '')
+                                      .map(os.path.basename)
+                                      .map(lambda fname: os.path.splitext(fname)[0]))
+
+    (stripped_names, type_tags) = _apply_tags(file_names, tags, keep_tags)
+
+    id_table['file_name'] = file_names
+    id_table['sample_id'] = extract_sample_ids(stripped_names if strip_tags
+                                               else file_names, extractor).values
+    id_table['type_tag'] = type_tags
+
+    return id_table
+
+
+def get_unmatched_files(id_table):
+    """Returns the files in a sample ID table that could not be mapped to a
+    sample ID.
+
+    Args:
+        id_table (pandas.DataFrame): A table from build_sample_id_table.
+
+    Requires:
+        None
+
+    Returns:
+        list: Files without a sample ID.
+    """
+    return id_table[id_table['sample_id'].isnull()]['file'].tolist()
+
+
+def sample_id_table_to_map(id_table):
+    """Converts a sample ID table to a dictionary keyed on sample ID, then
+    file type (suffixed with any type tag), holding lists of files. Files
+    without a sample ID are reported and left out.
+
+    Args:
+        id_table (pandas.DataFrame): A table from build_sample_id_table.
+
+    Requires:
+        None
+
+    Returns:
+        dict: Files grouped by sample ID and file type.
+    """
+    unmatched_files = get_unmatched_files(id_table)
+    if unmatched_files:
+        print "Could not extract sample ID's from %s files: %s" % (len(unmatched_files),
+                                                                 ", ".join(unmatched_files))
+
+    sample_id_map = {}
+    for (data_file, file_type, sample_id, type_tag) in zip(id_table['file'],
+                                                           id_table['file_type'],
+                                                           id_table['sample_id'],
+                                                           id_table['type_tag']):
+        if pd.isnull(sample_id):
+            continue
+
+        if not pd.isnull(type_tag) and type_tag:
+            file_type = file_type + "_" + type_tag
+
+        sample_id_map.setdefault(sample_id, {}).setdefault(file_type, []).append(data_file)
+
+    return sample_id_map
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp2_workflows.utils.staging
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Functions used to move batches of files into the HMP2 processing and
+public directories with a single rsync call per batch rather than one per
+file.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import collections
+import os
+import subprocess
+import tempfile
+import time
+
+
+## Extensions of files that are already compressed; rsync's -z only costs
+## CPU when sending these.
+COMPRESSED_EXTENSIONS = ['gz', 'bz2', 'xz', 'zst', 'zip', 'tgz', 'bam']
+
+
+def is_compressed(file_path):
+    """Returns True if the provided file carries one of the extensions
+    found in COMPRESSED_EXTENSIONS.
+
+    Args:
+        file_path (string): Path to the file.
+
+    Requires:
+        None
+
+    Returns:
+        boolean: True if the file is already compressed.
+    """
+    return file_path.rsplit('.', 1)[-1].lower() in COMPRESSED_EXTENSIONS
+
+
+def group_files_by_dir(input_files, target_files, batch_size=None):
+    """Groups the supplied files into batches that share a source
+    directory and a target directory. Each batch can be handed to a single
+    rsync call.
+
+    Args:
+        input_files (list): Files to be staged.
+        target_files (list): The staged path of each file in input_files.
+        batch_size (int): Maximum number of files in a batch. Batches are
+            unbounded if not provided.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of (source_dir, target_dir, input_files, target_files)
+            tuples.
+
+    Example:
+        from hmp2_workflows.utils import staging
+
+        batches = staging.group_files_by_dir(['/tmp/a/foo.fq', '/tmp/a/bar.fq'],
+                                             ['/tmp/b/foo.fq', '/tmp/b/bar.fq'])
+    """
+    groups = collections.OrderedDict()
+    for (input_file, target_file) in zip(input_files, target_files):
+        group_key = (os.path.dirname(input_file), os.path.dirname(target_file))
+        groups.setdefault(group_key, []).append((input_file, target_file))
+
+    batches = []
+    for ((source_dir, target_dir), group_files) in groups.items():
+        step = batch_size or len(group_files)
+        for idx in xrange(0, len(group_files), step):
+            batch_files = group_files[idx:idx+step]
+            batches.append((source_dir, target_dir,
+                            [item[0] for item in batch_files],
+                            [item[1] for item in batch_files]))
+
+    return batches
+
+
+def rsync_file_batch(input_files, target_dir, remove_existing=True):
+    """Copies a batch of files that share a source directory into the
+    provided target directory using a single rsync call driven by
+    --files-from. Compression is only enabled when the batch contains files
+    that are not already compressed and throughput for the batch is
+    printed once the copy completes.
+
+    Args:
+        input_files (list): Files to copy; all must live in the same
+            directory.
+        target_dir (string): Directory to copy files into.
+        remove_existing (boolean): Remove any file or symlink already
+            present at the target path before copying.
+
+    Requires:
+        rsync v3.0.6+: A versatile file copying tool.
+
+    Returns:
+        list: The staged files.
+
+    Example:
+        from hmp2_workflows.utils import staging
+
+        staging.rsync_file_batch(['/tmp/a/foo.fq.gz', '/tmp/a/bar.fq.gz'],
+                                 '/tmp/b')
+    """
+    source_dirs = set(os.path.dirname(input_file) for input_file in input_files)
+    if len(source_dirs) != 1:
+        raise ValueError('All files in a batch must share a source directory',
+                         sorted(source_dirs))
+
+    source_dir = source_dirs.pop() or '.'
+    target_files = [os.path.join(target_dir, os.path.basename(input_file))
+                    for input_file in input_files]
+
+    if remove_existing:
+        for target_file in target_files:
+            if os.path.lexists(target_file):
+                os.remove(target_file)
+
+    rsync_cmd = ['rsync', '-av']
+    if not all(map(is_compressed, input_files)):
+        rsync_cmd[1] = '-avz'
+        rsync_cmd.append('--skip-compress=%s' % "/".join(COMPRESSED_EXTENSIONS))
+
+    (list_fd, list_file) = tempfile.mkstemp(suffix='.files')
+    with os.fdopen(list_fd, 'w') as list_fh:
+        list_fh.write("\n".join(map(os.path.basename, input_files)) + "\n")
+
+    try:
+        start_time = time.time()
+        subprocess.check_call(rsync_cmd + ['--files-from=%s' % list_file,
+                                           source_dir + os.sep,
+                                           target_dir + os.sep])
+        elapsed_time = max(time.time() - start_time, 1e-6)
+    finally:
+        os.remove(list_file)
+
+    total_bytes = sum(os.path.getsize(target_file) for target_file in target_files)
+    print ("Staged %s files (%.1f MB) from %s to %s in %.1fs (%.1f MB/s)" %
+           (len(target_files), total_bytes / 1e6, source_dir, target_dir,
+            elapsed_time, total_bytes / 1e6 / elapsed_time))
+
+    return target_files
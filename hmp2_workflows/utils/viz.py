@@ -36,6 +36,8 @@ import pandas as pd
 
 from operator import itemgetter
 
+from hmp2_workflows.utils.metadata_cache import load_metadata
+
 
 def convert_table_to_datatables_json(table_file, output_dir):
     """Converts a tab-delimited text file to a JSON file that can be read 
@@ -246,7 +248,7 @@ def filter_taxonomic_profiles(tax_profile, metadata_file, output_folder, min_rea
     """
     filtered_tax_file = os.path.join(output_folder, "filtered_taxonomic_profiles.tsv")
     taxonomy_df = pd.read_table(tax_profile)
-    metadata_df = pd.read_csv(metadata_file)
+    metadata_df = load_metadata(metadata_file)
 
     ## If a metadata file is provided we should have access to number of reads here so we can 
     ## execute the same filtering steps from the manuscript
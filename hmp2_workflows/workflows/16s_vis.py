@@ -34,11 +34,10 @@ THE SOFTWARE.
 
 import os
 
-from glob2 import glob
-
 from anadama2 import Workflow
 
 from hmp2_workflows import document_templates
+from hmp2_workflows.utils.files import find_files
 from biobakery_workflows import utilities, files
 
 
@@ -78,25 +77,25 @@ def main(workflow):
     vars = {}
 
     # This file should exist in either scenario
-    eestats_table = glob(os.path.join(args.input + "/**/",
-        files.SixteenS.file_info['eestats2'].keywords.get('names')))[0]
+    eestats_table = find_files(args.input, os.path.join("**/",
+        files.SixteenS.file_info['eestats2'].keywords.get('names')), use_index=True)[0]
 
     templates.append(document_templates.get_template('header'))
     templates.append(document_templates.get_template('16s_bp'))
 
     if args.source == 'biobakery':
-        otu_table = glob(os.path.join(args.input + '/**/', 
-            files.SixteenS.file_info['otu_table_closed_reference'].keywords.get('names')))[0]
-        otu_table_open = glob(os.path.join(args.input + '/**/',
-            files.SixteenS.file_info['otu_table_open_reference'].keywords.get('names')))[0]
-        read_counts_table = glob(os.path.join(args.input + "/**/",
-            files.SixteenS.file_info['read_count_table'].keywords.get('names')))[0]
-        centroid_fasta = glob(os.path.join(args.input + "/**/",
-            files.SixteenS.file_info['msa_nonchimera'].keywords.get('names')))[0]
-        centroid_closed_fasta = glob(os.path.join(args.input + "/**/",
-            files.SixteenS.file_info['msa_closed_reference'].keywords.get('names')))[0]
-        centroid_closed_fasta = glob(os.path.join(args.input + "/**/",
-            files.SixteenS.file_info['msa_closed_reference'].keywords.get('names')))[0]
+        otu_table = find_files(args.input, os.path.join('**/', 
+            files.SixteenS.file_info['otu_table_closed_reference'].keywords.get('names')), use_index=True)[0]
+        otu_table_open = find_files(args.input, os.path.join('**/',
+            files.SixteenS.file_info['otu_table_open_reference'].keywords.get('names')), use_index=True)[0]
+        read_counts_table = find_files(args.input, os.path.join("**/",
+            files.SixteenS.file_info['read_count_table'].keywords.get('names')), use_index=True)[0]
+        centroid_fasta = find_files(args.input, os.path.join("**/",
+            files.SixteenS.file_info['msa_nonchimera'].keywords.get('names')), use_index=True)[0]
+        centroid_closed_fasta = find_files(args.input, os.path.join("**/",
+            files.SixteenS.file_info['msa_closed_reference'].keywords.get('names')), use_index=True)[0]
+        centroid_closed_fasta = find_files(args.input, os.path.join("**/",
+            files.SixteenS.file_info['msa_closed_reference'].keywords.get('names')), use_index=True)[0]
         log_file = files.Workflow.path('log', args.input)
 
         dependencies = [otu_table, otu_table_open, read_counts_table, 
@@ -108,9 +107,9 @@ def main(workflow):
 
         templates.append(document_templates.get_template('quality_control_16S_CMMR'))
     elif args.source == 'CMMR':
-        otu_table = glob(os.path.join(args.input + '/**/' + 'OTU_Table_taxonomy_fix.tsv'))[0]
-        centroid_fasta = glob(os.path.join(args.input + '/**/', 'CentroidInformation.fa'))[0]
-        read_counts_table = glob(os.path.join(args.input + '/**/' + 'read_counts.tsv'))[0]
+        otu_table = find_files(args.input, os.path.join('**/' + 'OTU_Table_taxonomy_fix.tsv'), use_index=True)[0]
+        centroid_fasta = find_files(args.input, os.path.join('**/', 'CentroidInformation.fa'), use_index=True)[0]
+        read_counts_table = find_files(args.input, os.path.join('**/' + 'read_counts.tsv'), use_index=True)[0]
         dependencies = [read_counts_table, otu_table, eestats_table, centroid_fasta]
 
         templates.append(document_templates.get_template('quality_control_16s_cmmr'))
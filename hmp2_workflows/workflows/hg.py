@@ -96,6 +96,7 @@ def main(workflow):
                                    input_files,
                                    project_dirs[1],
                                    paired_end=True,
+                                   stream=True,
                                    threads=args.threads,
                                    compress=False)
         paired_fastq_files = paired_files(fastq_files, '_R1')
@@ -96,6 +96,7 @@ def main(workflow):
                                           input_files,
                                           project_dirs[1],
                                           paired_end=True,
+                                          stream=True,
                                           threads=args.threads)
 
         paired_fastq_tars = []
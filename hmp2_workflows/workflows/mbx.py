@@ -108,7 +108,9 @@ def main(workflow):
         # we will want to process them and convert to CSV.
         processed_files = excel_to_csv(workflow, 
                                        deposited_files,
-                                       processing_dir)
+                                       processing_dir,
+                                       read_only=conf.get('excel_read_only', False),
+                                       cache_dir=conf.get('analysis_cache_dir'))
 
         pcl_files = add_metadata_to_tsv(workflow,
                                         processed_files,
@@ -117,7 +119,8 @@ def main(workflow):
                                         conf.get('metadata_id_col'),
                                         metadata_rows=dataset_cfg.get('metadata_rows'),
                                         col_offset=dataset_cfg.get('col_offset'),
-                                        target_cols=conf.get('target_metadata_cols', None))
+                                        target_cols=conf.get('target_metadata_cols', None),
+                                        cache_dir=conf.get('analysis_cache_dir'))
 
         public_files = stage_files(workflow, pcl_files, public_dir)
 
@@ -34,11 +34,10 @@ THE SOFTWARE.
 
 import os
 
-from glob2 import glob
-
 from anadama2 import Workflow
 
 from hmp2_workflows import document_templates
+from hmp2_workflows.utils.files import find_files
 from biobakery_workflows import utilities, files
 
 
@@ -67,9 +66,9 @@ def main(workflow):
     args = workflow.parse_args()
     templates = []
 
-    taxonomic_profile = glob(os.path.join(args.input + '/**/', 'HMP2.Virome.MetaPhlAn2.txt'))[0]
-    virmap_profile = glob(os.path.join(args.input + '/**/', 'HMP2.Virome.VirMAP.rel_abund.tsv'))[0]
-    read_counts = glob(os.path.join(args.input + '/**/', 'HMP2.Virome.VirMAP_Stats.txt'))[0]
+    taxonomic_profile = find_files(args.input, os.path.join('**/', 'HMP2.Virome.MetaPhlAn2.txt'), use_index=True)[0]
+    virmap_profile = find_files(args.input, os.path.join('**/', 'HMP2.Virome.VirMAP.rel_abund.tsv'), use_index=True)[0]
+    read_counts = find_files(args.input, os.path.join('**/', 'HMP2.Virome.VirMAP_Stats.txt'), use_index=True)[0]
 
     # TOOO: Segment these templates even more so we can pull in individual pieces that 
     # are used across all templates (like parsing and displaying metaphlan tables)
@@ -86,7 +86,10 @@ def main(workflow):
         ## files won't be in the same location as the Broad files so 
         ## we'll need to get MD5's manually supplied.
         validated_files = verify_files(workflow, input_files, 
-                                       args.checksums_file)
+                                       args.checksums_file,
+                                       local=conf.get('local_md5_verify', False),
+                                       threads=conf.get('md5_verify_threads', 4),
+                                       cache_file=conf.get('md5_cache_file'))
 
         ## Setup the directories where we will be depositing our files
         date_stamp = str(datetime.date.today())
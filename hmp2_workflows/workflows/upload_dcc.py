@@ -28,6 +28,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import hashlib
 import itertools
 import logging
 import os
@@ -45,7 +46,16 @@ from hmp2_workflows.utils.misc import (parse_cfg_file, parse_checksums_file,
 from biobakery_workflows.utilities import find_files
 
 from hmp2_workflows.utils import dcc
-from hmp2_workflows.tasks.dcc import upload_data_files
+from hmp2_workflows.utils import dcc_cache
+from hmp2_workflows.utils import dcc_ledger
+from hmp2_workflows.utils.metadata_cache import load_metadata
+from hmp2_workflows.tasks.dcc import upload_data_files, apply_upload_plan
+
+
+## Products looked up per parent while uploading; these are pulled in bulk
+## up front rather than with one query per sequence set or prep.
+PREFETCH_NODE_TYPES = ['abundance_matrix', 'serology', 'host_variant_call',
+                       'host_epigenetics_raw_seq_set']
 
 
 def set_logging():
@@ -83,19 +93,87 @@ def parse_cli_arguments():
                           'containing baseline visit metadata per subject.')                           
     workflow.add_argument('config-file', desc='Configuration file '
                           'containing parameters required by the workflow.')
+    workflow.add_argument('osdf-cache', desc='SQLite file used to mirror the '
+                          'DCC study locally. When provided the study is '
+                          'bulk-loaded once at the start of the run and all '
+                          'lookups are served from the mirror.', default=None)
+    workflow.add_argument('upload-threads', desc='Maximum number of DCC '
+                          'objects to upload concurrently.', default=8)
+    workflow.add_argument('plan-file', desc='Compute all changes needed to '
+                          'bring the DCC up to date and write them to this '
+                          'file instead of uploading anything.', default=None)
+    workflow.add_argument('apply-plan', desc='Upload the changes found in a '
+                          'plan file previously written using --plan-file.', 
+                          default=None)
+    workflow.add_argument('upload-ledger', desc='SQLite file recording every '
+                          'file pushed to the DCC. Files unchanged since '
+                          'they were last pushed are skipped without '
+                          'querying the DCC.', default=None)
+    workflow.add_argument('journal-file', desc='Append-only journal of '
+                          'metadata rows whose DCC objects have all been '
+                          'saved. When restarting a failed upload with the '
+                          'same journal any unchanged rows already uploaded '
+                          'are skipped. Objects saved for a partially '
+                          'uploaded row are re-diffed on restart; use '
+                          '--upload-ledger to avoid re-fetching them from '
+                          'the DCC.', default=None)
 
     return workflow
 
 
+def get_row_checksum(row, output_files, md5sums_map):
+    """Generates a checksum covering a single row of metadata and all the 
+    data files tied to it. If either the metadata or any of the files change
+    so does the checksum.
+
+    Args:
+        row (pandas.Series): Metadata row for a single sample.
+        output_files (dict): Output files associated with the sample keyed 
+            on their file type.
+        md5sums_map (dict): md5 checksums keyed on file name.
+
+    Requires:
+        None
+
+    Returns:
+        string: The md5 hexdigest of the row and its files.
+    """
+    file_names = set()
+    for value in itertools.chain(row.values, *(output_files or {}).values()):
+        for file_path in (value if isinstance(value, list) else [value]):
+            if isinstance(file_path, basestring) and os.path.basename(file_path) in md5sums_map:
+                file_names.add(os.path.basename(file_path))
+
+    row_hash = hashlib.md5(repr(sorted(row.iteritems())))
+    for file_name in sorted(file_names):
+        row_hash.update("%s:%s" % (file_name, md5sums_map[file_name]))
+
+    return row_hash.hexdigest()
+
+
 def main(workflow):
     args = workflow.parse_args()
     conf = parse_cfg_file(args.config_file)
+
+    if args.upload_ledger:
+        dcc.set_upload_ledger(dcc_ledger.open_upload_ledger(args.upload_ledger))
+
+    if args.journal_file:
+        dcc.set_upload_journal(args.journal_file)
+
+    if args.apply_plan:
+        session = cutlass.iHMPSession(conf.get('username'), 
+                                      conf.get('password'), 
+                                      ssl=False)
+        apply_upload_plan(workflow, args.apply_plan, 
+                          threads=int(args.upload_threads))
+        return
     data_type_mapping = conf.get('datatype_mapping')
 
     manifest = parse_cfg_file(args.manifest_file)
     data_files = manifest.get('submitted_files')
 
-    metadata_df = pd.read_csv(args.metadata_file)
+    metadata_df = load_metadata(args.metadata_file)
     baseline_metadata_df = pd.read_csv(args.baseline_metadata_file)
     md5sums_map = {}
 
@@ -107,12 +185,28 @@ def main(workflow):
         password = conf.get('password')
         session = cutlass.iHMPSession(username, password, ssl=False)
 
+        if args.plan_file:
+            dcc.start_upload_plan()
+
         dcc_objs = []
         dcc_project = dcc.get_project(conf, session)
         dcc_study = dcc.crud_study(conf, 
                                    session,
                                    dcc_project.id)
-        dcc_subjects = dcc.group_osdf_objects(dcc_study.subjects(),
+
+        if args.osdf_cache:
+            osdf_cache = dcc_cache.open_osdf_cache(args.osdf_cache)
+            dcc_cache.load_study_subtree(osdf_cache, session, dcc_study.id,
+                                         conf.get('namespace', 'ihmp'))
+            dcc.set_osdf_cache(osdf_cache)
+        else:
+            dcc.prefetch_osdf_nodes(session, PREFETCH_NODE_TYPES,
+                                    conf.get('data_study'), 
+                                    conf.get('namespace', 'ihmp'))
+
+        dcc_subjects = dcc.group_osdf_objects(dcc.get_osdf_children(dcc_study,
+                                                                    ['subject'],
+                                                                    dcc_study.subjects),
                                               'rand_subject_id')
         dcc_subjects = dcc.crud_subjects(dcc_subjects, dcc_study, baseline_metadata_df, conf)
 
@@ -164,15 +258,48 @@ def main(workflow):
             if output_files:
                 ## Do a bunch of stuff here since we have output files
                 output_files_map = dcc.create_output_file_map(data_type, output_files, tags=file_tags)
-    
+
+            ## Objects are queued up across the whole data type so they can be 
+            ## pushed to the DCC by a pool of concurrent uploads. Raw sequence 
+            ## sets are pushed first, then anything computed from them (viral 
+            ## and trimmed 16S sequence sets) and lastly the output files; objects whose 
+            ## parent is only saved in an earlier level are linked to it 
+            ## once that level is done.
+            dcc_upload_levels = [[], [], []]
+            obj_parents = {}
+
+            ## Rows are journaled once every object queued for them has been 
+            ## saved; on a restart any journaled rows (or whole participants) 
+            ## whose metadata and files are unchanged are skipped.
+            row_checksums = {}
+            row_pending = {}
+            obj_rows = {}
+
             for (subject_id, metadata) in sample_metadata_df.groupby(['Participant ID']):
+                row_keys = {}
+                for (idx, row) in metadata.iterrows():
+                    row_key = "%s:%s" % (data_type, row.get('External ID'))
+                    row_checksums[row_key] = get_row_checksum(row, 
+                                                              (output_files_map or {}).get(row.get('External ID')),
+                                                              md5sums_map)
+                    if not dcc.is_journaled('row', row_key, row_checksums[row_key]):
+                        row_keys[idx] = row_key
+
+                if not row_keys:
+                    print "SKIPPING PARTICIPANT %s; ALL ROWS JOURNALED" % subject_id
+                    continue
+
+                metadata = metadata.loc[row_keys.keys()]
+
                 dcc_subject = dcc_subjects.get(subject_id[1:])
                 if dcc_subject:
                     dcc_subject = dcc_subject[0]
                 else:
                     raise ValueError('Could not find Subject object for subject ID %s' % subject_id)                        
 
-                dcc_visits = dcc.group_osdf_objects(dcc_subject.visits(),
+                dcc_visits = dcc.group_osdf_objects(dcc.get_osdf_children(dcc_subject,
+                                                                          ['visit'],
+                                                                          dcc_subject.visits),
                                                     'visit_id')
                 
                 for (idx, row) in metadata.iterrows():
@@ -184,7 +311,9 @@ def main(workflow):
                                                conf)
                     dcc_visits.setdefault(dcc_visit.visit_id, []).append(dcc_visit)
 
-                    dcc_samples = dcc.group_osdf_objects(dcc_visit.samples(),
+                    dcc_samples = dcc.group_osdf_objects(dcc.get_osdf_children(dcc_visit,
+                                                                               ['sample'],
+                                                                               dcc_visit.samples),
                                                          'name')
                     dcc_sample = dcc.crud_sample(dcc_samples,
                                                  row.get('site_sub_coll'),
@@ -301,9 +430,11 @@ def main(workflow):
                         dcc_viral_seq_set = dcc.crud_viral_seq_set(dcc_raw_seq_set,
                                                                    row.get('viral_seq_set')[0],
                                                                    md5sums_map.get(viral_seq_set_fname),
+                                                                   dcc_sample.name,
                                                                    dtype_metadata,
                                                                    row)
                         input_dcc_objs.extend([dcc_raw_seq_set, dcc_viral_seq_set])
+                        obj_parents[id(dcc_viral_seq_set)] = (dcc_raw_seq_set, 'computed_from')
 
                     elif data_type == '16SBP' or data_type == "16S":
                         raw_seq_set_fname = os.path.basename(row.get('16S_raw_seq_set')[0])
@@ -323,6 +454,7 @@ def main(workflow):
                                                                             dtype_metadata,
                                                                             row)
                         input_dcc_objs.extend([dcc_raw_seq_set, dcc_trimmed_seq_set])
+                        obj_parents[id(dcc_trimmed_seq_set)] = (dcc_raw_seq_set, 'computed_from')
                     elif data_type == 'RRBS':
                         raw_epigenetics_seq_set = row.get('host_epigenetics_raw_seq_set')
                         raw_epigenetics_fname = os.path.basename(raw_epigenetics_seq_set[0])
@@ -357,14 +489,18 @@ def main(workflow):
                     if len(input_dcc_objs) == 0:
                         input_dcc_objs.append(dcc_seq_obj)
 
-                    ##uploaded_files = upload_data_files(workflow, input_dcc_objs)
+                    row_key = row_keys[idx]
+                    row_dcc_objs = [dcc_obj for dcc_obj in input_dcc_objs if 
+                                    getattr(dcc_obj, 'updated', False)]
+
+                    for dcc_obj in row_dcc_objs:
+                        dcc_upload_levels[1 if id(dcc_obj) in obj_parents else 0].append(dcc_obj)
 
                     ## The only output type currently supported are AbundanceMatrices 
                     ## so those are the only we will work with. Short-sided and 
                     ## ugly but can re-work this later.
                     if output_files_map and row.get('External ID') in output_files_map:
                         seq_out_files = output_files_map.get(row.get('External ID'))
-                        dcc_output_objs = []
 
                         for (output_ftype, output_files) in seq_out_files.iteritems():
                             for output_file in output_files:
@@ -380,7 +516,8 @@ def main(workflow):
                                     ## MBX data is a bit tricky since we can have multiple inputs and outputs
                                     ## that need to be threaded together.
                                     analysis_type = output_base.split('_', 1)[-1]
-                                    dcc_parent_obj = next((p for p in input_dcc_objs if analysis_type in p.urls[0]), None)
+                                    dcc_parent_obj = next((p for p in input_dcc_objs if analysis_type in 
+                                                           (p.urls or [p.local_file])[0]), None)
                                 else:
                                     dcc_parent_obj = input_dcc_objs[-1]
 
@@ -404,9 +541,45 @@ def main(workflow):
                                                                             dtype_metadata,
                                                                             row)
 
-                                dcc_output_objs.append(dcc_output_obj)
+                                obj_parents[id(dcc_output_obj)] = (dcc_parent_obj, 'computed_from')
+                                dcc_upload_levels[2].append(dcc_output_obj)
+                                row_dcc_objs.append(dcc_output_obj)
+
+                    row_pending[row_key] = set(id(dcc_obj) for dcc_obj in 
+                                               row_dcc_objs if dcc_obj.updated)
+                    obj_rows.update((id(dcc_obj), row_key) for dcc_obj in 
+                                    row_dcc_objs if dcc_obj.updated)
+
+                    if not row_pending[row_key]:
+                        dcc.record_journal_entry('row', row_key, 
+                                                 checksum=row_checksums[row_key])
 
-                        uploaded_file = upload_data_files(workflow, dcc_output_objs)
+            def _complete_row(dcc_obj):
+                row_key = obj_rows[id(dcc_obj)]
+                row_pending[row_key].discard(id(dcc_obj))
+
+                if not row_pending[row_key]:
+                    dcc.record_journal_entry('row', row_key, 
+                                             checksum=row_checksums[row_key])
+
+            for level_objs in dcc_upload_levels:
+                for dcc_obj in level_objs:
+                    if dcc_obj.updated and id(dcc_obj) in obj_parents:
+                        (dcc_parent_obj, link_type) = obj_parents[id(dcc_obj)]
+                        dcc_obj.links[link_type] = [dcc_parent_obj.id]
+
+                if args.plan_file:
+                    map(dcc.save_osdf_object, [dcc_obj for dcc_obj in level_objs
+                                               if dcc_obj.updated])
+                else:
+                    uploaded_files = upload_data_files(workflow, level_objs,
+                                                       threads=int(args.upload_threads),
+                                                       callback=_complete_row)
+
+        if args.plan_file:
+            plan_summary = dcc.write_upload_plan(args.plan_file)
+            for ((node_type, action), count) in sorted(plan_summary.items()):
+                print "%s\t%s\t%s" % (node_type, action, count)
 
 
 if __name__ == "__main__":
@@ -46,7 +46,7 @@ from biobakery_workflows.utilities import (find_files,
                                            name_files)
 from hmp2_workflows.tasks.common import (verify_files, 
                                          stage_files,
-                                         tar_files,
+                                         tar_files_batch,
                                          make_files_web_visible)
 from hmp2_workflows.tasks.file_conv import (batch_convert_tsv_to_biom, bam_to_fastq)
 from hmp2_workflows.tasks.analysis import generate_ko_files
@@ -130,6 +130,7 @@ def main(workflow):
                                             deposited_files, 
                                             processing_dir, 
                                             paired_end=True,
+                                            stream=True,
                                             compress=False,
                                             threads=args.threads)
             pair_identifier = "_R1"                                            
@@ -204,7 +205,10 @@ def main(workflow):
         #                                                  genefamilies,
         #                                                  processing_dir)
 
-        biom_files = batch_convert_tsv_to_biom(workflow, tax_profile_outputs[1])
+        biom_files = batch_convert_tsv_to_biom(workflow, 
+                                               tax_profile_outputs[1],
+                                               batch_size=conf.get('biom_batch_size', 200),
+                                               cache_dir=conf.get('biom_cache_dir'))
         tax_biom_files = stage_files(workflow,
                                      biom_files,
                                      processing_dir)
@@ -240,7 +244,8 @@ def main(workflow):
                                                id_col=conf.get('metadata_id_col'),
                                                col_replace=conf.get('analysis_col_patterns'),
                                                target_cols=conf.get('target_metadata_cols'),
-                                               aux_files=[knead_read_counts])
+                                               aux_files=[knead_read_counts],
+                                               chunksize=conf.get('pcl_chunksize', 100000))
 
         pub_files = [stage_files(workflow, files, target_dir) for (files, target_dir) 
                      in [(cleaned_fastqs, pub_raw_dir), 
@@ -272,18 +277,19 @@ def main(workflow):
                                     subfolder = 'kos_relab',
                                     extension = 'tsv')
 
-        func_tar_files = []
+        func_tarballs = []
         for (sample, gene_file, ecs_file, path_file) in zip(sample_names,
                                                             norm_genefamilies,
                                                             norm_ecs_files,
                                                             norm_path_files):
             tar_path = os.path.join(pub_func_profile_dir, 
                                     "%s_humann2.tgz" % sample)
-            func_tar_file = tar_files(workflow, 
-                                      [gene_file, ecs_file, path_file],
-                                      tar_path,
-                                      depends=func_profile_outputs)
-            func_tar_files.append(func_tar_file)
+            func_tarballs.append(([gene_file, ecs_file, path_file], tar_path))
+
+        func_tar_files = tar_files_batch(workflow, 
+                                         func_tarballs,
+                                         depends=func_profile_outputs,
+                                         threads=args.threads)
 
 
         workflow.go()
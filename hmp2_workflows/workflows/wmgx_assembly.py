@@ -80,77 +80,31 @@ def main(workflow):
                       targets=split_dir)
 
 
-    sorted_dir = os.path.join(args.output, 'sorted')
-    workflow.add_task('mkdir -p [targets[0]]',
-                      depends=split_dir,
-                      targets=sorted_dir)
-
     ## It seems like most of the data we are dealing with are not actual
-    ## proper deinterleaved sequences so we'll need to sort them beforehand
-    sorted_seqs = [os.path.join(sorted_dir, "%s.sorted.fastq.gz" % s) for s in samples]
-
-    for (in_seq, out_seq) in zip(sequence_files, sorted_seqs):
-        sample_name = os.path.basename(in_seq).split(os.extsep)[0]
-        temp_dir = os.path.join(sorted_dir, "%s.tmp" % sample_name)
-    
-        workflow.add_task('mkdir -p [targets[0]]',
-                          depends=[sorted_dir],
-                          targets=[temp_dir])
-
-        workflow.add_task_gridable('zcat [depends[0]] | paste - - - - | '
-                                   'sort -T [args[1]] -k1,1 -S [args[0]] | tr \'\t\' \'\n\' | '
-                                   'pigz --best -p 4 > [targets[0]]',
-                                   depends=[in_seq, sorted_dir, temp_dir],
-                                   targets=out_seq,
-                                   args=['10G', temp_dir],
-                                   cores='4',
-                                   mem=args.memory,
-                                   time='120')
-
-        # Delete our temp directories from the sort step
-        workflow.add_task('rm -rf [depends[0]]',
-                          depends=[temp_dir, out_seq])
-
-
-    ## Drop out any reads in our interleaved file that do not have a matching paired
-    ## sequence
-    matched_seqs = [s.replace('.sorted.fastq', '.paired.fastq') for s in sorted_seqs]
-    workflow.add_task_group_gridable('seqtk dropse [depends[0]] | pigz --best -p 4 > [targets[0]]',
-                                     depends=sorted_seqs,
-                                     targets=matched_seqs,
-                                     cores='4',
-                                     mem='4096',
-                                     time='60')
-
-    for (sorted_seq, matched_seq) in zip(sorted_seqs, matched_seqs):
-        workflow.add_task('rm [depends[0]]',
-                          depends=[sorted_seq, matched_seq])
-    
-    # And finally peel off the orphans into a separate file
-    for (raw_seq, matched_seq) in zip(sorted_seqs, matched_seqs):
-       orphan_seq = raw_seq.replace('.paired.fastq', '.orphans.fastq')
-       workflow.add_task_gridable('extract_orphans.sh [depends[0]] [depends[1]] [args[0]]',
-                                  depends=[raw_seq, matched_seq],
-                                  targets=[orphan_seq],
-                                  args=[split_dir])
-
+    ## proper deinterleaved sequences so we'll need to group reads by name
+    ## before splitting them into paired-end reads. This is done in the same
+    ## pass that drops any reads without a matching pair into a separate 
+    ## orphans file. Sorting only holds a small index of read name hashes 
+    ## in memory and spills sorted runs to a scratch directory.
     split_files = []
-    for in_seq in matched_seqs:
+    for in_seq in sequence_files:
         seq_base = os.path.basename(in_seq).split(os.extsep)[0]
         f_seq = os.path.join(split_dir, "%s_R1.fastq.gz" % seq_base)
         r_seq = os.path.join(split_dir, "%s_R2.fastq.gz" % seq_base)
+        orphan_seq = os.path.join(split_dir, "%s_orphans.fastq.gz" % seq_base)
+        split_stats = os.path.join(split_dir, "%s.split_stats.tsv" % seq_base)
         split_files.append((f_seq, r_seq))
 
-        workflow.add_task_gridable('seqtk seq -1 [depends[0]] | pigz --best -p 4 > [targets[0]] && '
-                                   'seqtk seq -2 [depends[0]] | pigz --best -p 4 > [targets[1]]',
+        workflow.add_task_gridable('split_interleaved_fastq.py -i [depends[0]] '
+                                   '-1 [targets[0]] -2 [targets[1]] -u [targets[2]] '
+                                   '-s [targets[3]] -t 2 --sort --tmp-dir [args[0]]',
                                    depends=[in_seq, split_dir],
-                                   targets=[f_seq, r_seq],
+                                   targets=[f_seq, r_seq, orphan_seq, split_stats],
+                                   args=[split_dir],
                                    cores='4',
-                                   mem='4096',
+                                   mem='2048',
                                    time='120')
 
-
-
     ## We need to run KneadData on our sequences first.
     qc_out_dir = os.path.join(args.output, 'qc')
     workflow.add_task('mkdir -p [targets[0]]',
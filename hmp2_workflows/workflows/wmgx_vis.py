@@ -34,11 +34,10 @@ THE SOFTWARE.
 
 import os
 
-from glob2 import glob
-
 from anadama2 import Workflow
 
 from hmp2_workflows import document_templates
+from hmp2_workflows.utils.files import find_files
 from biobakery_workflows import utilities, files
 
 
@@ -67,16 +66,16 @@ def parse_cli_arguments():
 def main(workflow):
     args = workflow.parse_args()
 
-    taxonomic_profile = glob(os.path.join(args.input + '/**/', 
-        files.ShotGun.file_info['taxonomic_profile'].keywords.get('names')))[0]
-    dna_read_counts = glob(os.path.join(args.input + '/**/',
-        files.ShotGun.file_info['kneaddata_read_counts'].keywords.get('names')))[0]
-    pathabundance = glob(os.path.join(args.input + "/**/",
-        files.ShotGun.file_info['pathabundance_relab'].keywords.get('names')))[0]
-    read_counts = glob(os.path.join(args.input + "/**/",
-        files.ShotGun.file_info['humann2_read_counts'].keywords.get('names')))[0]
-    feature_counts = glob(os.path.join(args.input + "/**/",
-        files.ShotGun.file_info['feature_counts'].keywords.get('names')))[0]
+    taxonomic_profile = find_files(args.input, os.path.join('**/', 
+        files.ShotGun.file_info['taxonomic_profile'].keywords.get('names')), use_index=True)[0]
+    dna_read_counts = find_files(args.input, os.path.join('**/',
+        files.ShotGun.file_info['kneaddata_read_counts'].keywords.get('names')), use_index=True)[0]
+    pathabundance = find_files(args.input, os.path.join("**/",
+        files.ShotGun.file_info['pathabundance_relab'].keywords.get('names')), use_index=True)[0]
+    read_counts = find_files(args.input, os.path.join("**/",
+        files.ShotGun.file_info['humann2_read_counts'].keywords.get('names')), use_index=True)[0]
+    feature_counts = find_files(args.input, os.path.join("**/",
+        files.ShotGun.file_info['feature_counts'].keywords.get('names')), use_index=True)[0]
 
     templates = []
     templates.append(document_templates.get_template('header'))
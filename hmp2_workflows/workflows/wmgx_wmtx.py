@@ -42,7 +42,7 @@ from biobakery_workflows.tasks.shotgun import (quality_control,
                                                norm_ratio)
 
 from hmp2_workflows.tasks.common import (verify_files, stage_files,
-                                         tar_files,
+                                         tar_files_batch,
                                          make_files_web_visible)
 from hmp2_workflows.tasks.file_conv import bam_to_fastq
 from hmp2_workflows.utils.files import (find_files, match_tax_profiles, 
@@ -137,6 +137,7 @@ def main(workflow):
                                             deposited_files_mtx, 
                                             project_dirs_mtx[1],
                                             paired_end=True,
+                                            stream=True,
                                             compress=False,
                                             threads=args.threads)
             pair_identifier_mtx = "_R1"                                            
@@ -205,6 +206,7 @@ def main(workflow):
                                                     deposited_files_mgx, 
                                                     project_dirs_mgx[1],
                                                     paired_end=True,
+                                                    stream=True,
                                                     compress=False,
                                                     threads=args.threads)
                     pair_identifier_mgx = "_R1"                                            
@@ -263,18 +265,20 @@ def main(workflow):
                                                 conf_mgx.get('analysis_col_patterns'),
                                                 conf_mgx.get('target_metadata_cols'))
                                       
-                func_tar_files_wgs = []
+                func_tarballs_wgs = []
                 for (sample, gene_file, ecs_file, path_file) in zip(sample_names_mgx,
                                                                     norm_genefamilies_mgx,
                                                                     norm_ecs_files_mgx,
                                                                     norm_path_files_mgx):
                     tar_path = os.path.join(pub_wgs_func_profile_dir, 
                                             "%s_humann2.tgz" % sample)
-                    func_tar_file = tar_files(workflow,
-                                            [gene_file, ecs_file, path_file],
-                                            tar_path,
-                                            depends=func_outs_mgx)
-                    func_tar_files_wgs.append(func_tar_file)
+                    func_tarballs_wgs.append(([gene_file, ecs_file, path_file], 
+                                              tar_path))
+
+                func_tar_files_wgs = tar_files_batch(workflow,
+                                                     func_tarballs_wgs,
+                                                     depends=func_outs_mgx,
+                                                     threads=args.threads)
 
         ##########################################
         #          MTX FILE PROCESSING           #
@@ -293,7 +297,9 @@ def main(workflow):
                                                                      input_tax_profiles,
                                                                      data_files.get('MGX').get('tax_profile_id', 'External ID'),
                                                                      args.metadata_file,
-                                                                     tags=input_file_tags)
+                                                                     tags=input_file_tags,
+                                                                     report_file=os.path.join(project_dirs_mtx[1],
+                                                                                              'mtx_tax_profile_matches.tsv'))
 
             func_outs_match_mtx = functional_profile(workflow,
                                                      matched_fqs,
@@ -356,18 +362,19 @@ def main(workflow):
                                          tag='pathabundance_relab',
                                          extension='tsv')
 
-        func_tar_files_mtx = []
+        func_tarballs_mtx = []
         for (sample, gene_file, ecs_file, path_file) in zip(sample_names_mtx,
                                                             norm_genefamilies_mtx,
                                                             norm_ecs_files_mtx,
                                                             norm_path_files_mtx):
             tar_path = os.path.join(pub_mtx_func_profile_dir,
                                     "%s_humann2.tgz" % sample)
-            func_tar_file = tar_files(workflow,
-                                      [gene_file, ecs_file, path_file],
-                                      tar_path,
-                                      depends=func_outs_mtx)
-            func_tar_files_mtx.append(func_tar_file)
+            func_tarballs_mtx.append(([gene_file, ecs_file, path_file], tar_path))
+
+        func_tar_files_mtx = tar_files_batch(workflow,
+                                             func_tarballs_mtx,
+                                             depends=func_outs_mtx,
+                                             threads=args.threads)
     
         workflow.go()
 
@@ -34,11 +34,10 @@ THE SOFTWARE.
 
 import os
 
-from glob2 import glob
-
 from anadama2 import Workflow
 
 from hmp2_workflows import document_templates
+from hmp2_workflows.utils.files import find_files
 from biobakery_workflows import utilities, files
 
 
@@ -67,18 +66,18 @@ def parse_cli_arguments():
 def main(workflow):
     args = workflow.parse_args()
 
-    read_counts = glob(os.path.join(args.input + '/**/',
-        files.ShotGun.file_info['kneaddata_read_counts'].keywords.get('names')))[0]
-    aligned_read_counts = glob(os.path.join(args.input + '/**/',
-        files.ShotGun.file_info['humann2_read_counts'].keywords.get('names')))[0]
-    norm_pathabundance = glob(os.path.join(args.input + "/**/paths",
-        files.ShotGun.file_info['paths_norm_ratio'].keywords.get('names')))[0]
+    read_counts = find_files(args.input, os.path.join('**/',
+        files.ShotGun.file_info['kneaddata_read_counts'].keywords.get('names')), use_index=True)[0]
+    aligned_read_counts = find_files(args.input, os.path.join('**/',
+        files.ShotGun.file_info['humann2_read_counts'].keywords.get('names')), use_index=True)[0]
+    norm_pathabundance = find_files(args.input, os.path.join("**/paths",
+        files.ShotGun.file_info['paths_norm_ratio'].keywords.get('names')), use_index=True)[0]
     #norm_genefamilies = glob(os.path.join(args.input + "/**/genes",
     #    files.ShotGun.file_info['genefamilies_norm_ratio'].keywords.get('names')))[0]
-    norm_ecs = glob(os.path.join(args.input + "/**/ecs",
-        files.ShotGun.file_info['ecs_norm_ratio'].keywords.get('names')))[0]
-    feature_counts = glob(os.path.join(args.input + "/**/",
-        files.ShotGun.file_info['feature_counts'].keywords.get('names')))[0]
+    norm_ecs = find_files(args.input, os.path.join("**/ecs",
+        files.ShotGun.file_info['ecs_norm_ratio'].keywords.get('names')), use_index=True)[0]
+    feature_counts = find_files(args.input, os.path.join("**/",
+        files.ShotGun.file_info['feature_counts'].keywords.get('names')), use_index=True)[0]
 
     templates = []
     templates.append(document_templates.get_template('header'))